@@ -6,7 +6,7 @@ load_dotenv()  # Cargar variables del archivo .env local
 from flask import Flask, send_from_directory
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from db import init_db
+from db import check_schema_version, init_cache_bus, init_request_scope
 
 # Inicializar Flask
 app = Flask(__name__)
@@ -27,8 +27,14 @@ def from_json_filter(value):
         return json.loads(value)
     return value
 
-# Inicializar Base de Datos
-init_db()
+# Verificar versión del esquema (las migraciones se aplican con `python manage.py migrate`)
+check_schema_version()
+
+# Compartir una conexión del pool por request
+init_request_scope(app)
+
+# Invalidación de cachés entre workers (LISTEN/NOTIFY)
+init_cache_bus(app)
 
 # Servir archivos estáticos subidos
 @app.route('/uploads/<path:filename>')
@@ -46,6 +52,7 @@ from routes.proveedores import proveedores_bp
 from routes.reportes import reportes_bp
 from routes.compras import compras_bp
 from routes.produccion import produccion_bp
+from routes.busqueda import busqueda_bp
 
 app.register_blueprint(auth_bp)
 app.register_blueprint(dashboard_bp)
@@ -56,6 +63,7 @@ app.register_blueprint(proveedores_bp)
 app.register_blueprint(reportes_bp)
 app.register_blueprint(compras_bp)
 app.register_blueprint(produccion_bp)
+app.register_blueprint(busqueda_bp)
 
 from flask import request, redirect, url_for, session
 
@@ -1,9 +1,24 @@
+import base64
+import copy
+import csv
+import hashlib
+import importlib.util
 import json
 import os
+import re
+import select
+import tempfile
+import threading
+import time
+from collections import deque
+import numpy as np
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-from datetime import datetime
-from typing import Any, Dict
+import psycopg2.pool
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict
+from flask import g, has_request_context
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -506,495 +521,455 @@ DEFAULT_DATA: Dict[str, Any] = {
 }
 
 
-def get_connection():
-    return psycopg2.connect(
-        host=os.environ.get("DB_HOST", "localhost"),
-        port=os.environ.get("DB_PORT", "5432"),
-        dbname=os.environ.get("DB_NAME", "postgres"),
-        user=os.environ.get("DB_USER", "postgres"),
-        password=os.environ.get("DB_PASSWORD", "postgres"),
-        cursor_factory=psycopg2.extras.RealDictCursor
+# ==========================================
+# POOL DE CONEXIONES
+# ==========================================
+
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN", "1"))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))
+POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", "30"))
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Conexión psycopg2 que vuelve al pool al salir del bloque `with`.
+
+    Los bloques `with` anidados sobre la misma conexión comparten una única
+    transacción: sólo el bloque más externo hace commit/rollback y los
+    `conn.commit()` internos se difieren hasta ese punto.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.depth = 0
+        self.request_scoped = False
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth > 0:
+            return False
+        try:
+            if not self.closed:
+                if exc_type is None:
+                    super().commit()
+                else:
+                    self.rollback()
+        finally:
+            if not self.request_scoped:
+                _get_pool().release(self)
+        return False
+
+    def commit(self):
+        if self.depth > 1:
+            return
+        super().commit()
+
+
+def _connection_params() -> dict:
+    return {
+        "host": os.environ.get("DB_HOST", "localhost"),
+        "port": os.environ.get("DB_PORT", "5432"),
+        "dbname": os.environ.get("DB_NAME", "postgres"),
+        "user": os.environ.get("DB_USER", "postgres"),
+        "password": os.environ.get("DB_PASSWORD", "postgres"),
+    }
+
+
+class ConnectionPool:
+    """Pool de conexiones thread-safe con timeout, health check y vida máxima."""
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, max_lifetime: float, ping_after: float):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        for _ in range(self.min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self) -> PooledConnection:
+        return psycopg2.connect(
+            **_connection_params(),
+            cursor_factory=psycopg2.extras.RealDictCursor,
+            connection_factory=PooledConnection,
+        )
+
+    def _expired(self, conn: PooledConnection) -> bool:
+        return bool(self.max_lifetime) and time.monotonic() - conn.created_at > self.max_lifetime
+
+    def _healthy(self, conn: PooledConnection) -> bool:
+        if conn.closed or self._expired(conn):
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - conn.last_used_at < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn: PooledConnection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise psycopg2.pool.PoolError(
+                            f"No hay conexiones disponibles en el pool (máximo {self.max_size}) tras {self.timeout}s."
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            # El health check (posible SELECT 1) se hace fuera del lock
+            if self._healthy(conn):
+                conn.depth = 0
+                return conn
+            self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def release(self, conn: PooledConnection) -> None:
+        if os.getpid() != self.pid:
+            return
+        conn.depth = 0
+        conn.request_scoped = False
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+        with self._cond:
+            if conn.closed or self._expired(conn):
+                self._discard(conn)
+                self._size -= 1
+            else:
+                conn.last_used_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def close_all(self) -> None:
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+                self._size -= 1
+            self._cond.notify_all()
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+_request_scope_enabled = False
+
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    # Tras un fork (p.ej. workers de gunicorn) cada proceso crea su propio pool.
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(
+                    POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT, POOL_MAX_LIFETIME, POOL_PING_AFTER
+                )
+    return _pool
+
+
+def get_connection() -> PooledConnection:
+    """Entrega una conexión del pool.
+
+    Dentro de una request de Flask (si `init_request_scope` está activo) todas
+    las llamadas comparten la misma conexión, que se devuelve al pool al
+    terminar la request.
+    """
+    if _request_scope_enabled and has_request_context():
+        conn = g.get("_db_conn")
+        if conn is None or conn.closed:
+            conn = _get_pool().acquire()
+            conn.request_scoped = True
+            g._db_conn = conn
+        return conn
+    return _get_pool().acquire()
+
+
+def release_request_connection(exc=None) -> None:
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        _get_pool().release(conn)
+
+
+def init_request_scope(app) -> None:
+    """Activa el modo de conexión compartida por request para la app Flask."""
+    global _request_scope_enabled
+    _request_scope_enabled = os.environ.get("DB_REQUEST_SCOPE", "1") != "0"
+    app.teardown_appcontext(release_request_connection)
+
+
+# ==========================================
+# INVALIDACIÓN DE CACHÉS ENTRE WORKERS
+# ==========================================
+# Cada caché en memoria registra una función que descarta sus entradas. Quien escribe
+# llama a publish_cache_invalidation() dentro de su transacción: se invalida el proceso
+# local y se emite un NOTIFY que, al confirmarse la transacción, reciben todos los
+# workers (incluido el propio, lo que cubre lecturas concurrentes previas al commit).
+# Si el listener pierde la conexión, mientras reintenta vacía todas las cachés cada
+# CACHE_BUS_POLL_INTERVAL segundos y una vez más al reconectarse.
+
+CACHE_BUS_CHANNEL = "cache_invalidation"
+CACHE_BUS_POLL_INTERVAL = float(os.getenv("CACHE_BUS_POLL_INTERVAL", "5"))
+_cache_invalidators: dict[str, Callable[[str | None], None]] = {}
+_cache_listener_pid = None
+_cache_listener_lock = threading.Lock()
+
+
+def register_cache_invalidator(name: str, evict: Callable[[str | None], None]) -> None:
+    """Registra la función que descarta entradas de la caché `name` (key None = todas)."""
+    _cache_invalidators[name] = evict
+
+
+def _evict_cache(name: str, key: str | None = None) -> None:
+    evict = _cache_invalidators.get(name)
+    if evict is not None:
+        evict(key)
+
+
+def _evict_all_caches() -> None:
+    for evict in list(_cache_invalidators.values()):
+        evict(None)
+
+
+def publish_cache_invalidation(cur, name: str, key: str | None = None) -> None:
+    """Invalida la caché en este proceso y avisa a los demás workers al confirmar la transacción de `cur`."""
+    _evict_cache(name, key)
+    cur.execute(
+        "SELECT pg_notify(%s, %s)",
+        (CACHE_BUS_CHANNEL, json.dumps({"cache": name, "key": key}, ensure_ascii=False)),
     )
 
 
-def init_db() -> None:
+def _handle_cache_notification(payload: str) -> None:
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        _evict_all_caches()
+        return
+    _evict_cache(message.get("cache"), message.get("key"))
+
+
+def _cache_listener_loop() -> None:
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**_connection_params())
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CACHE_BUS_CHANNEL}")
+            # Pudieron perderse avisos mientras no había listener
+            _evict_all_caches()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    # Sin avisos: se valida que la conexión siga viva
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _handle_cache_notification(conn.notifies.pop(0).payload)
+        except Exception:
+            # Modo de sondeo: sin avisos confiables se vacían las cachés hasta reconectar
+            _evict_all_caches()
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
+        time.sleep(CACHE_BUS_POLL_INTERVAL)
+
+
+def start_cache_listener() -> None:
+    """Inicia (una vez por proceso) el thread que escucha las invalidaciones de caché."""
+    global _cache_listener_pid
+    if _cache_listener_pid == os.getpid():
+        return
+    with _cache_listener_lock:
+        if _cache_listener_pid == os.getpid():
+            return
+        threading.Thread(target=_cache_listener_loop, name="cache-listener", daemon=True).start()
+        _cache_listener_pid = os.getpid()
+
+
+def init_cache_bus(app) -> None:
+    """Arranca el listener de invalidaciones en la primera request de cada worker."""
+    if os.environ.get("CACHE_BUS", "1") == "0":
+        return
+    app.before_request(start_cache_listener)
+
+
+# ==========================================
+# MIGRACIONES DE ESQUEMA
+# ==========================================
+
+MIGRATIONS_DIR = os.path.join(BASE_DIR, "migrations")
+_MIGRATION_FILE_RE = re.compile(r"^(\d{4})_([\w-]+)\.(sql|py)$")
+
+
+def list_migrations() -> list[dict]:
+    """Lista los archivos de migración ordenados por versión."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _MIGRATION_FILE_RE.match(filename)
+        if not match:
+            continue
+        migrations.append({
+            "version": int(match.group(1)),
+            "name": match.group(2),
+            "kind": match.group(3),
+            "path": os.path.join(MIGRATIONS_DIR, filename),
+        })
+    return migrations
+
+
+def latest_schema_version() -> int:
+    migrations = list_migrations()
+    return migrations[-1]["version"] if migrations else 0
+
+
+def get_schema_version() -> int:
+    """Versión registrada en schema_version (0 si la tabla aún no existe)."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL as exists")
+            if not cur.fetchone()["exists"]:
+                return 0
+            cur.execute("SELECT COALESCE(MAX(version), 0) as version FROM schema_version")
+            return cur.fetchone()["version"]
+
+
+def _run_migration(cur, migration: dict) -> None:
+    if migration["kind"] == "sql":
+        with open(migration["path"], encoding="utf-8") as f:
+            cur.execute(f.read())
+        return
+    spec = importlib.util.spec_from_file_location(f"migration_{migration['version']:04d}", migration["path"])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.upgrade(cur)
+
+
+def apply_migrations() -> list[dict]:
+    """Aplica en orden las migraciones pendientes, cada una en su propia transacción."""
+    applied = []
     with get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS page_data (
-                    key TEXT PRIMARY KEY,
-                    json TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sales_entries (
-                    id SERIAL PRIMARY KEY,
-                    sku TEXT NOT NULL,
-                    product_name TEXT NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    unit_price DOUBLE PRECISION NOT NULL,
-                    total_price DOUBLE PRECISION NOT NULL,
-                    sale_date TEXT NOT NULL,
-                    delivery_date TEXT,
-                    payment_status TEXT NOT NULL,
-                    delivery_status TEXT NOT NULL,
-                    payment_method TEXT NOT NULL,
-                    customer_name TEXT NOT NULL,
-                    seller_name TEXT NOT NULL,
-                    notes TEXT,
-                    created_at TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS products (
-                    id SERIAL PRIMARY KEY,
-                    sku TEXT NOT NULL UNIQUE,
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
                     name TEXT NOT NULL,
-                    description TEXT,
-                    photo_url TEXT,
-                    barcode TEXT,
-                    internal_code TEXT,
-                    category TEXT,
-                    expiry_date TEXT,
-                    width_cm DOUBLE PRECISION,
-                    height_cm DOUBLE PRECISION,
-                    depth_cm DOUBLE PRECISION,
-                    weight_kg DOUBLE PRECISION,
-                    created_at TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute(
-                """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'products'
-                """
-            )
-            existing_columns = {row["column_name"] for row in cur.fetchall()}
-            missing_columns = {
-                "barcode": "TEXT",
-                "internal_code": "TEXT",
-                "category": "TEXT",
-                "expiry_date": "TEXT",
-                "product_type": "TEXT DEFAULT 'Final'",
-                "cost": "DOUBLE PRECISION DEFAULT 0.0",
-                "is_deleted": "BOOLEAN DEFAULT FALSE",
-            }
-            for column_name, column_type in missing_columns.items():
-                if column_name not in existing_columns:
-                    cur.execute(
-                        f"ALTER TABLE products ADD COLUMN {column_name} {column_type}"
-                    )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS roles (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL UNIQUE,
-                    description TEXT,
-                    permissions TEXT,
-                    created_at TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username TEXT NOT NULL UNIQUE,
-                    email TEXT NOT NULL UNIQUE,
-                    password TEXT NOT NULL,
-                    full_name TEXT NOT NULL,
-                    role_id INTEGER NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (role_id) REFERENCES roles(id)
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sales (
-                    id SERIAL PRIMARY KEY,
-                    sale_number TEXT NOT NULL UNIQUE,
-                    customer_name TEXT NOT NULL,
-                    customer_email TEXT,
-                    customer_initials TEXT,
-                    sale_date TEXT NOT NULL,
-                    sale_time TEXT NOT NULL,
-                    products_json TEXT NOT NULL,
-                    total_amount DOUBLE PRECISION NOT NULL,
-                    status TEXT NOT NULL,
-                    seller_name TEXT NOT NULL,
-                    seller_initials TEXT,
-                    payment_method TEXT,
-                    payment_status TEXT,
-                    delivery_status TEXT,
-                    notes TEXT,
-                    created_at TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sale_payments (
-                    id SERIAL PRIMARY KEY,
-                    sale_id INTEGER NOT NULL UNIQUE,
-                    invoice_number TEXT,
-                    invoice_amount DOUBLE PRECISION,
-                    invoice_due_date TEXT,
-                    invoice_file TEXT,
-                    payment_proof_file TEXT,
-                    payment_amount DOUBLE PRECISION,
-                    payment_date TEXT,
-                    seller_uploaded_at TEXT,
-                    payment_uploaded_at TEXT,
-                    accounting_approved INTEGER DEFAULT 0,
-                    accounting_approved_by TEXT,
-                    accounting_approved_at TEXT,
-                    accounting_comment TEXT,
-                    status TEXT NOT NULL DEFAULT 'Factura pendiente',
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL,
-                    FOREIGN KEY (sale_id) REFERENCES sales(id)
-                )
-                """
-            )
-            cur.execute(
-                """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'sale_payments'
-                """
-            )
-            existing_payment_columns = {row["column_name"] for row in cur.fetchall()}
-            payment_missing_columns = {
-                "invoice_number": "TEXT",
-                "accounting_comment": "TEXT",
-                "invoice_due_date": "TEXT",
-                "payment_date": "TEXT",
-                "invoice_amount": "DOUBLE PRECISION",
-                "payment_amount": "DOUBLE PRECISION",
-            }
-            for column_name, column_type in payment_missing_columns.items():
-                if column_name not in existing_payment_columns:
-                    cur.execute(
-                        f"ALTER TABLE sale_payments ADD COLUMN {column_name} {column_type}"
-                    )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sale_payment_items (
-                    id SERIAL PRIMARY KEY,
-                    sale_id INTEGER NOT NULL,
-                    payment_amount DOUBLE PRECISION NOT NULL,
-                    payment_date TEXT,
-                    payment_proof_file TEXT,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (sale_id) REFERENCES sales(id)
+                    applied_at TEXT NOT NULL
                 )
                 """
             )
-            cur.execute("SELECT COUNT(*) as count FROM sale_payment_items")
-            if cur.fetchone()["count"] == 0:
+        conn.commit()
+
+        for migration in list_migrations():
+            with conn.cursor() as cur:
+                # Evita que dos despliegues simultáneos apliquen la misma migración
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+                cur.execute("SELECT 1 FROM schema_version WHERE version = %s", (migration["version"],))
+                if cur.fetchone():
+                    conn.rollback()
+                    continue
+                _run_migration(cur, migration)
                 cur.execute(
-                    "SELECT sale_id, payment_amount, payment_date, payment_proof_file, created_at FROM sale_payments WHERE payment_amount IS NOT NULL AND payment_amount > 0"
-                )
-                for row in cur.fetchall():
-                    cur.execute(
-                        "INSERT INTO sale_payment_items (sale_id, payment_amount, payment_date, payment_proof_file, created_at) VALUES (%s, %s, %s, %s, %s)",
-                        (row["sale_id"], row["payment_amount"], row["payment_date"], row["payment_proof_file"], row["created_at"]),
-                    )
-            cur.execute(
-                """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'sale_payment_items'
-                """
-            )
-            existing_item_columns = {row["column_name"] for row in cur.fetchall()}
-            item_missing_columns = {
-                "accounting_approved": "INTEGER DEFAULT 0",
-                "accounting_approved_by": "TEXT",
-                "accounting_approved_at": "TEXT",
-                "accounting_comment": "TEXT",
-            }
-            for col_name, col_type in item_missing_columns.items():
-                if col_name not in existing_item_columns:
-                    cur.execute(f"ALTER TABLE sale_payment_items ADD COLUMN {col_name} {col_type}")
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sales_status_history (
-                    id SERIAL PRIMARY KEY,
-                    sale_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    user_name TEXT NOT NULL,
-                    changed_at TEXT NOT NULL,
-                    comment TEXT,
-                    FOREIGN KEY (sale_id) REFERENCES sales(id) ON DELETE CASCADE
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sales_payment_history (
-                    id SERIAL PRIMARY KEY,
-                    sale_id INTEGER NOT NULL,
-                    action TEXT NOT NULL,
-                    user_name TEXT NOT NULL,
-                    changed_at TEXT NOT NULL,
-                    details TEXT,
-                    FOREIGN KEY (sale_id) REFERENCES sales(id) ON DELETE CASCADE
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS suppliers (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    website TEXT,
-                    created_at TEXT NOT NULL
-                )
-                """
-            )
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS rut TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS dv TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS razon_social TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS giro TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS direccion TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS comuna TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS ciudad TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS email TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS phone TEXT;")
-            cur.execute("ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS tipo_compra TEXT;")
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS supplier_contacts (
-                    id SERIAL PRIMARY KEY,
-                    supplier_id INTEGER NOT NULL,
-                    name TEXT NOT NULL,
-                    phone TEXT,
-                    email TEXT,
-                    position TEXT,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE CASCADE
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS product_suppliers (
-                    id SERIAL PRIMARY KEY,
-                    product_id INTEGER NOT NULL,
-                    supplier_id INTEGER NOT NULL,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
-                    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE CASCADE,
-                    UNIQUE(product_id, supplier_id)
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS purchase_orders (
-                    id SERIAL PRIMARY KEY,
-                    oc_number TEXT NOT NULL UNIQUE,
-                    supplier_id INTEGER NOT NULL,
-                    order_date TEXT NOT NULL,
-                    status TEXT NOT NULL, -- 'Borrador', 'Emitida', 'Parcialmente Recibida', 'Recibida', 'Facturada'
-                    total_amount DOUBLE PRECISION NOT NULL,
-                    notes TEXT,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS purchase_order_items (
-                    id SERIAL PRIMARY KEY,
-                    purchase_order_id INTEGER NOT NULL,
-                    product_id INTEGER NOT NULL,
-                    quantity_ordered INTEGER NOT NULL,
-                    quantity_received INTEGER DEFAULT 0,
-                    unit_price DOUBLE PRECISION NOT NULL,
-                    total_price DOUBLE PRECISION NOT NULL,
-                    FOREIGN KEY (purchase_order_id) REFERENCES purchase_orders(id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS inventory_entries (
-                    id SERIAL PRIMARY KEY,
-                    entry_date TEXT NOT NULL,
-                    order_number TEXT NOT NULL,
-                    purchase_order_id INTEGER,
-                    supplier_id INTEGER NOT NULL,
-                    warehouse TEXT NOT NULL,
-                    notes TEXT,
-                    total_amount DOUBLE PRECISION NOT NULL,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (purchase_order_id) REFERENCES purchase_orders(id) ON DELETE SET NULL,
-                    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS inventory_entry_items (
-                    id SERIAL PRIMARY KEY,
-                    inventory_entry_id INTEGER NOT NULL,
-                    product_id INTEGER NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    unit_price DOUBLE PRECISION NOT NULL,
-                    total DOUBLE PRECISION NOT NULL,
-                    FOREIGN KEY (inventory_entry_id) REFERENCES inventory_entries(id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE inventory_entries ALTER COLUMN supplier_id DROP NOT NULL;
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS created_by INTEGER REFERENCES users(id) ON DELETE SET NULL;
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS approved_by INTEGER REFERENCES users(id) ON DELETE SET NULL;
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS payment_method TEXT DEFAULT 'Efectivo';
-                """
-            )
-            cur.execute("DROP TABLE IF EXISTS product_margins;")
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS product_margins (
-                    product_sku TEXT PRIMARY KEY,
-                    base_margin DOUBLE PRECISION DEFAULT 20.0,
-                    category_margins JSONB DEFAULT '{}'::jsonb
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS production_orders (
-                    id SERIAL PRIMARY KEY,
-                    ot_number TEXT NOT NULL UNIQUE,
-                    final_product_id INTEGER NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    notes TEXT,
-                    created_at TEXT NOT NULL,
-                    approved_at TEXT,
-                    completed_at TEXT,
-                    FOREIGN KEY (final_product_id) REFERENCES products(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE production_orders ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS production_order_items (
-                    id SERIAL PRIMARY KEY,
-                    production_order_id INTEGER NOT NULL,
-                    input_product_id INTEGER NOT NULL,
-                    quantity_required DOUBLE PRECISION NOT NULL,
-                    FOREIGN KEY (production_order_id) REFERENCES production_orders(id) ON DELETE CASCADE,
-                    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS product_recipes (
-                    id SERIAL PRIMARY KEY,
-                    final_product_id INTEGER NOT NULL UNIQUE,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (final_product_id) REFERENCES products(id) ON DELETE CASCADE
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS product_recipe_items (
-                    id SERIAL PRIMARY KEY,
-                    recipe_id INTEGER NOT NULL,
-                    input_product_id INTEGER NOT NULL,
-                    quantity_required DOUBLE PRECISION NOT NULL,
-                    FOREIGN KEY (recipe_id) REFERENCES product_recipes(id) ON DELETE CASCADE,
-                    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
-                )
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS production_order_additional_items (
-                    id SERIAL PRIMARY KEY,
-                    production_order_id INTEGER NOT NULL,
-                    input_product_id INTEGER NOT NULL,
-                    quantity DOUBLE PRECISION NOT NULL,
-                    reason TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (production_order_id) REFERENCES production_orders(id) ON DELETE CASCADE,
-                    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                    (migration["version"], migration["name"], datetime.utcnow().isoformat(timespec='seconds')),
                 )
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE production_order_items ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
-                """
-            )
-            cur.execute(
-                """
-                ALTER TABLE production_order_additional_items ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
-                """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS clients (
-                    id SERIAL PRIMARY KEY,
-                    rut VARCHAR(20),
-                    dv VARCHAR(5),
-                    razon_social VARCHAR(255) NOT NULL,
-                    tipo_compra VARCHAR(100) DEFAULT 'Del Giro',
-                    direccion TEXT,
-                    comuna VARCHAR(100),
-                    ciudad VARCHAR(100),
-                    giro VARCHAR(255),
-                    contacto VARCHAR(255),
-                    rut_solicita VARCHAR(20),
-                    dv_solicita VARCHAR(5),
-                    email VARCHAR(255),
-                    phone VARCHAR(50),
-                    category_id VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                ALTER TABLE clients ALTER COLUMN category_id TYPE VARCHAR(50);
-                """
-            )
-        conn.commit()
+            conn.commit()
+            applied.append(migration)
+    refresh_schema_registry()
+    return applied
+
+
+_schema_columns: dict[str, set[str]] | None = None
+_schema_lock = threading.Lock()
+
+
+def refresh_schema_registry() -> None:
+    """Descarta las columnas cacheadas; se recargan en la próxima consulta."""
+    global _schema_columns
+    with _schema_lock:
+        _schema_columns = None
+
+
+def get_table_columns(table: str) -> set[str]:
+    """Columnas de una tabla, leídas de information_schema una sola vez por proceso."""
+    global _schema_columns
+    if _schema_columns is None:
+        with _schema_lock:
+            if _schema_columns is None:
+                columns: dict[str, set[str]] = {}
+                with get_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """
+                            SELECT table_name, column_name
+                            FROM information_schema.columns
+                            WHERE table_schema = current_schema()
+                            """
+                        )
+                        for row in cur.fetchall():
+                            columns.setdefault(row["table_name"], set()).add(row["column_name"])
+                _schema_columns = columns
+    return _schema_columns.get(table, set())
+
+
+def check_schema_version() -> None:
+    """Chequeo rápido al iniciar: sólo compara la versión registrada con la última migración."""
+    current = get_schema_version()
+    latest = latest_schema_version()
+    if current < latest:
+        raise RuntimeError(
+            f"El esquema de la base de datos está en la versión {current} y se requiere la {latest}. "
+            "Ejecute 'python manage.py migrate' antes de iniciar la aplicación."
+        )
+
 
+def init_db() -> None:
+    """Aplica las migraciones pendientes y siembra los datos por defecto."""
+    apply_migrations()
     seed_data_if_empty()
 
 
@@ -1002,7 +977,7 @@ def seed_data_if_empty() -> None:
     with get_connection() as conn:
         with conn.cursor() as cur:
             for key, value in DEFAULT_DATA.items():
-                if key != "default_roles":
+                if key not in ("default_roles", "inventory_items"):
                     cur.execute(
                         "INSERT INTO page_data (key, json) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING",
                         (key, json.dumps(value, ensure_ascii=False)),
@@ -1070,6 +1045,7 @@ def seed_data_if_empty() -> None:
                         ),
                     )
             
+            seeded_sales = []
             cur.execute("SELECT COUNT(*) as count FROM sales")
             sales_count = cur.fetchone()["count"]
             if sales_count == 0:
@@ -1171,6 +1147,7 @@ def seed_data_if_empty() -> None:
                             delivery_status, notes, created_at
                         ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                         ON CONFLICT (sale_number) DO NOTHING
+                        RETURNING id
                         """,
                         (
                             sale["sale_number"],
@@ -1191,6 +1168,9 @@ def seed_data_if_empty() -> None:
                             sale["created_at"],
                         ),
                     )
+                    inserted = cur.fetchone()
+                    if inserted:
+                        seeded_sales.append((inserted["id"], sale["products"]))
 
             # Sembrar productos si la tabla de productos está vacía
             cur.execute("SELECT COUNT(*) as count FROM products")
@@ -1245,44 +1225,110 @@ def seed_data_if_empty() -> None:
                         )
                     )
             
-            # Sembrar en inventory_items (page_data) si no existen
-            cur.execute("SELECT json FROM page_data WHERE key = 'inventory_items'")
-            row = cur.fetchone()
-            if row:
-                inv_items = json.loads(row["json"])
-                existing_codes = {item.get("code") for item in inv_items}
-                updated_inv = False
-                for ins in insumos:
-                    if ins["sku"] not in existing_codes:
-                        inv_items.append({
-                            "code": ins["sku"],
-                            "name": ins["name"],
-                            "desc": ins["desc"],
-                            "category": ins["category"],
-                            "stock": ins["stock"],
-                            "min_stock": ins["min_stock"],
-                            "price": ins["price"],
-                            "status": "Normal",
-                            "stock_percent": 100
-                        })
-                        updated_inv = True
-                if updated_inv:
-                    cur.execute(
-                        "UPDATE page_data SET json = %s WHERE key = 'inventory_items'",
-                        (json.dumps(inv_items, ensure_ascii=False),)
-                    )
+            # Sembrar saldos de inventario: los ítems por defecto si no hay ninguno y los insumos que falten
+            cur.execute("SELECT sku FROM stock_balances")
+            existing_skus = {row["sku"] for row in cur.fetchall()}
+            stock_seed = [] if existing_skus else [
+                {"sku": item["code"], "stock": item["stock"], "min_stock": item["min_stock"], "price": item["price"]}
+                for item in DEFAULT_DATA.get("inventory_items", [])
+            ]
+            stock_seed += [ins for ins in insumos if ins["sku"] not in existing_skus]
+            for item in stock_seed:
+                cur.execute(
+                    """
+                    INSERT INTO stock_balances (sku, quantity, min_stock, price, updated_at)
+                    VALUES (%s, 0, %s, %s, %s)
+                    ON CONFLICT (sku) DO NOTHING
+                    """,
+                    (item["sku"], item["min_stock"], item["price"], datetime.utcnow().isoformat(timespec='seconds'))
+                )
+            _post_inventory_movements(cur, [
+                {"sku": item["sku"], "quantity": item["stock"], "movement_type": "saldo_inicial", "notes": "Datos por defecto"}
+                for item in stock_seed
+            ])
+
+            # Líneas normalizadas de las ventas de ejemplo, una vez sembrados los productos. Las
+            # Completadas ya están descontadas del stock de ejemplo; las Pendientes reservan.
+            for sale_id, products in seeded_sales:
+                _sync_sale_items(cur, sale_id, products)
+            _mark_sales_already_deducted(
+                cur, [sale_id for sale_id, _ in seeded_sales], "de ejemplo (ya descontada del stock inicial)",
+                datetime.utcnow().isoformat(timespec='seconds'),
+            )
+            for sale_id, _ in seeded_sales:
+                _sync_sale_stock(cur, sale_id)
+
+            cur.execute("SELECT 1 FROM price_matrix LIMIT 1")
+            if not cur.fetchone():
+                _refresh_price_matrix(cur)
         conn.commit()
 
 
 
+# Caché de page_data: valores ya decodificados por proceso, con versión por clave y un TTL
+# corto como red de seguridad cuando hay varios workers. Dentro de una request, además,
+# cada clave se lee una sola vez (g._page_data_memo).
+PAGE_DATA_CACHE_TTL = float(os.getenv("PAGE_DATA_CACHE_TTL", "30"))
+_page_data_cache: dict[str, tuple[tuple[int, int], float, Any]] = {}
+_page_data_versions: dict[str, int] = {}
+_page_data_generation = 0
+_page_data_lock = threading.Lock()
+
+
+def _page_data_version(key: str) -> tuple[int, int]:
+    return (_page_data_generation, _page_data_versions.get(key, 0))
+
+
+def invalidate_page_data(key: str | None = None) -> None:
+    """Descarta del caché la clave indicada (o todas) en este proceso."""
+    global _page_data_generation
+    with _page_data_lock:
+        if key is None:
+            _page_data_generation += 1
+            _page_data_cache.clear()
+        else:
+            _page_data_versions[key] = _page_data_versions.get(key, 0) + 1
+            _page_data_cache.pop(key, None)
+    if has_request_context():
+        memo = g.get("_page_data_memo")
+        if memo is not None:
+            if key is None:
+                memo.clear()
+            else:
+                memo.pop(key, None)
+
+
 def get_page_data(key: str) -> Any:
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT json FROM page_data WHERE key = %s", (key,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            return json.loads(row["json"])
+    memo = g.setdefault("_page_data_memo", {}) if has_request_context() else None
+    if memo is not None and key in memo:
+        return copy.deepcopy(memo[key])
+
+    now = time.monotonic()
+    with _page_data_lock:
+        version = _page_data_version(key)
+        cached = _page_data_cache.get(key)
+    if cached and cached[0] == version and cached[1] > now:
+        value = cached[2]
+    else:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT json FROM page_data WHERE key = %s", (key,))
+                row = cur.fetchone()
+        value = json.loads(row["json"]) if row else None
+        if PAGE_DATA_CACHE_TTL > 0:
+            with _page_data_lock:
+                # Si hubo una escritura mientras se leía, no se guarda el valor viejo
+                if _page_data_version(key) == version:
+                    _page_data_cache[key] = (version, now + PAGE_DATA_CACHE_TTL, value)
+
+    # Las rutas modifican las listas/dicts que reciben: el caché y el memo guardan el valor
+    # original y cada llamada recibe su propia copia
+    if memo is not None:
+        memo[key] = value
+    return copy.deepcopy(value)
+
+
+register_cache_invalidator("page_data", invalidate_page_data)
 
 
 def set_page_data(key: str, value: Any) -> None:
@@ -1293,6 +1339,7 @@ def set_page_data(key: str, value: Any) -> None:
                 "ON CONFLICT(key) DO UPDATE SET json = EXCLUDED.json",
                 (key, json.dumps(value, ensure_ascii=False)),
             )
+            publish_cache_invalidation(cur, "page_data", key)
         conn.commit()
 
 
@@ -1305,7 +1352,7 @@ def list_sales_entries() -> list[dict]:
                        sale_date, delivery_date, payment_status, delivery_status,
                        payment_method, customer_name, seller_name, notes
                 FROM sales_entries
-                ORDER BY created_at::timestamp DESC, id DESC
+                ORDER BY created_ts DESC NULLS LAST, id DESC
                 """
             )
             return [dict(row) for row in cur.fetchall()]
@@ -1388,6 +1435,7 @@ def insert_product(product: dict) -> int:
                 ),
             )
             inserted_id = cur.fetchone()["id"]
+            _refresh_price_matrix(cur, [product["sku"]])
         conn.commit()
         return inserted_id
 
@@ -1411,6 +1459,8 @@ def get_product(product_id: int) -> dict:
 def update_product(product_id: int, product: dict) -> None:
     with get_connection() as conn:
         with conn.cursor() as cur:
+            cur.execute("SELECT sku FROM products WHERE id = %s", (product_id,))
+            previous = cur.fetchone()
             cur.execute(
                 """
                 UPDATE products SET
@@ -1438,13 +1488,17 @@ def update_product(product_id: int, product: dict) -> None:
                     product_id,
                 ),
             )
+            _refresh_price_matrix(cur, [product.get("sku"), previous["sku"] if previous else None])
         conn.commit()
 
 
 def delete_product(product_id: int) -> None:
     with get_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("UPDATE products SET is_deleted = TRUE WHERE id = %s", (product_id,))
+            cur.execute("UPDATE products SET is_deleted = TRUE WHERE id = %s RETURNING sku", (product_id,))
+            row = cur.fetchone()
+            if row:
+                _refresh_price_matrix(cur, [row["sku"]])
         conn.commit()
 
 # Funciones para Roles
@@ -1592,6 +1646,40 @@ def delete_user(user_id: int) -> None:
 
 # === Sales Functions ===
 
+def _sales_filter_sql(filters: dict = None, alias: str = "") -> tuple[str, list]:
+    """Condiciones WHERE de los listados de ventas; las fechas filtran por rango sobre sale_ts."""
+    where = ""
+    params = []
+    if filters:
+        if filters.get('status'):
+            where += f" AND {alias}status = %s"
+            params.append(filters['status'])
+        if filters.get('customer_name'):
+            where += f" AND {alias}customer_name ILIKE %s"
+            params.append(f"%{filters['customer_name']}%")
+        if filters.get('date_from'):
+            where += f" AND {alias}sale_ts >= %s::date"
+            params.append(filters['date_from'])
+        if filters.get('date_to'):
+            where += f" AND {alias}sale_ts < %s::date + 1"
+            params.append(filters['date_to'])
+        if filters.get('customer_exact'):
+            where += f" AND {alias}customer_name = %s"
+            params.append(filters['customer_exact'])
+        if filters.get('product'):
+            where += f" AND EXISTS (SELECT 1 FROM sale_items si_f WHERE si_f.sale_id = {alias or 'sales.'}id AND si_f.product_name = %s)"
+            params.append(filters['product'])
+        if filters.get('exclude_quotes'):
+            where += f" AND {alias}status <> 'Cotización' AND {alias}sale_number NOT LIKE 'COT-%%'"
+        if filters.get('payment_overdue'):
+            # Equivalente SQL del estado calculado "Retrasada": factura vencida y no pagada
+            where += (
+                f" AND COALESCE({alias}payment_status, '') <> 'Pagado'"
+                f" AND EXISTS (SELECT 1 FROM sale_payments sp_f WHERE sp_f.sale_id = {alias or 'sales.'}id"
+                " AND sp_f.invoice_due_on < CURRENT_DATE)"
+            )
+    return where, params
+
 def list_sales(filters: dict = None) -> list[dict]:
     with get_connection() as conn:
         with conn.cursor() as cur:
@@ -1605,23 +1693,10 @@ def list_sales(filters: dict = None) -> list[dict]:
                 LEFT JOIN sale_payments sp ON sp.sale_id = s.id
                 WHERE 1=1
             """
-            params = []
-            
-            if filters:
-                if filters.get('status'):
-                    query += " AND s.status = %s"
-                    params.append(filters['status'])
-                if filters.get('customer_name'):
-                    query += " AND s.customer_name ILIKE %s"
-                    params.append(f"%{filters['customer_name']}%")
-                if filters.get('date_from'):
-                    query += " AND s.sale_date >= %s"
-                    params.append(filters['date_from'])
-                if filters.get('date_to'):
-                    query += " AND s.sale_date <= %s"
-                    params.append(filters['date_to'])
+            where, params = _sales_filter_sql(filters, "s.")
+            query += where
             
-            query += " ORDER BY (s.sale_date || ' ' || s.sale_time)::timestamp DESC, s.id DESC"
+            query += " ORDER BY s.sale_ts DESC NULLS LAST, s.id DESC"
             
             cur.execute(query, tuple(params))
             rows = cur.fetchall()
@@ -1634,98 +1709,166 @@ def list_sales(filters: dict = None) -> list[dict]:
             return sales
 
 
-def count_sales(filters: dict = None) -> int:
+# Sobre este umbral count_sales(estimate=True) devuelve la estimación del planificador
+SALES_COUNT_ESTIMATE_THRESHOLD = int(os.getenv("SALES_COUNT_ESTIMATE_THRESHOLD", "10000"))
+
+
+def count_sales(filters: dict = None, estimate: bool = False) -> int:
+    where, params = _sales_filter_sql(filters)
     with get_connection() as conn:
         with conn.cursor() as cur:
-            query = "SELECT COUNT(*) as count FROM sales WHERE 1=1"
-            params = []
-            if filters:
-                if filters.get('status'):
-                    query += " AND status = %s"
-                    params.append(filters['status'])
-                if filters.get('customer_name'):
-                    query += " AND customer_name ILIKE %s"
-                    params.append(f"%{filters['customer_name']}%")
-                if filters.get('date_from'):
-                    query += " AND sale_date >= %s"
-                    params.append(filters['date_from'])
-                if filters.get('date_to'):
-                    query += " AND sale_date <= %s"
-                    params.append(filters['date_to'])
-            cur.execute(query, tuple(params))
+            if estimate:
+                # La estimación del plan es O(1); sólo se cuenta exacto si el resultado es chico
+                cur.execute("EXPLAIN (FORMAT JSON) SELECT 1 FROM sales WHERE 1=1" + where, tuple(params))
+                plan = cur.fetchone()["QUERY PLAN"]
+                estimated = int(plan[0]["Plan"]["Plan Rows"])
+                if estimated > SALES_COUNT_ESTIMATE_THRESHOLD:
+                    return estimated
+            cur.execute("SELECT COUNT(*) as count FROM sales WHERE 1=1" + where, tuple(params))
             return cur.fetchone()["count"]
 
 
-def list_sales_page(limit: int, offset: int, filters: dict = None) -> list[dict]:
+def encode_sales_cursor(sale: dict) -> str:
+    """Cursor opaco con la clave de orden (sale_ts, id) de una venta."""
+    sale_ts = sale.get("sale_ts")
+    payload = {"t": sale_ts.isoformat() if sale_ts else None, "i": sale["id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_sales_cursor(token: str) -> tuple:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        sale_ts = datetime.fromisoformat(payload["t"]) if payload["t"] else None
+        return sale_ts, int(payload["i"])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Cursor de paginación inválido")
+
+
+def _list_sales_keyset(columns: str, limit: int, cursor: str = None, filters: dict = None,
+                       backward: bool = False) -> dict:
+    """Página de ventas por búsqueda de clave (sale_ts DESC NULLS LAST, id DESC) en vez de OFFSET."""
+    where, params = _sales_filter_sql(filters)
+    after = decode_sales_cursor(cursor) if cursor else None
+    in_undated = bool(after and after[0] is None)
+
+    # Orden de lectura: ventas con fecha y luego sin fecha; hacia atrás se recorre al revés.
+    # Cada tramo es un rango del índice idx_sales_sale_ts, así que el costo no depende de la profundidad.
+    if not backward:
+        segments = []
+        if not in_undated:
+            cond = " AND (sale_ts, id) < (%s, %s)" if after else " AND sale_ts IS NOT NULL"
+            segments.append((cond, list(after) if after else [], "sale_ts DESC NULLS LAST, id DESC"))
+        cond = " AND sale_ts IS NULL AND id < %s" if in_undated else " AND sale_ts IS NULL"
+        segments.append((cond, [after[1]] if in_undated else [], "id DESC"))
+    else:
+        if not after:
+            return _list_sales_keyset(columns, limit, None, filters)
+        segments = []
+        if in_undated:
+            segments.append((" AND sale_ts IS NULL AND id > %s", [after[1]], "id ASC"))
+        cond = " AND sale_ts IS NOT NULL" if in_undated else " AND (sale_ts, id) > (%s, %s)"
+        segments.append((cond, [] if in_undated else list(after), "sale_ts ASC NULLS FIRST, id ASC"))
+
+    rows = []
     with get_connection() as conn:
         with conn.cursor() as cur:
-            query = """
-                SELECT id, sale_number, customer_name, customer_email, customer_initials,
-                       sale_date, sale_time, products_json, total_amount, status,
-                       seller_name, seller_initials, payment_method, payment_status,
-                       delivery_status, notes, created_at
-                FROM sales
-                WHERE 1=1
-            """
-            params = []
-            if filters:
-                if filters.get('status'):
-                    query += " AND status = %s"
-                    params.append(filters['status'])
-                if filters.get('customer_name'):
-                    query += " AND customer_name ILIKE %s"
-                    params.append(f"%{filters['customer_name']}%")
-                if filters.get('date_from'):
-                    query += " AND sale_date >= %s"
-                    params.append(filters['date_from'])
-                if filters.get('date_to'):
-                    query += " AND sale_date <= %s"
-                    params.append(filters['date_to'])
-            query += " ORDER BY (sale_date || ' ' || sale_time)::timestamp DESC, id DESC"
-            query += " LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-            cur.execute(query, tuple(params))
-            rows = cur.fetchall()
-            sales = []
-            for row in rows:
-                sale = dict(row)
-                sale['products'] = json.loads(sale['products_json'])
-                del sale['products_json']
-                sales.append(sale)
-            return sales
+            for cond, seek_params, order in segments:
+                remaining = limit + 1 - len(rows)
+                if remaining <= 0:
+                    break
+                cur.execute(
+                    f"SELECT {columns}, sale_ts FROM sales WHERE 1=1{where}{cond} ORDER BY {order} LIMIT %s",
+                    tuple(params + seek_params + [remaining]),
+                )
+                rows.extend(dict(row) for row in cur.fetchall())
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    has_next = has_more if not backward else True
+    has_prev = has_more if backward else after is not None
+    return {
+        "items": rows,
+        "next_cursor": encode_sales_cursor(rows[-1]) if rows and has_next else None,
+        "prev_cursor": encode_sales_cursor(rows[0]) if rows and has_prev else None,
+    }
+
+
+def list_sales_page(limit: int, cursor: str = None, filters: dict = None, backward: bool = False) -> dict:
+    page = _list_sales_keyset(
+        """id, sale_number, customer_name, customer_email, customer_initials,
+           sale_date, sale_time, products_json, total_amount, paid_total, balance_due, status,
+           seller_name, seller_initials, payment_method, payment_status,
+           delivery_status, notes, created_at""",
+        limit, cursor, filters, backward,
+    )
+    for sale in page["items"]:
+        sale['products'] = json.loads(sale['products_json'])
+        del sale['products_json']
+    return page
+
+
+def list_sales_page_light(limit: int, cursor: str = None, filters: dict = None, backward: bool = False) -> dict:
+    return _list_sales_keyset(
+        """id, sale_number, customer_name, customer_email, customer_initials,
+           sale_date, sale_time, total_amount, paid_total, balance_due, status,
+           seller_name, seller_initials, payment_method, payment_status,
+           delivery_status, notes, created_at""",
+        limit, cursor, filters, backward,
+    )
+
+
+# Opciones de los filtros de cliente/producto del listado de ventas, por tipo (ventas o cotizaciones)
+SALES_FILTER_OPTIONS_TTL = int(os.getenv("SALES_FILTER_OPTIONS_TTL", "300"))
+_sales_filter_options_cache: dict[bool, tuple[float, dict]] = {}
+_sales_filter_options_lock = threading.Lock()
+
 
+def invalidate_sales_filter_options(key: str | None = None) -> None:
+    with _sales_filter_options_lock:
+        _sales_filter_options_cache.clear()
 
-def list_sales_page_light(limit: int, offset: int, filters: dict = None) -> list[dict]:
+
+register_cache_invalidator("sales_filter_options", invalidate_sales_filter_options)
+
+
+def get_sales_filter_options(quotes: bool = False) -> dict:
+    """Clientes y productos distintos de las ventas (o cotizaciones), cacheados SALES_FILTER_OPTIONS_TTL segundos."""
+    now = time.monotonic()
+    with _sales_filter_options_lock:
+        cached = _sales_filter_options_cache.get(quotes)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    is_quote = "(status = 'Cotización' OR sale_number LIKE 'COT-%')"
+    kind = is_quote if quotes else f"NOT {is_quote}"
     with get_connection() as conn:
         with conn.cursor() as cur:
-            query = """
-                SELECT id, sale_number, customer_name, customer_email, customer_initials,
-                       sale_date, sale_time, total_amount, status,
-                       seller_name, seller_initials, payment_method, payment_status,
-                       delivery_status, notes, created_at
-                FROM sales
-                WHERE 1=1
-            """
-            params = []
-            if filters:
-                if filters.get('status'):
-                    query += " AND status = %s"
-                    params.append(filters['status'])
-                if filters.get('customer_name'):
-                    query += " AND customer_name ILIKE %s"
-                    params.append(f"%{filters['customer_name']}%")
-                if filters.get('date_from'):
-                    query += " AND sale_date >= %s"
-                    params.append(filters['date_from'])
-                if filters.get('date_to'):
-                    query += " AND sale_date <= %s"
-                    params.append(filters['date_to'])
-            query += " ORDER BY (sale_date || ' ' || sale_time)::timestamp DESC, id DESC"
-            query += " LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-            cur.execute(query, tuple(params))
-            rows = cur.fetchall()
-            return [dict(row) for row in rows]
+            cur.execute(
+                f"""
+                SELECT DISTINCT customer_name FROM sales
+                WHERE {kind} AND COALESCE(customer_name, '') <> ''
+                ORDER BY customer_name
+                """
+            )
+            clients = [row["customer_name"] for row in cur.fetchall()]
+            cur.execute(
+                f"""
+                SELECT DISTINCT si.product_name
+                FROM sale_items si
+                JOIN sales ON sales.id = si.sale_id
+                WHERE {kind}
+                ORDER BY si.product_name
+                """
+            )
+            products = [row["product_name"] for row in cur.fetchall()]
+
+    options = {"clients": clients, "products": products}
+    with _sales_filter_options_lock:
+        _sales_filter_options_cache[quotes] = (now + SALES_FILTER_OPTIONS_TTL, options)
+    return options
 
 
 def get_sale_payments_for_sales(sale_ids: list[int]) -> dict[int, dict]:
@@ -1748,6 +1891,50 @@ def get_sale_payments_for_sales(sale_ids: list[int]) -> dict[int, dict]:
             return {row["sale_id"]: dict(row) for row in rows}
 
 
+def get_status_history_for_sales(sale_ids: list[int]) -> dict[int, list]:
+    """Historial de estados de varias ventas en una consulta, del más reciente al más antiguo."""
+    history = {sale_id: [] for sale_id in sale_ids}
+    if not sale_ids:
+        return history
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT sale_id, status, user_name, changed_at, comment
+                FROM sales_status_history
+                WHERE sale_id = ANY(%s)
+                ORDER BY sale_id, id DESC
+                """,
+                (list(sale_ids),),
+            )
+            for row in cur.fetchall():
+                entry = dict(row)
+                history[entry.pop("sale_id")].append(entry)
+    return history
+
+
+def get_payment_history_for_sales(sale_ids: list[int]) -> dict[int, list]:
+    """Historial de pagos de varias ventas en una consulta, del más reciente al más antiguo."""
+    history = {sale_id: [] for sale_id in sale_ids}
+    if not sale_ids:
+        return history
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT sale_id, action, user_name, changed_at, details
+                FROM sales_payment_history
+                WHERE sale_id = ANY(%s)
+                ORDER BY sale_id, id DESC
+                """,
+                (list(sale_ids),),
+            )
+            for row in cur.fetchall():
+                entry = dict(row)
+                history[entry.pop("sale_id")].append(entry)
+    return history
+
+
 def get_sale(sale_id: int) -> dict | None:
     with get_connection() as conn:
         with conn.cursor() as cur:
@@ -1804,6 +1991,10 @@ def insert_sale(sale: dict) -> int:
                 ),
             )
             inserted_id = cur.fetchone()["id"]
+            _sync_sale_items(cur, inserted_id, sale["products"])
+            _sync_sale_stock(cur, inserted_id)
+            publish_cache_invalidation(cur, "sales_filter_options")
+            publish_cache_invalidation(cur, "income_report")
         conn.commit()
         return inserted_id
 
@@ -1838,13 +2029,20 @@ def update_sale(sale_id: int, sale: dict) -> None:
                     sale_id,
                 ),
             )
+            _sync_sale_items(cur, sale_id, sale.get("products", []))
+            _sync_sale_stock(cur, sale_id)
+            publish_cache_invalidation(cur, "sales_filter_options")
+            publish_cache_invalidation(cur, "income_report")
         conn.commit()
 
 
 def delete_sale(sale_id: int) -> None:
     with get_connection() as conn:
         with conn.cursor() as cur:
+            _sync_sale_stock(cur, sale_id, deleting=True)
             cur.execute("DELETE FROM sales WHERE id = %s", (sale_id,))
+            publish_cache_invalidation(cur, "sales_filter_options")
+            publish_cache_invalidation(cur, "income_report")
         conn.commit()
 
 
@@ -1880,153 +2078,207 @@ def get_sale_payment(sale_id: int) -> dict | None:
             return dict(row) if row else None
 
 
+_SALE_PAYMENT_UPSERT_FIELDS = (
+    "invoice_number",
+    "invoice_amount",
+    "invoice_due_date",
+    "invoice_file",
+    "payment_proof_file",
+    "payment_amount",
+    "payment_date",
+    "seller_uploaded_at",
+    "payment_uploaded_at",
+    "accounting_approved",
+    "accounting_approved_by",
+    "accounting_approved_at",
+    "accounting_comment",
+    "status",
+    "updated_at",
+)
+
+
 def upsert_sale_payment(sale_id: int, payment: dict) -> None:
+    now = datetime.utcnow().isoformat(timespec='seconds')
+    values = {
+        "invoice_number": payment.get("invoice_number"),
+        "invoice_amount": payment.get("invoice_amount"),
+        "invoice_due_date": payment.get("invoice_due_date"),
+        "invoice_file": payment.get("invoice_file"),
+        "payment_proof_file": payment.get("payment_proof_file"),
+        "payment_amount": payment.get("payment_amount"),
+        "payment_date": payment.get("payment_date"),
+        "seller_uploaded_at": payment.get("seller_uploaded_at"),
+        "payment_uploaded_at": payment.get("payment_uploaded_at"),
+        "accounting_approved": payment.get("accounting_approved", 0),
+        "accounting_approved_by": payment.get("accounting_approved_by"),
+        "accounting_approved_at": payment.get("accounting_approved_at"),
+        "accounting_comment": payment.get("accounting_comment"),
+        "status": payment.get("status", "Factura pendiente"),
+        "updated_at": payment.get("updated_at") or now,
+    }
+    payment_columns = get_table_columns("sale_payments")
+    fields = [f for f in _SALE_PAYMENT_UPSERT_FIELDS if f in payment_columns]
+    insert_cols = ["sale_id", "created_at"] + fields
+    updates = ", ".join(f"{f} = EXCLUDED.{f}" for f in fields)
     with get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'sale_payments'
-                """
+                f"""
+                INSERT INTO sale_payments ({", ".join(insert_cols)})
+                VALUES ({", ".join(["%s"] * len(insert_cols))})
+                ON CONFLICT (sale_id) DO UPDATE SET {updates}
+                """,
+                (sale_id, payment.get("created_at") or now, *(values[f] for f in fields)),
             )
-            payment_columns = {row["column_name"] for row in cur.fetchall()}
-            has_invoice_number = "invoice_number" in payment_columns
-            has_accounting_comment = "accounting_comment" in payment_columns
-            has_invoice_due_date = "invoice_due_date" in payment_columns
-            has_payment_date = "payment_date" in payment_columns
-            has_invoice_amount = "invoice_amount" in payment_columns
-            has_payment_amount = "payment_amount" in payment_columns
-            
+            publish_cache_invalidation(cur, "income_report")
+        conn.commit()
+
+
+# Pagos registrados por vendedores/digitadores que esperan validación de un Aprobador
+PAYMENT_APPROVAL_STATUS = "Pendiente Aprobación Pago"
+
+
+def list_pending_payment_approvals(limit: int = 500) -> dict:
+    """Cola de ventas con pago por aprobar (índice parcial idx_sales_pending_payment_approval)."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS total FROM sales WHERE payment_status = %s", (PAYMENT_APPROVAL_STATUS,))
+            total = cur.fetchone()["total"]
             cur.execute(
-                "SELECT id FROM sale_payments WHERE sale_id = %s",
-                (sale_id,),
+                """
+                SELECT s.id, s.sale_number, s.customer_name, s.sale_date, s.seller_name, s.status,
+                       s.total_amount, sp.invoice_number, sp.payment_date, sp.payment_proof_file,
+                       sp.payment_uploaded_at, sp.accounting_comment
+                FROM sales s
+                LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+                WHERE s.payment_status = %s
+                ORDER BY s.sale_ts, s.id
+                LIMIT %s
+                """,
+                (PAYMENT_APPROVAL_STATUS, min(max(1, int(limit)), 5000)),
             )
-            existing = cur.fetchone()
-            if existing:
-                if has_invoice_number:
-                    cur.execute(
-                        """
-                        UPDATE sale_payments
-                        SET invoice_number = %s, invoice_amount = %s, invoice_due_date = %s, invoice_file = %s, payment_proof_file = %s, payment_amount = %s, payment_date = %s, seller_uploaded_at = %s,
-                            payment_uploaded_at = %s, accounting_approved = %s, accounting_approved_by = %s,
-                            accounting_approved_at = %s, accounting_comment = %s, status = %s, updated_at = %s
-                        WHERE sale_id = %s
-                        """,
-                        (
-                            payment.get("invoice_number"),
-                            payment.get("invoice_amount"),
-                            payment.get("invoice_due_date"),
-                            payment.get("invoice_file"),
-                            payment.get("payment_proof_file"),
-                            payment.get("payment_amount"),
-                            payment.get("payment_date"),
-                            payment.get("seller_uploaded_at"),
-                            payment.get("payment_uploaded_at"),
-                            payment.get("accounting_approved", 0),
-                            payment.get("accounting_approved_by"),
-                            payment.get("accounting_approved_at"),
-                            payment.get("accounting_comment"),
-                            payment.get("status", "Factura pendiente"),
-                            payment.get("updated_at"),
-                            sale_id,
-                        ),
-                    )
-                else:
-                    cur.execute(
-                        """
-                        UPDATE sale_payments
-                        SET invoice_amount = %s, invoice_due_date = %s, invoice_file = %s, payment_proof_file = %s, payment_amount = %s, payment_date = %s, seller_uploaded_at = %s,
-                            payment_uploaded_at = %s, accounting_approved = %s, accounting_approved_by = %s,
-                            accounting_approved_at = %s, accounting_comment = %s, status = %s, updated_at = %s
-                        WHERE sale_id = %s
-                        """,
-                        (
-                            payment.get("invoice_amount"),
-                            payment.get("invoice_due_date"),
-                            payment.get("invoice_file"),
-                            payment.get("payment_proof_file"),
-                            payment.get("payment_amount"),
-                            payment.get("payment_date"),
-                            payment.get("seller_uploaded_at"),
-                            payment.get("payment_uploaded_at"),
-                            payment.get("accounting_approved", 0),
-                            payment.get("accounting_approved_by"),
-                            payment.get("accounting_approved_at"),
-                            payment.get("accounting_comment"),
-                            payment.get("status", "Factura pendiente"),
-                            payment.get("updated_at"),
-                            sale_id,
-                        ),
-                    )
-            else:
-                cur.execute(
-                    """
-                    INSERT INTO sale_payments (
-                        sale_id, invoice_file, payment_proof_file, seller_uploaded_at,
-                        payment_uploaded_at, accounting_approved, accounting_approved_by,
-                        accounting_approved_at, status, created_at, updated_at
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        sale_id,
-                        payment.get("invoice_file"),
-                        payment.get("payment_proof_file"),
-                        payment.get("seller_uploaded_at"),
-                        payment.get("payment_uploaded_at"),
-                        payment.get("accounting_approved", 0),
-                        payment.get("accounting_approved_by"),
-                        payment.get("accounting_approved_at"),
-                        payment.get("status", "Factura pendiente"),
-                        payment.get("created_at"),
-                        payment.get("updated_at"),
-                    ),
+            items = [dict(row) for row in cur.fetchall()]
+    return {"items": items, "total": total}
+
+
+def approve_sale_payments(sale_ids: list[int], user_name: str) -> list[int]:
+    """Aprueba en lote los pagos pendientes de las ventas indicadas.
+
+    Una sola sentencia marca las ventas como pagadas y completadas, aprueba sale_payments
+    y escribe ambos historiales; las ventas que no estaban pendientes de aprobación se
+    omiten. Devuelve los ids aprobados.
+    """
+    if not sale_ids:
+        return []
+    now_str = datetime.utcnow().isoformat()
+    changed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH target AS (
+                    SELECT id, status AS old_status FROM sales
+                    WHERE id IN (SELECT unnest(%(ids)s::int[])) AND payment_status = %(pending)s
+                    ORDER BY id
+                    FOR UPDATE
+                ),
+                approved AS (
+                    UPDATE sales s SET payment_status = 'Pagado', status = 'Completada'
+                    FROM target t
+                    WHERE s.id = t.id
+                    RETURNING s.id, s.total_amount, t.old_status
+                ),
+                payments AS (
+                    UPDATE sale_payments sp
+                    SET status = 'Pagado', accounting_approved = 1, accounting_approved_by = %(user)s,
+                        accounting_approved_at = %(now)s, payment_amount = a.total_amount, updated_at = %(now)s
+                    FROM approved a
+                    WHERE sp.sale_id = a.id
+                ),
+                status_history AS (
+                    INSERT INTO sales_status_history (sale_id, status, user_name, changed_at, comment)
+                    SELECT id, 'Completada', %(system_user)s, %(changed_at)s,
+                           'Estado cambiado a Completada tras aprobación de pago'
+                    FROM approved
+                ),
+                payment_history AS (
+                    INSERT INTO sales_payment_history (sale_id, action, user_name, changed_at, details)
+                    SELECT id, 'Pago Aprobado', %(user)s, %(changed_at)s, 'El pago fue validado y aprobado formalmente.'
+                    FROM approved
                 )
-                if has_invoice_number:
-                    cur.execute(
-                        "UPDATE sale_payments SET invoice_number = %s WHERE sale_id = %s",
-                        (payment.get("invoice_number"), sale_id),
-                    )
-                if has_invoice_amount:
-                    cur.execute(
-                        "UPDATE sale_payments SET invoice_amount = %s WHERE sale_id = %s",
-                        (payment.get("invoice_amount"), sale_id),
-                    )
-                if has_payment_amount:
-                    cur.execute(
-                        "UPDATE sale_payments SET payment_amount = %s WHERE sale_id = %s",
-                        (payment.get("payment_amount"), sale_id),
-                    )
-                if has_invoice_due_date:
-                    cur.execute(
-                        "UPDATE sale_payments SET invoice_due_date = %s WHERE sale_id = %s",
-                        (payment.get("invoice_due_date"), sale_id),
-                    )
-                if has_payment_date:
-                    cur.execute(
-                        "UPDATE sale_payments SET payment_date = %s WHERE sale_id = %s",
-                        (payment.get("payment_date"), sale_id),
-                    )
-                if has_accounting_comment:
-                    cur.execute(
-                        "UPDATE sale_payments SET accounting_comment = %s WHERE sale_id = %s",
-                        (payment.get("accounting_comment"), sale_id),
-                    )
+                SELECT id, old_status FROM approved ORDER BY id
+                """,
+                {
+                    "ids": list(sale_ids),
+                    "pending": PAYMENT_APPROVAL_STATUS,
+                    "user": user_name,
+                    "system_user": f"Sistema (Aprobación por {user_name})",
+                    "now": now_str,
+                    "changed_at": changed_at,
+                },
+            )
+            approved = cur.fetchall()
+            # Las ventas que pasan a Completada descuentan stock
+            for row in approved:
+                if row["old_status"] != "Completada":
+                    _sync_sale_stock(cur, row["id"])
+            if approved:
+                publish_cache_invalidation(cur, "income_report")
         conn.commit()
+    return [row["id"] for row in approved]
 
 
-def list_sale_payment_items(sale_id: int) -> list[dict]:
+def reject_sale_payments(sale_ids: list[int], user_name: str, comment: str = "") -> list[int]:
+    """Rechaza en lote los pagos pendientes: la venta vuelve a pago Pendiente y queda en el historial."""
+    if not sale_ids:
+        return []
+    comment = (comment or "").strip()
+    now_str = datetime.utcnow().isoformat()
     with get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'sale_payment_items'
-                """
+                WITH rejected AS (
+                    UPDATE sales SET payment_status = 'Pendiente'
+                    WHERE id IN (SELECT unnest(%(ids)s::int[])) AND payment_status = %(pending)s
+                    RETURNING id
+                ),
+                payments AS (
+                    UPDATE sale_payments sp
+                    SET status = 'Pendiente', accounting_approved = 0, accounting_approved_by = NULL,
+                        accounting_approved_at = NULL, payment_amount = 0, accounting_comment = %(comment)s,
+                        updated_at = %(now)s
+                    FROM rejected r
+                    WHERE sp.sale_id = r.id
+                ),
+                payment_history AS (
+                    INSERT INTO sales_payment_history (sale_id, action, user_name, changed_at, details)
+                    SELECT id, 'Pago Rechazado', %(user)s, %(changed_at)s, %(details)s
+                    FROM rejected
+                )
+                SELECT id FROM rejected ORDER BY id
+                """,
+                {
+                    "ids": list(sale_ids),
+                    "pending": PAYMENT_APPROVAL_STATUS,
+                    "user": user_name,
+                    "comment": comment or "Pago rechazado por Aprobador",
+                    "details": f"El pago fue rechazado: {comment}" if comment else "El pago fue rechazado.",
+                    "now": now_str,
+                    "changed_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                },
             )
-            cols = [r["column_name"] for r in cur.fetchall()]
-            has_approval = "accounting_approved" in cols
+            rejected = [row["id"] for row in cur.fetchall()]
+            if rejected:
+                publish_cache_invalidation(cur, "income_report")
+        conn.commit()
+    return rejected
+
+
+def list_sale_payment_items(sale_id: int) -> list[dict]:
+    has_approval = "accounting_approved" in get_table_columns("sale_payment_items")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
             if has_approval:
                 select_cols = "id, sale_id, payment_amount, payment_date, payment_proof_file, created_at, accounting_approved, accounting_approved_by, accounting_approved_at, accounting_comment"
             else:
@@ -2112,53 +2364,121 @@ def delete_sale_payment_item(item_id: int) -> None:
 
 
 def get_sale_payment_items_totals(sale_ids: list[int]) -> dict[int, float]:
+    """Pagado de cada venta, leído de sales.paid_total (lo mantienen los triggers de la migración 0013)."""
     if not sale_ids:
         return {}
-    placeholders = ",".join(["%s"] * len(sale_ids))
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, paid_total FROM sales WHERE id = ANY(%s)", (list(sale_ids),))
+            return {row["id"]: row["paid_total"] for row in cur.fetchall()}
+
+
+def get_client_balance(customer_name: str) -> dict:
+    """Ventas abiertas y saldo por cobrar de un cliente, desde client_balances."""
     with get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                f"""
-                SELECT sale_id, COALESCE(SUM(payment_amount), 0) as total_paid
-                FROM sale_payment_items
-                WHERE sale_id IN ({placeholders})
-                GROUP BY sale_id
-                """,
-                tuple(sale_ids),
+                "SELECT open_sales, balance_due FROM client_balances WHERE customer_name = %s",
+                (customer_name,),
             )
-            rows = cur.fetchall()
-            return {row["sale_id"]: row["total_paid"] for row in rows}
+            row = cur.fetchone()
+    if not row:
+        return {"open_sales": 0, "balance_due": 0.0}
+    return {"open_sales": row["open_sales"], "balance_due": float(row["balance_due"])}
 
 
-def get_sales_metrics() -> dict:
+def rebuild_sale_balances(check_only: bool = False) -> dict:
+    """Compara sales.paid_total y client_balances con el recálculo desde los pagos y, salvo check_only, los corrige.
+
+    Devuelve las ventas y los clientes con diferencias (valor almacenado vs recalculado).
+    """
     with get_connection() as conn:
         with conn.cursor() as cur:
-            today = datetime.now().strftime('%Y-%m-%d')
+            # Evita pagos y ventas nuevos mientras se compara
+            cur.execute("LOCK TABLE sales, sale_payments, sale_payment_items IN SHARE MODE")
             cur.execute(
-                "SELECT COALESCE(SUM(total_amount), 0) as total FROM sales WHERE sale_date = %s",
-                (today,)
+                """
+                SELECT s.id, s.sale_number, s.customer_name,
+                       s.paid_total AS stored_paid_total, t.paid_total AS expected_paid_total
+                FROM sales s
+                JOIN sales_paid_totals() t ON t.sale_id = s.id
+                WHERE ABS(s.paid_total - t.paid_total) > 0.005
+                ORDER BY s.id
+                """
             )
-            total_today = cur.fetchone()["total"]
-            
+            sales = [dict(row) for row in cur.fetchall()]
             cur.execute(
-                "SELECT COUNT(*) as count FROM sales WHERE status = 'Completada'"
+                """
+                WITH expected_sales AS (
+                    SELECT s.customer_name, s.status, s.payment_status,
+                           ROUND((COALESCE(s.total_amount, 0) - t.paid_total)::numeric, 2)::double precision AS balance_due
+                    FROM sales s
+                    JOIN sales_paid_totals() t ON t.sale_id = s.id
+                ),
+                expected AS (
+                    SELECT customer_name, COUNT(*) AS open_sales,
+                           ROUND(SUM(balance_due)::numeric, 2)::double precision AS balance_due
+                    FROM expected_sales
+                    WHERE customer_name IS NOT NULL
+                      AND sale_counts_in_client_balance(status, payment_status, balance_due)
+                    GROUP BY customer_name
+                )
+                SELECT COALESCE(e.customer_name, c.customer_name) AS customer_name,
+                       COALESCE(c.open_sales, 0) AS stored_open_sales,
+                       COALESCE(e.open_sales, 0) AS expected_open_sales,
+                       COALESCE(c.balance_due, 0) AS stored_balance_due,
+                       COALESCE(e.balance_due, 0) AS expected_balance_due
+                FROM expected e
+                FULL JOIN client_balances c ON c.customer_name = e.customer_name
+                WHERE COALESCE(c.open_sales, 0) <> COALESCE(e.open_sales, 0)
+                   OR ABS(COALESCE(c.balance_due, 0) - COALESCE(e.balance_due, 0)) > 0.005
+                ORDER BY 1
+                """
             )
-            total_completed = cur.fetchone()["count"]
-            
+            clients = [dict(row) for row in cur.fetchall()]
+
+            if not check_only:
+                if sales:
+                    cur.execute("SELECT refresh_sales_paid_total(%s)", ([sale["id"] for sale in sales],))
+                if sales or clients:
+                    cur.execute("SELECT rebuild_client_balances()")
+        conn.commit()
+    return {"sales": sales, "clients": clients}
+
+
+def rebuild_sales_rollups() -> None:
+    """Recalcula sales_daily_rollup y sales_customer_rollup desde sales."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT rebuild_sales_rollups()")
+        conn.commit()
+
+
+def get_sales_metrics() -> dict:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Resúmenes mantenidos por trigger: el costo no crece con el historial de ventas
+            today = datetime.now().strftime('%Y-%m-%d')
             cur.execute(
-                "SELECT COUNT(*) as count FROM sales WHERE status = 'Pendiente'"
+                """
+                SELECT COALESCE(SUM(total_amount) FILTER (WHERE day = %s::date), 0) AS total_today,
+                       COALESCE(SUM(sale_count) FILTER (WHERE status = 'Completada'), 0) AS total_completed,
+                       COALESCE(SUM(sale_count) FILTER (WHERE status = 'Pendiente'), 0) AS total_pending
+                FROM sales_daily_rollup
+                """,
+                (today,)
             )
-            total_pending = cur.fetchone()["count"]
-            
+            row = cur.fetchone()
+
             cur.execute(
-                "SELECT COUNT(DISTINCT customer_name) as count FROM sales"
+                "SELECT COUNT(*) as count FROM sales_customer_rollup WHERE sale_count > 0"
             )
             total_customers = cur.fetchone()["count"]
             
             return {
-                "ventas_hoy": round(float(total_today), 2),
-                "ventas_completadas": total_completed,
-                "ventas_pendientes": total_pending,
+                "ventas_hoy": round(float(row["total_today"]), 2),
+                "ventas_completadas": int(row["total_completed"]),
+                "ventas_pendientes": int(row["total_pending"]),
                 "clientes_activos": total_customers,
             }
 
@@ -2169,23 +2489,24 @@ def get_sales_chart_data(year: int = None, period: str = "6months") -> dict:
             if year:
                 cur.execute(
                     """
-                    SELECT TO_CHAR(sale_date::date, 'YYYY-MM') as month,
+                    SELECT TO_CHAR(date_trunc('month', day), 'YYYY-MM') as month,
                            SUM(total_amount) as total
-                    FROM sales
-                    WHERE TO_CHAR(sale_date::date, 'YYYY') = %s
+                    FROM sales_daily_rollup
+                    WHERE day >= make_date(%s, 1, 1) AND day < make_date(%s + 1, 1, 1)
                     GROUP BY month
                     ORDER BY month ASC
                     """,
-                    (str(year),)
+                    (int(year), int(year))
                 )
                 rows = cur.fetchall()
             else:
                 limit = 12 if period == "12months" else 6
                 cur.execute(
                     """
-                    SELECT TO_CHAR(sale_date::date, 'YYYY-MM') as month,
+                    SELECT TO_CHAR(date_trunc('month', day), 'YYYY-MM') as month,
                            SUM(total_amount) as total
-                    FROM sales
+                    FROM sales_daily_rollup
+                    WHERE day > '-infinity'::date
                     GROUP BY month
                     ORDER BY month DESC
                     LIMIT %s
@@ -2211,55 +2532,34 @@ def get_sales_chart_data(year: int = None, period: str = "6months") -> dict:
 def get_top_products(year: int = None, period: str = "year") -> dict:
     with get_connection() as conn:
         with conn.cursor() as cur:
+            where = "s.status = 'Completada'"
+            params = []
             if year:
-                cur.execute(
-                    """
-                    SELECT products_json
-                    FROM sales
-                    WHERE TO_CHAR(sale_date::date, 'YYYY') = %s AND status = 'Completada'
-                    """,
-                    (str(year),)
-                )
-                rows = cur.fetchall()
+                where += " AND s.sale_ts >= make_date(%s, 1, 1) AND s.sale_ts < make_date(%s + 1, 1, 1)"
+                params = [int(year), int(year)]
             elif period == "month":
-                current_month = datetime.now().strftime('%Y-%m')
-                cur.execute(
-                    """
-                    SELECT products_json
-                    FROM sales
-                    WHERE TO_CHAR(sale_date::date, 'YYYY-MM') = %s AND status = 'Completada'
-                    """,
-                    (current_month,)
-                )
-                rows = cur.fetchall()
-            else:
-                cur.execute(
-                    """
-                    SELECT products_json
-                    FROM sales
-                    WHERE status = 'Completada'
-                    """
-                )
-                rows = cur.fetchall()
-            
-            product_counts = {}
-            for row in rows:
-                products = json.loads(row['products_json'])
-                for product_str in products:
-                    product_name = product_str.split('(')[0].strip()
-                    try:
-                        quantity = int(product_str.split('(')[1].split(')')[0])
-                    except:
-                        quantity = 1
-                    
-                    product_counts[product_name] = product_counts.get(product_name, 0) + quantity
-            
-            sorted_products = sorted(product_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-            
-            labels = [p[0] for p in sorted_products]
-            data = [p[1] for p in sorted_products]
-            
-            return {"labels": labels, "data": data}
+                month_start = datetime.now().strftime('%Y-%m-01')
+                where += " AND s.sale_ts >= %s::date AND s.sale_ts < %s::date + INTERVAL '1 month'"
+                params = [month_start, month_start]
+            cur.execute(
+                f"""
+                SELECT si.product_name, SUM(si.quantity) AS quantity, COALESCE(SUM(si.subtotal), 0) AS revenue
+                FROM sale_items si
+                JOIN sales s ON s.id = si.sale_id
+                WHERE {where}
+                GROUP BY si.product_name
+                ORDER BY quantity DESC, si.product_name
+                LIMIT 5
+                """,
+                tuple(params),
+            )
+            rows = cur.fetchall()
+
+            labels = [row["product_name"] for row in rows]
+            data = [int(row["quantity"]) if float(row["quantity"]).is_integer() else row["quantity"] for row in rows]
+            revenue = [round(float(row["revenue"]), 2) for row in rows]
+
+            return {"labels": labels, "data": data, "revenue": revenue}
 
 
 def list_suppliers() -> list[dict]:
@@ -2758,6 +3058,22 @@ def register_inventory_entry(po_id: int, order_number: str, entry_date: str, war
                     (new_received, po_item["id"])
                 )
             
+            # Ingresar el stock recibido al libro de movimientos
+            cur.execute("SELECT id, sku FROM products WHERE id = ANY(%s)", ([item["product_id"] for item in items],))
+            sku_by_id = {row["id"]: row["sku"] for row in cur.fetchall()}
+            _post_inventory_movements(cur, [
+                {
+                    "sku": sku_by_id[item["product_id"]],
+                    "quantity": item["quantity"],
+                    "movement_type": "ingreso",
+                    "reference_type": "inventory_entry",
+                    "reference_id": entry_id,
+                    "unit_cost": item["unit_price"],
+                    "notes": f"Ingreso OC {order_number}",
+                }
+                for item in items if item["product_id"] in sku_by_id
+            ])
+
             # 3. Validar el nuevo estado de la OC
             cur.execute(
                 """
@@ -2781,15 +3097,727 @@ def register_inventory_entry(po_id: int, order_number: str, entry_date: str, war
             cur.execute("UPDATE purchase_orders SET status = %s WHERE id = %s", (new_status, po_id))
         conn.commit()
 
-def list_inventory_entries() -> list[dict]:
-    """Obtiene los ingresos de mercadería recientes"""
+# === Inventory Stock Functions ===
+
+def _post_inventory_movements(cur, movements: list[dict]) -> None:
+    """Inserta movimientos en el libro y suma cada SKU a stock_balances en la transacción de cur."""
+    movements = [m for m in movements if m.get("sku") and m.get("quantity")]
+    if not movements:
+        return
+    now_str = datetime.utcnow().isoformat(timespec='seconds')
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO inventory_movements (sku, quantity, movement_type, reference_type, reference_id, unit_cost, notes, created_at)
+        VALUES %s
+        """,
+        [
+            (m["sku"], m["quantity"], m["movement_type"], m.get("reference_type"), m.get("reference_id"),
+             m.get("unit_cost"), m.get("notes"), now_str)
+            for m in movements
+        ],
+    )
+    totals: dict[str, float] = {}
+    for m in movements:
+        totals[m["sku"]] = totals.get(m["sku"], 0.0) + m["quantity"]
+    # Orden fijo por SKU para que transacciones concurrentes bloqueen las filas en el mismo orden
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO stock_balances (sku, quantity, updated_at) VALUES %s
+        ON CONFLICT (sku) DO UPDATE
+        SET quantity = stock_balances.quantity + EXCLUDED.quantity, updated_at = EXCLUDED.updated_at
+        """,
+        [(sku, qty, now_str) for sku, qty in sorted(totals.items())],
+    )
+    _apply_product_costs(cur, movements, now_str)
+
+
+def _apply_cost_movement(state: dict, quantity: float, unit_cost: float | None) -> None:
+    """Aplica un movimiento al costo promedio móvil de un SKU.
+
+    Las entradas con costo se promedian con el saldo (o fijan el costo si no hay saldo
+    o aún no hay costo); las salidas y entradas sin costo mueven el saldo al costo vigente.
+    """
+    new_quantity = state["quantity"] + quantity
+    if quantity > 0 and unit_cost is not None:
+        if state["quantity"] <= 0 or state["avg_cost"] is None or new_quantity <= 0:
+            state["avg_cost"] = float(unit_cost)
+            state["total_value"] = new_quantity * float(unit_cost)
+        else:
+            state["total_value"] += quantity * float(unit_cost)
+            state["avg_cost"] = state["total_value"] / new_quantity
+    else:
+        state["total_value"] = new_quantity * (state["avg_cost"] or 0.0)
+    state["quantity"] = new_quantity
+
+
+def _apply_product_costs(cur, movements: list[dict], now_str: str) -> None:
+    """Actualiza product_cost con los movimientos y recalcula precios de los SKU cuyo costo cambió."""
+    skus = sorted({m["sku"] for m in movements})
+    cur.execute(
+        "SELECT sku, quantity, total_value, avg_cost FROM product_cost WHERE sku = ANY(%s) ORDER BY sku FOR UPDATE",
+        (skus,),
+    )
+    states = {row["sku"]: dict(row) for row in cur.fetchall()}
+    previous_costs = {sku: state["avg_cost"] for sku, state in states.items()}
+    for m in movements:
+        state = states.setdefault(m["sku"], {"sku": m["sku"], "quantity": 0.0, "total_value": 0.0, "avg_cost": None})
+        _apply_cost_movement(state, float(m["quantity"]), m.get("unit_cost"))
+
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO product_cost (sku, quantity, total_value, avg_cost, updated_at) VALUES %s
+        ON CONFLICT (sku) DO UPDATE
+        SET quantity = EXCLUDED.quantity, total_value = EXCLUDED.total_value,
+            avg_cost = EXCLUDED.avg_cost, updated_at = EXCLUDED.updated_at
+        """,
+        [(sku, states[sku]["quantity"], states[sku]["total_value"], states[sku]["avg_cost"], now_str) for sku in skus],
+    )
+    changed = [sku for sku in skus if states[sku]["avg_cost"] != previous_costs.get(sku)]
+    _refresh_price_matrix(cur, changed)
+
+
+def _replay_product_costs(cur) -> dict[str, dict]:
+    """Recalcula el costo promedio móvil de cada SKU recorriendo todo el libro de movimientos."""
+    states: dict[str, dict] = {}
+    cur.execute("SELECT sku, quantity, unit_cost FROM inventory_movements ORDER BY id")
+    for row in cur.fetchall():
+        state = states.setdefault(row["sku"], {"sku": row["sku"], "quantity": 0.0, "total_value": 0.0, "avg_cost": None})
+        _apply_cost_movement(state, float(row["quantity"]), row["unit_cost"])
+    return states
+
+
+def rebuild_product_cost(check_only: bool = False) -> list[dict]:
+    """Compara product_cost con el recálculo desde el libro y, salvo check_only, lo reemplaza.
+
+    Devuelve los SKU con diferencias (costo almacenado vs recalculado).
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Evita movimientos nuevos mientras se recorre el libro
+            cur.execute("LOCK TABLE inventory_movements IN SHARE MODE")
+            states = _replay_product_costs(cur)
+            cur.execute("SELECT sku, quantity, total_value, avg_cost FROM product_cost")
+            stored = {row["sku"]: row for row in cur.fetchall()}
+
+            differences = []
+            for sku in sorted(set(states) | set(stored)):
+                expected = states.get(sku) or {"quantity": 0.0, "avg_cost": None}
+                current = stored.get(sku) or {"quantity": 0.0, "avg_cost": None}
+                same_cost = (
+                    expected["avg_cost"] is None and current["avg_cost"] is None
+                ) or (
+                    expected["avg_cost"] is not None and current["avg_cost"] is not None
+                    and abs(expected["avg_cost"] - current["avg_cost"]) < 1e-6
+                )
+                if not same_cost or abs(expected["quantity"] - current["quantity"]) > 1e-6:
+                    differences.append({
+                        "sku": sku,
+                        "stored_avg_cost": current["avg_cost"],
+                        "expected_avg_cost": expected["avg_cost"],
+                        "stored_quantity": current["quantity"],
+                        "expected_quantity": expected["quantity"],
+                    })
+
+            if not check_only:
+                now_str = datetime.utcnow().isoformat(timespec='seconds')
+                cur.execute("DELETE FROM product_cost")
+                if states:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        "INSERT INTO product_cost (sku, quantity, total_value, avg_cost, updated_at) VALUES %s",
+                        [(sku, st["quantity"], st["total_value"], st["avg_cost"], now_str) for sku, st in states.items()],
+                    )
+                if differences:
+                    _refresh_price_matrix(cur, [d["sku"] for d in differences])
+        conn.commit()
+    return differences
+
+
+def ensure_stock_balance(sku: str, min_stock: int = 10, price: float = 0.0) -> None:
+    """Crea el saldo en cero de un SKU nuevo; no modifica uno existente."""
     with get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT ie.id, ie.entry_date as date, ie.order_number, ie.warehouse, ie.notes, ie.total_amount,
-                       s.name as supplier, po.oc_number,
-                       (SELECT COUNT(*) FROM inventory_entry_items WHERE inventory_entry_id = ie.id) as items_count
+                INSERT INTO stock_balances (sku, quantity, min_stock, price, updated_at)
+                VALUES (%s, 0, %s, %s, %s)
+                ON CONFLICT (sku) DO NOTHING
+                """,
+                (sku, min_stock, price, datetime.utcnow().isoformat(timespec='seconds')),
+            )
+            if cur.rowcount:
+                _refresh_price_matrix(cur, [sku])
+        conn.commit()
+
+
+def update_stock_min(sku: str, min_stock: int) -> bool:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE stock_balances SET min_stock = %s, updated_at = %s WHERE sku = %s",
+                (min_stock, datetime.utcnow().isoformat(timespec='seconds'), sku),
+            )
+            updated = cur.rowcount > 0
+        conn.commit()
+        return updated
+
+
+def list_stock_balances() -> list[dict]:
+    """Ítems de inventario con stock disponible, reservado, total y estado ya calculados."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT sb.sku AS code, COALESCE(p.name, sb.sku) AS name, COALESCE(p.description, '') AS desc,
+                       COALESCE(p.category, 'Varios') AS category, sb.quantity AS stock,
+                       sb.reserved, sb.quantity + sb.reserved AS total_stock,
+                       sb.min_stock, sb.price,
+                       CASE WHEN sb.quantity + sb.reserved <= sb.min_stock THEN 'Stock Bajo' ELSE 'Normal' END AS status,
+                       LEAST(100, trunc((sb.quantity + sb.reserved) / GREATEST(1, sb.quantity + 100) * 100))::int AS stock_percent
+                FROM stock_balances sb
+                LEFT JOIN products p ON p.sku = sb.sku
+                ORDER BY sb.sku
+                """
+            )
+            return [dict(row) for row in cur.fetchall()]
+
+
+def get_stock_map(skus: list[str] = None) -> dict[str, float]:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            if skus is None:
+                cur.execute("SELECT sku, quantity FROM stock_balances")
+            else:
+                cur.execute("SELECT sku, quantity FROM stock_balances WHERE sku = ANY(%s)", (list(skus),))
+            return {row["sku"]: row["quantity"] for row in cur.fetchall()}
+
+
+# === Price Matrix Functions ===
+# Precios por producto y categoría de cliente materializados en price_matrix
+# (category_id '' = precio base). Se recalculan sólo los SKU afectados cuando cambia
+# su costo promedio o sus márgenes, y completos al cambiar price_list_config.
+
+DEFAULT_PRICE_LIST_CONFIG = {
+    "base_margin": 20.0,
+    "categories": [
+        {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
+        {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
+        {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
+        {"id": "cat_3", "name": "Categoría D", "margin": 20.0},
+    ],
+}
+PRICE_MATRIX_TTL = int(os.getenv("PRICE_MATRIX_TTL", "300"))
+_price_matrix_cache: dict[str, tuple[float, dict]] = {}
+_price_matrix_lock = threading.Lock()
+
+
+def get_price_list_config() -> dict:
+    config = get_page_data("price_list_config")
+    if not config or "categories" not in config:
+        return copy.deepcopy(DEFAULT_PRICE_LIST_CONFIG)
+    return config
+
+
+def _load_price_list_config(cur) -> dict:
+    cur.execute("SELECT json FROM page_data WHERE key = 'price_list_config'")
+    row = cur.fetchone()
+    config = json.loads(row["json"]) if row else None
+    if not config or "categories" not in config:
+        return copy.deepcopy(DEFAULT_PRICE_LIST_CONFIG)
+    return config
+
+
+def _load_product_vpp(cur, product_ids: list[int] | None = None) -> dict[int, float]:
+    """Costo promedio móvil (product_cost) por producto, para los que ya tienen costo."""
+    where = "AND p.id = ANY(%s)" if product_ids is not None else ""
+    cur.execute(
+        f"""
+        SELECT p.id, pc.avg_cost
+        FROM product_cost pc
+        JOIN products p ON p.sku = pc.sku
+        WHERE pc.avg_cost IS NOT NULL {where}
+        """,
+        (product_ids,) if product_ids is not None else None,
+    )
+    return {row["id"]: row["avg_cost"] for row in cur.fetchall()}
+
+
+def compute_price_matrix(costs, base_margins, category_margins, overrides) -> tuple:
+    """Precio base y por categoría de todos los productos en una sola pasada.
+
+    costs y base_margins: (n,); category_margins: (k,); overrides: (n, k) con NaN donde
+    el producto usa el margen de la categoría. Devuelve (price_base, margins, prices) sin
+    redondear: los precios se redondean a centavos con round() al materializarlos.
+    """
+    costs = np.asarray(costs, dtype=float)
+    base_margins = np.asarray(base_margins, dtype=float)
+    category_margins = np.asarray(category_margins, dtype=float)
+    overrides = np.asarray(overrides, dtype=float).reshape(len(costs), len(category_margins))
+
+    margins = np.where(np.isnan(overrides), category_margins[np.newaxis, :], overrides)
+    price_base = costs * (1 + base_margins / 100)
+    prices = price_base[:, np.newaxis] * (1 + margins / 100)
+    return price_base, margins, prices
+
+
+def _load_pricing_inputs(cur, skus: list[str] | None = None) -> tuple[list[dict], dict, dict, dict]:
+    """Productos, costo promedio, precio de catálogo y márgenes propios de los SKU indicados (o de todos)."""
+    sku_filter = "AND sku = ANY(%s)" if skus is not None else ""
+    sku_params = (skus,) if skus is not None else None
+
+    cur.execute(
+        f"""
+        SELECT id, sku, name, product_type FROM products
+        WHERE (is_deleted = FALSE OR is_deleted IS NULL) {sku_filter}
+        ORDER BY id DESC
+        """,
+        sku_params,
+    )
+    products = cur.fetchall()
+    vpp_map = _load_product_vpp(cur, [p["id"] for p in products] if skus is not None else None)
+
+    cur.execute(f"SELECT sku, price FROM stock_balances WHERE TRUE {sku_filter}", sku_params)
+    catalog_prices = {row["sku"]: row["price"] for row in cur.fetchall()}
+    cur.execute(
+        f"SELECT product_sku, base_margin, category_margins FROM product_margins WHERE TRUE {sku_filter.replace('sku', 'product_sku')}",
+        sku_params,
+    )
+    margins_map = {row["product_sku"]: row for row in cur.fetchall()}
+    return products, vpp_map, catalog_prices, margins_map
+
+
+def _price_arrays(products: list[dict], vpp_map: dict, catalog_prices: dict, margins_map: dict, config: dict) -> tuple:
+    """Arreglos de entrada de compute_price_matrix para los productos y la configuración dados."""
+    cat_ids = [cat["id"] for cat in config["categories"]]
+    costs = np.zeros(len(products))
+    base_margins = np.full(len(products), float(config["base_margin"]))
+    overrides = np.full((len(products), len(cat_ids)), np.nan)
+    for i, p in enumerate(products):
+        vpp = vpp_map.get(p["id"])
+        costs[i] = vpp if vpp is not None else (catalog_prices.get(p["sku"]) or 0.0)
+        m = margins_map.get(p["sku"])
+        if m:
+            base_margins[i] = m["base_margin"]
+            product_cat_margins = m["category_margins"] or {}
+            for j, cat_id in enumerate(cat_ids):
+                if product_cat_margins.get(cat_id) is not None:
+                    overrides[i, j] = float(product_cat_margins[cat_id])
+    category_margins = np.array([float(cat["margin"]) for cat in config["categories"]])
+    return costs, base_margins, category_margins, overrides
+
+
+def _compute_price_rows(products: list[dict], vpp_map: dict, catalog_prices: dict, margins_map: dict, config: dict) -> list[tuple]:
+    """Filas (sku, category_id, vpp, margin, price) de la matriz para los productos dados."""
+    costs, base_margins, category_margins, overrides = _price_arrays(products, vpp_map, catalog_prices, margins_map, config)
+    price_base, margins, prices = compute_price_matrix(costs, base_margins, category_margins, overrides)
+
+    cat_ids = [cat["id"] for cat in config["categories"]]
+    costs, base_margins, price_base = costs.tolist(), base_margins.tolist(), price_base.tolist()
+    margins, prices = margins.tolist(), prices.tolist()
+    rows = []
+    for i, p in enumerate(products):
+        rows.append((p["sku"], "", costs[i], base_margins[i], round(price_base[i], 2)))
+        rows.extend(
+            (p["sku"], cat_id, costs[i], margins[i][j], round(prices[i][j], 2))
+            for j, cat_id in enumerate(cat_ids)
+        )
+    return rows
+
+
+def _refresh_price_matrix(cur, skus: list[str] | None = None) -> None:
+    """Recalcula las filas de price_matrix de los SKU indicados (o de todos)."""
+    if skus is not None:
+        skus = sorted({sku for sku in skus if sku})
+        if not skus:
+            return
+
+    products, vpp_map, catalog_prices, margins_map = _load_pricing_inputs(cur, skus)
+    rows = _compute_price_rows(products, vpp_map, catalog_prices, margins_map, _load_price_list_config(cur))
+    if skus is not None:
+        cur.execute("DELETE FROM price_matrix WHERE sku = ANY(%s)", (skus,))
+    else:
+        cur.execute("DELETE FROM price_matrix")
+    if rows:
+        now = datetime.utcnow().isoformat(timespec='seconds')
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO price_matrix (sku, category_id, vpp, margin, price, updated_at) VALUES %s",
+            [row + (now,) for row in rows],
+        )
+    publish_cache_invalidation(cur, "price_matrix")
+
+
+def simulate_price_list(base_margin: float | None = None, category_margins: dict | None = None) -> dict:
+    """Recalcula todos los precios con márgenes propuestos, sin guardar nada.
+
+    Los márgenes propios de cada producto (product_margins) siguen teniendo prioridad.
+    """
+    config = get_price_list_config()
+    proposed = copy.deepcopy(config)
+    if base_margin is not None:
+        proposed["base_margin"] = float(base_margin)
+    for cat in proposed["categories"]:
+        if category_margins and cat["id"] in category_margins:
+            cat["margin"] = float(category_margins[cat["id"]])
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            products, vpp_map, catalog_prices, margins_map = _load_pricing_inputs(cur)
+    products = [p for p in products if p.get("product_type", "Final") != "Insumo"]
+
+    costs, current_base, current_cats, overrides = _price_arrays(products, vpp_map, catalog_prices, margins_map, config)
+    _, proposed_base, proposed_cats, _ = _price_arrays(products, vpp_map, catalog_prices, margins_map, proposed)
+    current_price_base, _, current_prices = compute_price_matrix(costs, current_base, current_cats, overrides)
+    proposed_price_base, proposed_margins, proposed_prices = compute_price_matrix(costs, proposed_base, proposed_cats, overrides)
+
+    priced = current_price_base > 0
+    avg_change = (
+        float(np.mean((proposed_price_base[priced] - current_price_base[priced]) / current_price_base[priced]) * 100)
+        if priced.any() else 0.0
+    )
+
+    cat_ids = [cat["id"] for cat in proposed["categories"]]
+    current_price_base, proposed_price_base = current_price_base.tolist(), proposed_price_base.tolist()
+    current_prices, proposed_prices = current_prices.tolist(), proposed_prices.tolist()
+    results = []
+    for i, p in enumerate(products):
+        results.append({
+            "sku": p["sku"],
+            "name": p["name"],
+            "vpp": float(costs[i]),
+            "base_margin": float(proposed_base[i]),
+            "price_base": {"current": round(current_price_base[i], 2), "proposed": round(proposed_price_base[i], 2)},
+            "categories": [
+                {
+                    "id": cat_id,
+                    "margin": float(proposed_margins[i, j]),
+                    "current": round(current_prices[i][j], 2),
+                    "proposed": round(proposed_prices[i][j], 2),
+                }
+                for j, cat_id in enumerate(cat_ids)
+            ],
+        })
+
+    return {
+        "config": proposed,
+        "summary": {"products": len(results), "avg_change_percent": round(avg_change, 2)},
+        "products": results,
+    }
+
+
+def refresh_price_matrix(skus: list[str] | None = None) -> None:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            _refresh_price_matrix(cur, skus)
+        conn.commit()
+
+
+def invalidate_price_matrix(key: str | None = None) -> None:
+    with _price_matrix_lock:
+        _price_matrix_cache.clear()
+
+
+register_cache_invalidator("price_matrix", invalidate_price_matrix)
+
+
+def get_price_matrix() -> dict[str, dict]:
+    """Precios por SKU: vpp, base_margin, price_base y categories {category_id: {margin, price}}."""
+    now = time.monotonic()
+    with _price_matrix_lock:
+        cached = _price_matrix_cache.get("all")
+        if cached and cached[0] > now:
+            return cached[1]
+
+    matrix = {}
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT sku, category_id, vpp, margin, price FROM price_matrix")
+            for row in cur.fetchall():
+                entry = matrix.setdefault(row["sku"], {"vpp": row["vpp"], "categories": {}})
+                if row["category_id"] == "":
+                    entry["base_margin"] = row["margin"]
+                    entry["price_base"] = row["price"]
+                else:
+                    entry["categories"][row["category_id"]] = {"margin": row["margin"], "price": row["price"]}
+
+    with _price_matrix_lock:
+        _price_matrix_cache["all"] = (now + PRICE_MATRIX_TTL, matrix)
+    return matrix
+
+
+def save_price_list_config(config: dict) -> None:
+    """Guarda price_list_config y recalcula la matriz completa en la misma transacción."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO page_data (key, json) VALUES (%s, %s) "
+                "ON CONFLICT(key) DO UPDATE SET json = EXCLUDED.json",
+                ("price_list_config", json.dumps(config, ensure_ascii=False)),
+            )
+            publish_cache_invalidation(cur, "page_data", "price_list_config")
+            _refresh_price_matrix(cur)
+        conn.commit()
+
+
+def save_product_margins(sku: str, base_margin: float, category_margins: dict) -> None:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO product_margins (product_sku, base_margin, category_margins)
+                VALUES (%s, %s, %s::jsonb)
+                ON CONFLICT (product_sku) DO UPDATE
+                SET base_margin = EXCLUDED.base_margin,
+                    category_margins = EXCLUDED.category_margins
+                """,
+                (sku, base_margin, json.dumps(category_margins))
+            )
+            _refresh_price_matrix(cur, [sku])
+        conn.commit()
+
+
+_SALE_PRODUCT_STR_RE = re.compile(r'^(.*?)\s*\((\d+)\)$')
+
+
+def _load_product_lookup(cur) -> tuple[dict, dict]:
+    cur.execute("SELECT id, sku, name FROM products")
+    rows = cur.fetchall()
+    id_to_sku = {row["id"]: row["sku"] for row in rows}
+    name_to_sku = {row["name"].strip().lower(): row["sku"] for row in rows}
+    return id_to_sku, name_to_sku
+
+
+def _match_product_sku(name: str, name_to_sku: dict) -> str | None:
+    """SKU por nombre exacto (en minúsculas) o, si no hay, por coincidencia parcial."""
+    if name in name_to_sku:
+        return name_to_sku[name]
+    for name_db, sku_db in name_to_sku.items():
+        if name_db in name or name in name_db:
+            return sku_db
+    return None
+
+
+def parse_sale_product_lines(products: list, id_to_sku: dict, name_to_sku: dict) -> list[dict]:
+    """Líneas de sale_items a partir de products_json, en formato dict o texto legado "Nombre (cantidad)"."""
+    lines = []
+    for p in products or []:
+        sku, unit_price, discount, subtotal = None, None, 0.0, None
+        if isinstance(p, dict):
+            name = (p.get('product_name') or p.get('name') or '').strip()
+            qty = float(p.get('quantity', 0) or 0)
+            p_id = p.get('product_id')
+            if p_id and p_id in id_to_sku:
+                sku = id_to_sku[p_id]
+            elif name:
+                sku = _match_product_sku(name.lower(), name_to_sku)
+            price = p.get('price', p.get('unit_price'))
+            unit_price = float(price) if price not in (None, '') else None
+            discount = float(p.get('discount') or 0.0)
+            if p.get('subtotal') not in (None, ''):
+                subtotal = float(p['subtotal'])
+            elif unit_price is not None:
+                subtotal = round(qty * unit_price * (1.0 - discount / 100.0), 2)
+        elif isinstance(p, str):
+            match = _SALE_PRODUCT_STR_RE.match(p.strip())
+            if match:
+                name, qty = match.group(1).strip(), float(match.group(2))
+            else:
+                name, qty = p.split('(')[0].strip(), 1.0
+            sku = _match_product_sku(name.lower(), name_to_sku) if name else None
+        else:
+            continue
+        if (name or sku) and qty > 0:
+            lines.append({
+                "sku": sku,
+                "product_name": name or sku,
+                "quantity": qty,
+                "unit_price": unit_price,
+                "discount": discount,
+                "subtotal": subtotal,
+            })
+    return lines
+
+
+def _sync_sale_items(cur, sale_id: int, products: list) -> None:
+    """Reescribe las líneas normalizadas de una venta desde su lista de productos."""
+    id_to_sku, name_to_sku = _load_product_lookup(cur)
+    sku_to_id = {sku: product_id for product_id, sku in id_to_sku.items()}
+    cur.execute("DELETE FROM sale_items WHERE sale_id = %s", (sale_id,))
+    lines = parse_sale_product_lines(products, id_to_sku, name_to_sku)
+    if lines:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO sale_items (sale_id, line_no, product_id, sku, product_name, quantity, unit_price, discount, subtotal)
+            VALUES %s
+            """,
+            [
+                (sale_id, line_no, sku_to_id.get(line["sku"]), line["sku"], line["product_name"], line["quantity"],
+                 line["unit_price"], line["discount"], line["subtotal"])
+                for line_no, line in enumerate(lines, start=1)
+            ],
+        )
+
+
+def _apply_stock_reservations(cur, reference_type: str, reference_id: int, desired: dict[str, float]) -> None:
+    """Deja las reservas de un documento en desired y suma la diferencia a stock_balances.reserved."""
+    cur.execute(
+        """
+        SELECT sku, quantity FROM stock_reservations
+        WHERE reference_type = %s AND reference_id = %s
+        FOR UPDATE
+        """,
+        (reference_type, reference_id),
+    )
+    current = {row["sku"]: row["quantity"] for row in cur.fetchall()}
+    deltas = {
+        sku: desired.get(sku, 0.0) - current.get(sku, 0.0)
+        for sku in set(desired) | set(current)
+    }
+    deltas = {sku: delta for sku, delta in deltas.items() if abs(delta) > 1e-9}
+    if not deltas:
+        return
+
+    removed = [sku for sku in current if sku not in desired]
+    if removed:
+        cur.execute(
+            "DELETE FROM stock_reservations WHERE reference_type = %s AND reference_id = %s AND sku = ANY(%s)",
+            (reference_type, reference_id, removed),
+        )
+    kept = [(reference_type, reference_id, sku, qty) for sku, qty in desired.items()]
+    if kept:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO stock_reservations (reference_type, reference_id, sku, quantity) VALUES %s
+            ON CONFLICT (reference_type, reference_id, sku) DO UPDATE SET quantity = EXCLUDED.quantity
+            """,
+            kept,
+        )
+    now_str = datetime.utcnow().isoformat(timespec='seconds')
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO stock_balances (sku, quantity, reserved, updated_at) VALUES %s
+        ON CONFLICT (sku) DO UPDATE
+        SET reserved = stock_balances.reserved + EXCLUDED.reserved, updated_at = EXCLUDED.updated_at
+        """,
+        [(sku, 0, delta, now_str) for sku, delta in sorted(deltas.items())],
+    )
+
+
+def _mark_sales_already_deducted(cur, sale_ids: list[int], note: str, now_str: str) -> None:
+    """Registra las ventas Completadas indicadas como ya descontadas del stock.
+
+    Por venta y SKU inserta la salida 'venta' (referencia sale) y un 'saldo_inicial' que la
+    compensa: el saldo no cambia y _sync_sale_stock ya no las vuelve a descontar.
+    """
+    if not sale_ids:
+        return
+    cur.execute(
+        """
+        INSERT INTO inventory_movements (sku, quantity, movement_type, reference_type, reference_id, notes, created_at)
+        SELECT m.sku, m.quantity, m.movement_type, m.reference_type, m.reference_id,
+               'Venta ' || t.sale_number || ' ' || %(note)s, %(now)s
+        FROM (
+            SELECT s.id AS sale_id, s.sale_number, si.sku, SUM(si.quantity) AS quantity
+            FROM unnest(%(ids)s::int[]) AS ids (id)
+            JOIN sales s ON s.id = ids.id
+            JOIN sale_items si ON si.sale_id = s.id
+            WHERE s.status = 'Completada' AND si.sku IS NOT NULL
+            GROUP BY s.id, s.sale_number, si.sku
+            HAVING SUM(si.quantity) <> 0
+        ) t
+        CROSS JOIN LATERAL (VALUES
+            (1, t.sku, t.quantity, 'saldo_inicial', NULL, NULL::integer),
+            (2, t.sku, -t.quantity, 'venta', 'sale', t.sale_id)
+        ) AS m (ord, sku, quantity, movement_type, reference_type, reference_id)
+        ORDER BY t.sale_id, t.sku, m.ord
+        """,
+        {"ids": list(sale_ids), "note": note, "now": now_str},
+    )
+
+
+def _sync_sale_stock(cur, sale_id: int, deleting: bool = False) -> None:
+    """Ajusta movimientos y reservas de una venta: reserva mientras está Pendiente y descuenta si está Completada."""
+    cur.execute("SELECT status FROM sales WHERE id = %s FOR UPDATE", (sale_id,))
+    sale = cur.fetchone()
+    lines: dict[str, float] = {}
+    if sale and not deleting and sale["status"] in ("Pendiente", "Completada"):
+        cur.execute(
+            """
+            SELECT sku, SUM(quantity) AS quantity FROM sale_items
+            WHERE sale_id = %s AND sku IS NOT NULL
+            GROUP BY sku
+            """,
+            (sale_id,),
+        )
+        lines = {row["sku"]: row["quantity"] for row in cur.fetchall()}
+    status = sale["status"] if sale and not deleting else None
+
+    _apply_stock_reservations(cur, "sale", sale_id, lines if status == "Pendiente" else {})
+
+    desired = {sku: -qty for sku, qty in lines.items()} if status == "Completada" else {}
+    cur.execute(
+        """
+        SELECT sku, SUM(quantity) AS quantity
+        FROM inventory_movements
+        WHERE reference_type = 'sale' AND reference_id = %s
+        GROUP BY sku
+        """,
+        (sale_id,),
+    )
+    posted = {row["sku"]: row["quantity"] for row in cur.fetchall()}
+
+    movements = []
+    for sku in sorted(set(desired) | set(posted)):
+        delta = desired.get(sku, 0.0) - posted.get(sku, 0.0)
+        if abs(delta) > 1e-9:
+            movements.append({
+                "sku": sku,
+                "quantity": delta,
+                "movement_type": "venta" if delta < 0 else "venta_reverso",
+                "reference_type": "sale",
+                "reference_id": sale_id,
+            })
+    _post_inventory_movements(cur, movements)
+
+
+def _sync_production_order_stock(cur, ot_id: int) -> None:
+    """Reserva los insumos (planificados y adicionales) de una OT mientras está Aprobada."""
+    cur.execute("SELECT id FROM production_orders WHERE id = %s FOR UPDATE", (ot_id,))
+    cur.execute(
+        """
+        SELECT p.sku, SUM(items.quantity) AS quantity
+        FROM production_orders po
+        JOIN (
+            SELECT production_order_id, input_product_id, quantity_required AS quantity FROM production_order_items
+            UNION ALL
+            SELECT production_order_id, input_product_id, quantity FROM production_order_additional_items
+        ) items ON items.production_order_id = po.id
+        JOIN products p ON p.id = items.input_product_id
+        WHERE po.id = %s AND po.status = 'Aprobada'
+        GROUP BY p.sku
+        """,
+        (ot_id,),
+    )
+    desired = {row["sku"]: row["quantity"] for row in cur.fetchall()}
+    _apply_stock_reservations(cur, "production_order", ot_id, desired)
+
+
+
+def list_inventory_entries() -> list[dict]:
+    """Obtiene los ingresos de mercadería recientes"""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT ie.id, ie.entry_date as date, ie.order_number, ie.warehouse, ie.notes, ie.total_amount,
+                       s.name as supplier, po.oc_number,
+                       (SELECT COUNT(*) FROM inventory_entry_items WHERE inventory_entry_id = ie.id) as items_count
                 FROM inventory_entries ie
                 JOIN suppliers s ON ie.supplier_id = s.id
                 LEFT JOIN purchase_orders po ON ie.purchase_order_id = po.id
@@ -2805,121 +3833,198 @@ def list_inventory_entries() -> list[dict]:
             return records
 
 
+# Reporte de Ingresos: las series mensuales y los totales se agregan en SQL y se cachean
+# por día (el estado "Retrasada" depende de la fecha) con INCOME_REPORT_TTL como tope;
+# el detalle se pagina aparte (get_income_report_detail).
+INCOME_REPORT_TTL = int(os.getenv("INCOME_REPORT_TTL", "300"))
+_income_report_cache: dict[str, tuple[float, dict]] = {}
+_income_report_lock = threading.Lock()
+
+_MONTH_NAMES = {
+    "01": "Enero", "02": "Febrero", "03": "Marzo", "04": "Abril",
+    "05": "Mayo", "06": "Junio", "07": "Julio", "08": "Agosto",
+    "09": "Septiembre", "10": "Octubre", "11": "Noviembre", "12": "Diciembre"
+}
+
+# Ventas vigentes con el monto y el mes en que cuentan: las pagadas por fecha de pago (o de
+# venta) y las pendientes por vencimiento de la factura (o fecha de venta)
+_INCOME_ROWS_SQL = """
+    WITH income AS (
+        SELECT s.id, s.sale_number, s.customer_name,
+               LEFT(COALESCE(s.sale_date, ''), 10) AS sale_date,
+               COALESCE(s.payment_status, 'Pendiente') = 'Pagado' AS is_paid,
+               COALESCE(NULLIF(sp.payment_amount, 0), s.total_amount, 0) AS paid_amount,
+               COALESCE(s.total_amount, 0) AS total_amount,
+               LEFT(COALESCE(sp.payment_date, ''), 10) AS payment_date,
+               CASE WHEN LEFT(COALESCE(sp.invoice_due_date, ''), 10) NOT IN ('', '-')
+                    THEN LEFT(sp.invoice_due_date, 10)
+                    ELSE LEFT(COALESCE(s.sale_date, ''), 10) END AS due_date
+        FROM sales s
+        LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+        WHERE s.status NOT IN ('Cancelada', 'Cancelado', 'Cotización')
+    ), classified AS (
+        SELECT income.*,
+               CASE WHEN is_paid THEN paid_amount ELSE total_amount END AS amount,
+               CASE
+                   WHEN is_paid AND LENGTH(payment_date) >= 7 THEN LEFT(payment_date, 7)
+                   WHEN is_paid AND LENGTH(sale_date) >= 7 THEN LEFT(sale_date, 7)
+                   WHEN NOT is_paid AND LENGTH(due_date) >= 7 THEN LEFT(due_date, 7)
+                   ELSE %(month)s
+               END AS month_key,
+               NOT is_paid AND due_date NOT IN ('', '-') AND due_date < %(today)s AS is_overdue
+        FROM income
+    )
+"""
+
+
+def _month_label(month_key: str, today_str: str) -> str:
+    y, m = month_key.split("-", 1) if "-" in month_key else (today_str[:4], today_str[5:7])
+    return f"{_MONTH_NAMES.get(m, m)} {y}"
+
+
+def invalidate_income_report(key: str | None = None) -> None:
+    with _income_report_lock:
+        _income_report_cache.clear()
+
+
+register_cache_invalidator("income_report", invalidate_income_report)
+
+
 def get_income_report_data() -> dict:
     """Calcula datos financieros de Ingresos: pagos históricos realizados y compromisos de cobros futuros."""
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    now = time.monotonic()
+    with _income_report_lock:
+        cached = _income_report_cache.get(today_str)
+        if cached and cached[0] > now:
+            return copy.deepcopy(cached[1])
+
     with get_connection() as conn:
         with conn.cursor() as cur:
-            query = """
-                SELECT s.id, s.sale_number, s.customer_name, s.sale_date, s.total_amount, s.status, s.payment_status,
-                       sp.invoice_due_date, sp.payment_date, sp.payment_amount
-                FROM sales s
-                LEFT JOIN sale_payments sp ON sp.sale_id = s.id
-                WHERE s.status NOT IN ('Cancelada', 'Cancelado', 'Cotización')
-                ORDER BY s.sale_date ASC
-            """
-            cur.execute(query)
-            sales = cur.fetchall()
+            cur.execute(
+                _INCOME_ROWS_SQL + """
+                SELECT month_key, is_paid, SUM(amount) AS amount, COUNT(*) AS count,
+                       COALESCE(SUM(amount) FILTER (WHERE is_overdue), 0) AS overdue_amount,
+                       COUNT(*) FILTER (WHERE is_overdue) AS overdue_count
+                FROM classified
+                GROUP BY month_key, is_paid
+                ORDER BY month_key
+                """,
+                {"today": today_str, "month": today_str[:7]},
+            )
+            groups = cur.fetchall()
 
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    
-    month_names = {
-        "01": "Enero", "02": "Febrero", "03": "Marzo", "04": "Abril",
-        "05": "Mayo", "06": "Junio", "07": "Julio", "08": "Agosto",
-        "09": "Septiembre", "10": "Octubre", "11": "Noviembre", "12": "Diciembre"
+    monthly_summary = {}
+    totals = {"historico": 0.0, "futuro": 0.0, "retrasado": 0.0}
+    counts = {"historicos": 0, "futuros": 0, "retrasados": 0}
+    for group in groups:
+        month = monthly_summary.setdefault(group["month_key"], {
+            "month_key": group["month_key"],
+            "label": _month_label(group["month_key"], today_str),
+            "realizado": 0.0,
+            "comprometido": 0.0,
+        })
+        amount = float(group["amount"] or 0.0)
+        if group["is_paid"]:
+            month["realizado"] += amount
+            totals["historico"] += amount
+            counts["historicos"] += group["count"]
+        else:
+            month["comprometido"] += amount
+            totals["futuro"] += amount
+            counts["futuros"] += group["count"]
+            totals["retrasado"] += float(group["overdue_amount"])
+            counts["retrasados"] += group["overdue_count"]
+
+    table_months = [monthly_summary[k] for k in sorted(monthly_summary)]
+    data = {
+        "total_historico": round(totals["historico"], 2),
+        "total_futuro": round(totals["futuro"], 2),
+        "total_proyectado": round(totals["historico"] + totals["futuro"], 2),
+        "monto_retrasado": round(totals["retrasado"], 2),
+        "count_retrasados": counts["retrasados"],
+        "count_historicos": counts["historicos"],
+        "count_futuros": counts["futuros"],
+        "chart_labels": [month["label"] for month in table_months],
+        "chart_realizados": [round(month["realizado"], 2) for month in table_months],
+        "chart_comprometidos": [round(month["comprometido"], 2) for month in table_months],
+        "table_months": table_months,
     }
+    with _income_report_lock:
+        _income_report_cache.clear()
+        _income_report_cache[today_str] = (now + INCOME_REPORT_TTL, data)
+    return copy.deepcopy(data)
 
-    monthly_summary = {}
-    
-    total_historico = 0.0
-    total_futuro = 0.0
-    monto_retrasado = 0.0
-    count_retrasados = 0
-    
-    futuros_detalles = []
-    historicos_detalles = []
 
-    for sale in sales:
-        total = float(sale.get("total_amount") or 0.0)
-        p_status = sale.get("payment_status") or "Pendiente"
-        sale_date = str(sale.get("sale_date") or "")[:10]
-        due_date = str(sale.get("invoice_due_date") or "")[:10]
-        payment_date = str(sale.get("payment_date") or "")[:10]
-        
-        if p_status == "Pagado":
-            monto_pago = float(sale.get("payment_amount") or total)
-            target_month = payment_date[:7] if len(payment_date) >= 7 else (sale_date[:7] if len(sale_date) >= 7 else today_str[:7])
-            
-            total_historico += monto_pago
-            
-            if target_month not in monthly_summary:
-                y, m = target_month.split("-") if "-" in target_month else (today_str[:4], today_str[5:7])
-                monthly_summary[target_month] = {
-                    "month_key": target_month,
-                    "label": f"{month_names.get(m, m)} {y}",
-                    "realizado": 0.0,
-                    "comprometido": 0.0,
-                }
-            monthly_summary[target_month]["realizado"] += monto_pago
-            
-            historicos_detalles.append({
-                "sale_number": sale["sale_number"],
-                "customer_name": sale["customer_name"],
-                "sale_date": sale_date,
-                "payment_date": payment_date or sale_date,
-                "monto": monto_pago,
-                "status": "Pagado"
-            })
-        else:
-            target_due = due_date if (due_date and due_date != "-") else sale_date
-            target_month = target_due[:7] if len(target_due) >= 7 else today_str[:7]
-            
-            total_futuro += total
-            
-            is_overdue = False
-            if target_due and target_due != "-" and target_due < today_str:
-                is_overdue = True
-                monto_retrasado += total
-                count_retrasados += 1
-
-            if target_month not in monthly_summary:
-                y, m = target_month.split("-") if "-" in target_month else (today_str[:4], today_str[5:7])
-                monthly_summary[target_month] = {
-                    "month_key": target_month,
-                    "label": f"{month_names.get(m, m)} {y}",
-                    "realizado": 0.0,
-                    "comprometido": 0.0,
-                }
-            monthly_summary[target_month]["comprometido"] += total
-
-            futuros_detalles.append({
-                "sale_number": sale["sale_number"],
-                "customer_name": sale["customer_name"],
-                "sale_date": sale_date,
-                "due_date": target_due,
-                "monto": total,
-                "status": "Retrasada" if is_overdue else "Pendiente",
-                "is_overdue": is_overdue
-            })
+# Columnas ordenables del detalle del reporte de ingresos, por tipo
+INCOME_DETAIL_SORTS = {
+    "historicos": {
+        "sale_number": "sale_number", "customer_name": "customer_name", "sale_date": "sale_date",
+        "payment_date": "COALESCE(NULLIF(payment_date, ''), sale_date)", "monto": "amount",
+    },
+    "futuros": {
+        "sale_number": "sale_number", "customer_name": "customer_name", "sale_date": "sale_date",
+        "due_date": "due_date", "monto": "amount", "status": "is_overdue",
+    },
+}
+
+
+def get_income_report_detail(tipo: str, page: int = 1, per_page: int = 25,
+                             sort: str = "sale_date", direction: str = "asc") -> dict:
+    """Una página del detalle de cobros realizados (historicos) o comprometidos (futuros)."""
+    if tipo not in INCOME_DETAIL_SORTS:
+        raise ValueError(f"Tipo de detalle desconocido: {tipo}")
+    if sort not in INCOME_DETAIL_SORTS[tipo]:
+        raise ValueError(f"No se puede ordenar por {sort}")
+    page = max(1, int(page))
+    per_page = min(max(1, int(per_page)), 100)
+    order = f"{INCOME_DETAIL_SORTS[tipo][sort]} {'DESC' if direction == 'desc' else 'ASC'}, id"
+
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                _INCOME_ROWS_SQL + f"""
+                SELECT sale_number, customer_name, sale_date,
+                       COALESCE(NULLIF(payment_date, ''), sale_date) AS payment_date,
+                       due_date, amount, is_overdue
+                FROM classified
+                WHERE is_paid = %(paid)s
+                ORDER BY {order}
+                LIMIT %(limit)s OFFSET %(offset)s
+                """,
+                {
+                    "today": today_str,
+                    "month": today_str[:7],
+                    "paid": tipo == "historicos",
+                    "limit": per_page,
+                    "offset": (page - 1) * per_page,
+                },
+            )
+            rows = cur.fetchall()
 
-    sorted_months_keys = sorted(monthly_summary.keys())
-    chart_labels = [monthly_summary[k]["label"] for k in sorted_months_keys]
-    chart_realizados = [round(monthly_summary[k]["realizado"], 2) for k in sorted_months_keys]
-    chart_comprometidos = [round(monthly_summary[k]["comprometido"], 2) for k in sorted_months_keys]
-    
-    table_months = [monthly_summary[k] for k in sorted_months_keys]
+    items = []
+    for row in rows:
+        item = {
+            "sale_number": row["sale_number"],
+            "customer_name": row["customer_name"],
+            "sale_date": row["sale_date"],
+            "monto": float(row["amount"] or 0.0),
+        }
+        if tipo == "historicos":
+            item.update(payment_date=row["payment_date"], status="Pagado")
+        else:
+            item.update(due_date=row["due_date"], is_overdue=row["is_overdue"],
+                        status="Retrasada" if row["is_overdue"] else "Pendiente")
+        items.append(item)
 
+    total = get_income_report_data()[f"count_{tipo}"]
     return {
-        "total_historico": round(total_historico, 2),
-        "total_futuro": round(total_futuro, 2),
-        "total_proyectado": round(total_historico + total_futuro, 2),
-        "monto_retrasado": round(monto_retrasado, 2),
-        "count_retrasados": count_retrasados,
-        "chart_labels": chart_labels,
-        "chart_realizados": chart_realizados,
-        "chart_comprometidos": chart_comprometidos,
-        "table_months": table_months,
-        "futuros_detalles": futuros_detalles,
-        "historicos_detalles": historicos_detalles
+        "items": items,
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "pages": max(1, -(-total // per_page)),
     }
 
 
@@ -2948,6 +4053,7 @@ def insert_client(data: dict) -> int:
                     rut, dv, razon_social, tipo_compra, direccion, comuna, ciudad,
                     giro, contacto, rut_solicita, dv_solicita, email, phone, category_id
                 ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (rut_normalized) DO NOTHING
                 RETURNING id
                 """,
                 (
@@ -2967,13 +4073,24 @@ def insert_client(data: dict) -> int:
                     str(data["category_id"]).strip() if data.get("category_id") else None,
                 ),
             )
-            client_id = cur.fetchone()["id"]
+            row = cur.fetchone()
+            if not row:
+                raise ValueError(f"Ya existe un cliente con el RUT {data.get('rut', '').strip()}.")
+            client_id = row["id"]
         conn.commit()
         return client_id
 
 def update_client(client_id: int, data: dict) -> None:
     with get_connection() as conn:
         with conn.cursor() as cur:
+            clean_rut = normalize_rut(data.get("rut", ""))
+            if clean_rut:
+                cur.execute(
+                    "SELECT 1 FROM clients WHERE rut_normalized = %s AND id <> %s",
+                    (clean_rut, client_id),
+                )
+                if cur.fetchone():
+                    raise ValueError(f"Ya existe otro cliente con el RUT {data.get('rut', '').strip()}.")
             cur.execute(
                 """
                 UPDATE clients SET
@@ -3010,67 +4127,1359 @@ def delete_client(client_id: int) -> None:
         conn.commit()
 
 
+def normalize_rut(rut: str) -> str | None:
+    """RUT sin puntos, guiones ni espacios y en mayúsculas, como clients.rut_normalized."""
+    normalized = re.sub(r"[^0-9A-Za-z]", "", rut or "").upper()
+    return normalized or None
+
+
 def get_client_by_rut(rut: str) -> dict:
-    if not rut:
+    clean_rut = normalize_rut(rut)
+    if not clean_rut:
         return None
-    clean_rut = rut.strip().replace(".", "").replace("-", "")
     with get_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM clients WHERE REPLACE(REPLACE(rut, '.', ''), '-', '') = %s LIMIT 1", (clean_rut,))
+            cur.execute("SELECT * FROM clients WHERE rut_normalized = %s", (clean_rut,))
             return cur.fetchone()
 
 
 def upsert_client_by_rut(data: dict) -> int:
+    """Crea el cliente o, si el RUT ya existe, actualiza sólo los campos informados."""
     rut_raw = data.get("rut", "").strip()
-    if not rut_raw:
+    if not normalize_rut(rut_raw):
         return None
-    clean_rut = rut_raw.replace(".", "").replace("-", "")
-    existing = get_client_by_rut(clean_rut)
-    
-    dv = data.get("dv", "").strip()
-    razon_social = data.get("razon_social", "").strip()
-    email = data.get("email", "").strip()
-    category_id = str(data["category_id"]).strip() if data.get("category_id") else None
-
-    if existing:
-        client_id = existing["id"]
-        update_data = {
-            "rut": rut_raw,
-            "dv": dv or existing.get("dv", ""),
-            "razon_social": razon_social or existing.get("razon_social", ""),
-            "tipo_compra": data.get("tipo_compra") or existing.get("tipo_compra") or "Del Giro",
-            "direccion": data.get("direccion") or existing.get("direccion") or "",
-            "comuna": data.get("comuna") or existing.get("comuna") or "",
-            "ciudad": data.get("ciudad") or existing.get("ciudad") or "",
-            "giro": data.get("giro") or existing.get("giro") or "",
-            "contacto": data.get("contacto") or existing.get("contacto") or "",
-            "rut_solicita": data.get("rut_solicita") or existing.get("rut_solicita") or "",
-            "dv_solicita": data.get("dv_solicita") or existing.get("dv_solicita") or "",
-            "email": email or existing.get("email", ""),
-            "phone": data.get("phone") or existing.get("phone") or "",
-            "category_id": category_id or existing.get("category_id")
-        }
-        update_client(client_id, update_data)
+
+    params = {
+        field: (str(data.get(field) or "")).strip()
+        for field in (
+            "dv", "razon_social", "tipo_compra", "direccion", "comuna", "ciudad", "giro",
+            "contacto", "rut_solicita", "dv_solicita", "email", "phone", "category_id",
+        )
+    }
+    params["rut"] = rut_raw
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO clients (
+                    rut, dv, razon_social, tipo_compra, direccion, comuna, ciudad,
+                    giro, contacto, rut_solicita, dv_solicita, email, phone, category_id
+                ) VALUES (
+                    %(rut)s, %(dv)s, %(razon_social)s, COALESCE(NULLIF(%(tipo_compra)s, ''), 'Del Giro'),
+                    %(direccion)s, %(comuna)s, %(ciudad)s, %(giro)s, %(contacto)s, %(rut_solicita)s,
+                    %(dv_solicita)s, %(email)s, %(phone)s, NULLIF(%(category_id)s, '')
+                )
+                ON CONFLICT (rut_normalized) DO UPDATE SET
+                    rut = EXCLUDED.rut,
+                    dv = COALESCE(NULLIF(%(dv)s, ''), clients.dv, ''),
+                    razon_social = COALESCE(NULLIF(%(razon_social)s, ''), clients.razon_social, ''),
+                    tipo_compra = COALESCE(NULLIF(%(tipo_compra)s, ''), NULLIF(clients.tipo_compra, ''), 'Del Giro'),
+                    direccion = COALESCE(NULLIF(%(direccion)s, ''), clients.direccion, ''),
+                    comuna = COALESCE(NULLIF(%(comuna)s, ''), clients.comuna, ''),
+                    ciudad = COALESCE(NULLIF(%(ciudad)s, ''), clients.ciudad, ''),
+                    giro = COALESCE(NULLIF(%(giro)s, ''), clients.giro, ''),
+                    contacto = COALESCE(NULLIF(%(contacto)s, ''), clients.contacto, ''),
+                    rut_solicita = COALESCE(NULLIF(%(rut_solicita)s, ''), clients.rut_solicita, ''),
+                    dv_solicita = COALESCE(NULLIF(%(dv_solicita)s, ''), clients.dv_solicita, ''),
+                    email = COALESCE(NULLIF(%(email)s, ''), clients.email, ''),
+                    phone = COALESCE(NULLIF(%(phone)s, ''), clients.phone, ''),
+                    category_id = COALESCE(NULLIF(%(category_id)s, ''), clients.category_id)
+                RETURNING id
+                """,
+                params,
+            )
+            client_id = cur.fetchone()["id"]
+        conn.commit()
         return client_id
-    else:
-        new_client = {
-            "rut": rut_raw,
-            "dv": dv,
-            "razon_social": razon_social,
-            "tipo_compra": data.get("tipo_compra", "Del Giro"),
-            "direccion": data.get("direccion", ""),
-            "comuna": data.get("comuna", ""),
-            "ciudad": data.get("ciudad", ""),
-            "giro": data.get("giro", ""),
-            "contacto": data.get("contacto", ""),
-            "rut_solicita": data.get("rut_solicita", ""),
-            "dv_solicita": data.get("dv_solicita", ""),
-            "email": email,
-            "phone": data.get("phone", ""),
-            "category_id": category_id
+
+
+
+
+
+
+# === Search Functions ===
+# Búsqueda tolerante a errores de tipeo sobre ventas, clientes, productos y proveedores.
+# Con la extensión pg_trgm usa los índices GIN de trigramas (migración 0011); sin ella,
+# trae candidatos con ILIKE y los ordena en Python con la misma fórmula de puntaje.
+
+SEARCH_TRIGRAM = os.getenv("SEARCH_TRIGRAM", "1") != "0"
+SEARCH_FALLBACK_CANDIDATES = int(os.getenv("SEARCH_FALLBACK_CANDIDATES", "1000"))
+_WORD_SIMILARITY_THRESHOLD = 0.6  # pg_trgm.word_similarity_threshold por defecto
+_trigram_available: bool | None = None
+
+SEARCH_TYPES = {
+    "ventas": {
+        "table": "sales",
+        "columns": "id, sale_number, customer_name, sale_date, total_amount, status",
+        "fields": [("sale_number", "q"), ("customer_name", "q")],
+        "where": "TRUE",
+        "order": "id DESC",
+        "title": lambda row: row["sale_number"],
+        "detail": lambda row: f"{row['customer_name']} · {row['sale_date']} · {row['status']}",
+    },
+    "clientes": {
+        "table": "clients",
+        "columns": "id, rut, dv, razon_social, email",
+        "fields": [("razon_social", "q"), ("rut_normalized", "q_rut")],
+        "where": "TRUE",
+        "order": "razon_social",
+        "title": lambda row: row["razon_social"],
+        "detail": lambda row: "-".join(part for part in (row["rut"], row["dv"]) if part),
+    },
+    "productos": {
+        "table": "products",
+        "columns": "id, sku, name, barcode, product_type",
+        "fields": [("name", "q"), ("sku", "q"), ("barcode", "q")],
+        "where": "(is_deleted = FALSE OR is_deleted IS NULL)",
+        "order": "name",
+        "title": lambda row: row["name"],
+        "detail": lambda row: row["sku"],
+    },
+    "proveedores": {
+        "table": "suppliers",
+        "columns": "id, name, razon_social, rut, dv",
+        "fields": [("name", "q"), ("razon_social", "q")],
+        "where": "TRUE",
+        "order": "name",
+        "title": lambda row: row["name"],
+        "detail": lambda row: row["razon_social"] or "",
+    },
+}
+
+
+def _trigram_search_enabled() -> bool:
+    global _trigram_available
+    if not SEARCH_TRIGRAM:
+        return False
+    if _trigram_available is None:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS available")
+                _trigram_available = cur.fetchone()["available"]
+    return _trigram_available
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _trigrams(text: str) -> set[str]:
+    """Trigramas de cada palabra como los calcula pg_trgm (dos espacios antes, uno después)."""
+    grams = set()
+    for word in re.findall(r"[^\W_]+", (text or "").lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _field_score(value: str, query: str) -> float:
+    """Puntaje de un campo: exacto 1.0, prefijo 0.9, si no similitud de trigramas (máx. 0.8)."""
+    value_lower, query_lower = (value or "").lower(), query.lower()
+    if not value_lower or not query_lower:
+        return 0.0
+    if value_lower == query_lower:
+        return 1.0
+    if value_lower.startswith(query_lower):
+        return 0.9
+    value_grams, query_grams = _trigrams(value_lower), _trigrams(query_lower)
+    if not value_grams or not query_grams:
+        return 0.0
+    common = len(value_grams & query_grams)
+    similarity = common / len(value_grams | query_grams)
+    word_similarity = common / len(query_grams)
+    return max(similarity, word_similarity) * 0.8
+
+
+def _field_matches(value: str, query: str) -> bool:
+    value_lower = (value or "").lower()
+    if query.lower() in value_lower:
+        return True
+    query_grams = _trigrams(query)
+    return bool(query_grams) and len(_trigrams(value_lower) & query_grams) / len(query_grams) >= _WORD_SIMILARITY_THRESHOLD
+
+
+def _search_type_trigram(cur, spec: dict, params: dict, limit: int) -> list[dict]:
+    fields = [(column, param) for column, param in spec["fields"] if params[param]]
+    scores = [
+        f"""CASE WHEN lower({column}) = lower(%({param})s) THEN 1.0
+                 WHEN {column} ILIKE %({param}_prefix)s THEN 0.9
+                 ELSE GREATEST(similarity(COALESCE({column}, ''), %({param})s),
+                               word_similarity(%({param})s, COALESCE({column}, ''))) * 0.8 END"""
+        for column, param in fields
+    ]
+    conditions = [f"{column} ILIKE %({param}_like)s OR %({param})s <%% {column}" for column, param in fields]
+    cur.execute(
+        f"""
+        SELECT {spec["columns"]}, GREATEST({", ".join(scores)}) AS score
+        FROM {spec["table"]}
+        WHERE {spec["where"]} AND ({" OR ".join(conditions)})
+        ORDER BY score DESC, {spec["order"]}
+        LIMIT %(limit)s
+        """,
+        {**params, "limit": limit},
+    )
+    return cur.fetchall()
+
+
+def _search_type_fallback(cur, spec: dict, params: dict, limit: int) -> list[dict]:
+    fields = [(column, param) for column, param in spec["fields"] if params[param]]
+    # Sin recorrer la tabla completa: candidatos con alguna palabra de la búsqueda en algún
+    # campo; los que contienen la búsqueda completa van primero para que el límite no los corte
+    conditions, values = [], []
+    for column, param in fields:
+        words = [w for w in re.findall(r"[^\W_]+", params[param]) if len(w) >= 3] or [params[param]]
+        for word in words:
+            conditions.append(f"{column} ILIKE %s")
+            values.append(f"%{_escape_like(word)}%")
+    full_match = " OR ".join(f"{column} ILIKE %s" for column, _ in fields)
+    cur.execute(
+        f"""
+        SELECT {spec["columns"]} FROM {spec["table"]}
+        WHERE {spec["where"]} AND ({" OR ".join(conditions)})
+        ORDER BY ({full_match}) DESC, {spec["order"]}
+        LIMIT %s
+        """,
+        values + [params[f"{param}_like"] for _, param in fields] + [SEARCH_FALLBACK_CANDIDATES],
+    )
+
+    ranked = []
+    for row in cur.fetchall():
+        row = dict(row)
+        values = [
+            (str((normalize_rut(row.get("rut")) if column == "rut_normalized" else row.get(column)) or ""), params[param])
+            for column, param in fields
+        ]
+        if not any(_field_matches(value, query) for value, query in values):
+            continue
+        row["score"] = max(_field_score(value, query) for value, query in values)
+        ranked.append(row)
+    ranked.sort(key=lambda row: row["score"], reverse=True)
+    return ranked[:limit]
+
+
+def search(query: str, types: list[str] | None = None, limit: int = 10) -> list[dict]:
+    """Resultados de búsqueda ordenados por puntaje: tipo, id, título, detalle y score."""
+    query = (query or "").strip()
+    if len(query) < 2:
+        return []
+    params = {"q": query, "q_rut": normalize_rut(query) or ""}
+    for key in ("q", "q_rut"):
+        params[f"{key}_like"] = f"%{_escape_like(params[key])}%"
+        params[f"{key}_prefix"] = f"{_escape_like(params[key])}%"
+
+    use_trigram = _trigram_search_enabled()
+    results = []
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            for tipo in types or list(SEARCH_TYPES):
+                spec = SEARCH_TYPES[tipo]
+                rows = (_search_type_trigram if use_trigram else _search_type_fallback)(cur, spec, params, limit)
+                results.extend(
+                    {
+                        "tipo": tipo,
+                        "id": row["id"],
+                        "titulo": spec["title"](row),
+                        "detalle": spec["detail"](row),
+                        "score": round(float(row["score"]), 3),
+                    }
+                    for row in rows
+                )
+    results.sort(key=lambda result: result["score"], reverse=True)
+    return results
+
+
+# === Receivables Functions ===
+# Cuentas por cobrar: saldo de cada venta vigente no pagada (sales.balance_due, migración 0013)
+# y su antigüedad según el vencimiento de la factura, o la fecha de venta si no tiene.
+# Las ventas abiertas se leen del índice parcial idx_sales_open_receivables (migración 0012).
+
+RECEIVABLES_BUCKETS = [
+    ("por_vencer", "Por vencer"),
+    ("0_30", "0-30 días"),
+    ("31_60", "31-60 días"),
+    ("61_90", "61-90 días"),
+    ("90_mas", "Más de 90 días"),
+]
+
+_RECEIVABLES_OPEN_SQL = (
+    "s.status NOT IN ('Cancelada', 'Cancelado', 'Cotización', 'Borrador')"
+    " AND COALESCE(s.payment_status, 'Pendiente') <> 'Pagado'"
+)
+
+
+def _receivables_sql(as_of: str) -> str:
+    """Ventas con saldo pendiente, con días de atraso y tramo al día as_of (expresión SQL)."""
+    return f"""
+        SELECT s.id, s.sale_number, s.customer_name, s.sale_date, sp.invoice_number, due.due_on,
+               s.total_amount, s.paid_total AS paid_amount, s.balance_due AS balance,
+               GREATEST({as_of} - due.due_on, 0) AS days_overdue,
+               CASE
+                   WHEN due.due_on IS NULL OR due.due_on >= {as_of} THEN 'por_vencer'
+                   WHEN {as_of} - due.due_on <= 30 THEN '0_30'
+                   WHEN {as_of} - due.due_on <= 60 THEN '31_60'
+                   WHEN {as_of} - due.due_on <= 90 THEN '61_90'
+                   ELSE '90_mas'
+               END AS bucket
+        FROM sales s
+        LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+        CROSS JOIN LATERAL (SELECT COALESCE(sp.invoice_due_on, s.sale_ts::date) AS due_on) due
+        WHERE {_RECEIVABLES_OPEN_SQL}
+          AND s.balance_due > 0.005
+    """
+
+
+def _receivables_as_of(as_of: str | None) -> str:
+    if not as_of:
+        return datetime.now().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(as_of, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Fecha inválida: {as_of} (formato AAAA-MM-DD).")
+    return as_of
+
+
+def get_receivables_aging(as_of: str | None = None) -> dict:
+    """Saldos por cobrar por cliente repartidos en tramos de antigüedad, con totales."""
+    as_of = _receivables_as_of(as_of)
+    bucket_sums = ", ".join(
+        f"COALESCE(SUM(balance) FILTER (WHERE bucket = '{key}'), 0) AS b_{key}"
+        for key, _ in RECEIVABLES_BUCKETS
+    )
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                WITH receivables AS ({_receivables_sql("%(as_of)s::date")}),
+                by_client AS (
+                    SELECT customer_name, COUNT(*) AS invoices, SUM(balance) AS total,
+                           MAX(days_overdue) AS max_days_overdue, {bucket_sums}
+                    FROM receivables
+                    GROUP BY customer_name
+                )
+                SELECT b.*, c.rut, c.dv
+                FROM by_client b
+                LEFT JOIN LATERAL (
+                    SELECT rut, dv FROM clients
+                    WHERE LOWER(TRIM(razon_social)) = LOWER(TRIM(b.customer_name))
+                    ORDER BY id LIMIT 1
+                ) c ON TRUE
+                ORDER BY b.total DESC, b.customer_name
+                """,
+                {"as_of": as_of},
+            )
+            rows = cur.fetchall()
+
+    clients = []
+    totals = {key: 0.0 for key, _ in RECEIVABLES_BUCKETS}
+    totals.update(total=0.0, invoices=0)
+    for row in rows:
+        client = {
+            "customer_name": row["customer_name"],
+            "rut": "-".join(part for part in (row["rut"], row["dv"]) if part),
+            "invoices": row["invoices"],
+            "max_days_overdue": row["max_days_overdue"],
+            "total": round(float(row["total"]), 2),
+        }
+        for key, _ in RECEIVABLES_BUCKETS:
+            client[key] = round(float(row[f"b_{key}"]), 2)
+            totals[key] += client[key]
+        totals["total"] += client["total"]
+        totals["invoices"] += client["invoices"]
+        clients.append(client)
+    return {
+        "as_of": as_of,
+        "buckets": [{"key": key, "label": label} for key, label in RECEIVABLES_BUCKETS],
+        "clients": clients,
+        "totals": {key: round(value, 2) for key, value in totals.items()},
+    }
+
+
+def list_receivables(as_of: str | None = None, customer_name: str | None = None,
+                     bucket: str | None = None, limit: int = 500) -> list[dict]:
+    """Ventas con saldo pendiente (de un cliente y/o tramo), de la más atrasada a la más reciente."""
+    as_of = _receivables_as_of(as_of)
+    if bucket and bucket not in dict(RECEIVABLES_BUCKETS):
+        raise ValueError(f"Tramo desconocido: {bucket}")
+    conditions = ["TRUE"]
+    params = {"as_of": as_of, "limit": min(max(1, int(limit)), 5000)}
+    if customer_name:
+        conditions.append("customer_name = %(customer_name)s")
+        params["customer_name"] = customer_name
+    if bucket:
+        conditions.append("bucket = %(bucket)s")
+        params["bucket"] = bucket
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT * FROM ({_receivables_sql("%(as_of)s::date")}) r
+                WHERE {" AND ".join(conditions)}
+                ORDER BY due_on NULLS LAST, id
+                LIMIT %(limit)s
+                """,
+                params,
+            )
+            return [
+                {
+                    **dict(row),
+                    "due_on": row["due_on"].isoformat() if row["due_on"] else None,
+                    "total_amount": float(row["total_amount"] or 0.0),
+                    "paid_amount": float(row["paid_amount"]),
+                    "balance": round(float(row["balance"]), 2),
+                }
+                for row in cur.fetchall()
+            ]
+
+
+# === Export Functions ===
+# Exportaciones en streaming: las filas se leen de un cursor con nombre (server-side) en
+# bloques de EXPORT_CHUNK_SIZE. El generador se consume después de que la vista retorna,
+# por eso usa una conexión propia del pool y no la compartida de la request.
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+
+EXPORT_TYPES = {
+    "ventas": {
+        "columns": [
+            "ID", "N° Venta", "Fecha", "Hora", "Cliente", "Email", "Vendedor", "Estado",
+            "Estado de pago", "Estado de despacho", "Medio de pago", "Total",
+            "N° Factura", "Monto factura", "Vencimiento factura", "Estado factura", "Pagado", "Saldo",
+        ],
+        "query": """
+            SELECT s.id, s.sale_number, s.sale_date, s.sale_time, s.customer_name, s.customer_email,
+                   s.seller_name, s.status, s.payment_status, s.delivery_status, s.payment_method,
+                   s.total_amount, sp.invoice_number, sp.invoice_amount, sp.invoice_due_date, sp.status,
+                   s.paid_total, s.balance_due
+            FROM sales s
+            LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+            WHERE {where}
+            ORDER BY s.sale_ts NULLS FIRST, s.id
+        """,
+        "date": "s.sale_ts",
+        "status": "s.status",
+    },
+    "pagos": {
+        "columns": [
+            "ID", "N° Venta", "Cliente", "Fecha de pago", "Monto", "Estado", "Aprobado por",
+            "Fecha aprobación", "Comentario", "Registrado",
+        ],
+        "query": """
+            SELECT spi.id, s.sale_number, s.customer_name, spi.payment_date, spi.payment_amount,
+                   CASE WHEN spi.accounting_approved = 1 THEN 'Aprobado' ELSE 'Pendiente' END,
+                   spi.accounting_approved_by, spi.accounting_approved_at, spi.accounting_comment, spi.created_at
+            FROM sale_payment_items spi
+            JOIN sales s ON s.id = spi.sale_id
+            WHERE {where}
+            ORDER BY text_to_timestamp(spi.payment_date) NULLS FIRST, spi.id
+        """,
+        "date": "text_to_timestamp(spi.payment_date)",
+        "status": "CASE WHEN spi.accounting_approved = 1 THEN 'Aprobado' ELSE 'Pendiente' END",
+    },
+    "ordenes_compra": {
+        "columns": [
+            "N° OC", "Fecha", "Proveedor", "Estado", "Medio de pago", "Total OC", "SKU", "Producto",
+            "Cantidad pedida", "Cantidad recibida", "Precio unitario", "Total línea",
+        ],
+        "query": """
+            SELECT po.oc_number, po.order_date, s.name, po.status, po.payment_method, po.total_amount,
+                   p.sku, p.name, poi.quantity_ordered, poi.quantity_received, poi.unit_price, poi.total_price
+            FROM purchase_orders po
+            LEFT JOIN suppliers s ON s.id = po.supplier_id
+            LEFT JOIN purchase_order_items poi ON poi.purchase_order_id = po.id
+            LEFT JOIN products p ON p.id = poi.product_id
+            WHERE {where}
+            ORDER BY text_to_timestamp(po.order_date) NULLS FIRST, po.id, poi.id
+        """,
+        "date": "text_to_timestamp(po.order_date)",
+        "status": "po.status",
+    },
+    "cuentas_por_cobrar": {
+        "columns": [
+            "N° Venta", "Cliente", "Fecha venta", "N° Factura", "Vencimiento", "Total", "Pagado",
+            "Saldo", "Días de atraso", "Tramo",
+        ],
+        "query": """
+            SELECT r.sale_number, r.customer_name, r.sale_date, r.invoice_number, r.due_on, r.total_amount,
+                   r.paid_amount, r.balance, r.days_overdue,
+                   CASE r.bucket """ + " ".join(f"WHEN '{key}' THEN '{label}'" for key, label in RECEIVABLES_BUCKETS) + """ END
+            FROM (""" + _receivables_sql("CURRENT_DATE") + """) r
+            WHERE {where}
+            ORDER BY r.due_on NULLS LAST, r.id
+        """,
+        "date": "r.due_on",
+        "status": "r.bucket",
+    },
+    "ingresos": {
+        "columns": [
+            "ID ingreso", "Fecha", "N° Orden", "Proveedor", "Bodega", "Total ingreso", "SKU", "Producto",
+            "Cantidad", "Precio unitario", "Total línea",
+        ],
+        "query": """
+            SELECT ie.id, ie.entry_date, ie.order_number, s.name, ie.warehouse, ie.total_amount,
+                   p.sku, p.name, iei.quantity, iei.unit_price, iei.total
+            FROM inventory_entries ie
+            LEFT JOIN suppliers s ON s.id = ie.supplier_id
+            LEFT JOIN inventory_entry_items iei ON iei.inventory_entry_id = ie.id
+            LEFT JOIN products p ON p.id = iei.product_id
+            WHERE {where}
+            ORDER BY text_to_timestamp(ie.entry_date) NULLS FIRST, ie.id, iei.id
+        """,
+        "date": "text_to_timestamp(ie.entry_date)",
+        "status": None,
+    },
+}
+
+
+def _export_query(tipo: str, filters: dict | None) -> tuple[str, list]:
+    spec = EXPORT_TYPES[tipo]
+    conditions = ["TRUE"]
+    params = []
+    filters = filters or {}
+    for key in ("date_from", "date_to"):
+        if filters.get(key):
+            try:
+                datetime.strptime(filters[key], "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"Fecha inválida: {filters[key]} (formato AAAA-MM-DD).")
+    if filters.get("date_from"):
+        conditions.append(f"{spec['date']} >= %s::date")
+        params.append(filters["date_from"])
+    if filters.get("date_to"):
+        conditions.append(f"{spec['date']} < %s::date + 1")
+        params.append(filters["date_to"])
+    if filters.get("status"):
+        if not spec["status"]:
+            raise ValueError(f"La exportación '{tipo}' no admite filtro de estado.")
+        conditions.append(f"{spec['status']} = %s")
+        params.append(filters["status"])
+    return spec["query"].format(where=" AND ".join(conditions)), params
+
+
+def iter_export_rows(tipo: str, filters: dict | None = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Filas (tuplas) de una exportación en el orden de EXPORT_TYPES[tipo]['columns'].
+
+    Los filtros (date_from, date_to, status) se validan al llamar; las filas se leen
+    al iterar, de a chunk_size desde el servidor.
+    """
+    if tipo not in EXPORT_TYPES:
+        raise ValueError(f"Tipo de exportación desconocido: {tipo}")
+    query, params = _export_query(tipo, filters)
+    return _stream_export_rows(tipo, query, params, chunk_size)
+
+
+def _stream_export_rows(tipo: str, query: str, params: list, chunk_size: int):
+    pool = _get_pool()
+    conn = pool.acquire()
+    try:
+        with conn.cursor(name=f"export_{tipo}", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = chunk_size
+            cur.execute(query, params)
+            yield from cur
+    finally:
+        pool.release(conn)
+
+
+# === Import Functions ===
+# Importación masiva de ventas históricas desde CSV (una fila por línea de producto).
+# Las filas se validan en Python, se cargan con COPY a una tabla temporal y se resuelven
+# clientes (por RUT) y productos (por SKU) con SQL por conjuntos; todo en una transacción.
+# Las ventas importadas no mueven el stock ni reservan: son históricas. Las Completadas quedan
+# en el libro como ya descontadas (salida compensada) para que editarlas no las descuente.
+
+IMPORT_SALES_COLUMNS = [
+    "sale_number", "sale_date", "sale_time", "rut", "customer_name", "customer_email",
+    "seller_name", "status", "payment_method", "payment_status", "delivery_status",
+    "sku", "quantity", "unit_price", "discount",
+    "invoice_number", "invoice_due_date", "payment_amount", "payment_date", "notes",
+]
+IMPORT_REQUIRED_COLUMNS = ("sale_number", "sale_date", "sku", "quantity", "unit_price")
+IMPORT_REJECTED_DETAIL_LIMIT = 1000
+
+_IMPORT_STAGE_COLUMNS = ["line_no"] + IMPORT_SALES_COLUMNS
+_IMPORT_NUMERIC_COLUMNS = ("quantity", "unit_price", "discount", "payment_amount")
+_IMPORT_DATE_COLUMNS = ("sale_date", "invoice_due_date", "payment_date")
+_IMPORT_DEFAULTS = {
+    "sale_time": "00:00:00",
+    "status": "Completada",
+    "payment_status": "Pendiente",
+    "delivery_status": "Pendiente",
+    "discount": "0",
+}
+
+
+def _validate_import_row(row: dict, with_entries: bool) -> tuple[dict | None, str | None]:
+    """Fila normalizada lista para COPY, o el motivo de rechazo."""
+    values = {col: (row.get(col) or "").strip() for col in IMPORT_SALES_COLUMNS}
+    for col, default in _IMPORT_DEFAULTS.items():
+        values[col] = values[col] or default
+    missing = [col for col in IMPORT_REQUIRED_COLUMNS if not values[col]]
+    if missing:
+        return None, f"Faltan columnas obligatorias: {', '.join(missing)}"
+
+    for col in _IMPORT_NUMERIC_COLUMNS:
+        if values[col]:
+            try:
+                values[col] = float(values[col].replace(",", "."))
+            except ValueError:
+                return None, f"{col} no es numérico: {values[col]}"
+        else:
+            values[col] = None
+    if values["quantity"] <= 0:
+        return None, "quantity debe ser mayor que cero"
+    if with_entries and not values["quantity"].is_integer():
+        return None, "quantity debe ser entera para el registro de ingreso de ventas"
+    if values["unit_price"] < 0:
+        return None, "unit_price no puede ser negativo"
+    if not 0 <= values["discount"] <= 100:
+        return None, "discount debe estar entre 0 y 100"
+
+    for col in _IMPORT_DATE_COLUMNS:
+        if values[col]:
+            try:
+                datetime.strptime(values[col], "%Y-%m-%d")
+            except ValueError:
+                return None, f"{col} inválida: {values[col]} (formato AAAA-MM-DD)"
+    try:
+        datetime.strptime(values["sale_time"], "%H:%M:%S" if values["sale_time"].count(":") == 2 else "%H:%M")
+    except ValueError:
+        return None, f"sale_time inválida: {values['sale_time']}"
+
+    # El RUT se guarda sin DV en clients; se acepta con o sin él
+    values["rut"] = normalize_rut(values["rut"].split("-")[0]) or ""
+    return values, None
+
+
+def _import_copy_value(value) -> str:
+    return "" if value is None else str(value)
+
+
+def import_sales_csv(stream, dry_run: bool = False, with_entries: bool = False) -> dict:
+    """Importa ventas históricas desde un CSV de texto (archivo abierto o iterable de líneas).
+
+    Cada fila es una línea de producto; las filas con el mismo sale_number forman una venta
+    y los datos de cabecera se toman de la primera. Una venta con alguna fila rechazada se
+    descarta completa. Con with_entries también se agrega cada línea a sales_entries.
+    Devuelve el resumen con las filas rechazadas (línea del archivo y motivo); con
+    dry_run valida todo contra la base pero no guarda nada.
+    """
+    reader = csv.DictReader(stream)
+    missing = [col for col in IMPORT_REQUIRED_COLUMNS if col not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"El archivo no tiene las columnas obligatorias: {', '.join(missing)}")
+
+    rejected = []
+    rejected_count = 0
+    total_rows = 0
+    staged = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024, mode="w+", newline="", encoding="utf-8")
+    writer = csv.writer(staged)
+    invalid_sales = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024, mode="w+", newline="", encoding="utf-8")
+    invalid_writer = csv.writer(invalid_sales)
+    for line_no, row in enumerate(reader, start=2):
+        total_rows += 1
+        values, error = _validate_import_row(row, with_entries)
+        if error:
+            rejected_count += 1
+            invalid_writer.writerow([(row.get("sale_number") or "").strip()])
+            if len(rejected) < IMPORT_REJECTED_DETAIL_LIMIT:
+                rejected.append({"line": line_no, "sale_number": (row.get("sale_number") or "").strip(), "error": error})
+            continue
+        writer.writerow([line_no] + [_import_copy_value(values[col]) for col in IMPORT_SALES_COLUMNS])
+    staged.seek(0)
+    invalid_sales.seek(0)
+
+    now_str = datetime.utcnow().isoformat(timespec="seconds")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMP TABLE import_sales_stage (
+                    line_no INTEGER PRIMARY KEY,
+                    sale_number TEXT NOT NULL, sale_date TEXT NOT NULL, sale_time TEXT NOT NULL,
+                    rut TEXT, customer_name TEXT, customer_email TEXT, seller_name TEXT,
+                    status TEXT NOT NULL, payment_method TEXT, payment_status TEXT NOT NULL,
+                    delivery_status TEXT NOT NULL, sku TEXT NOT NULL,
+                    quantity DOUBLE PRECISION NOT NULL, unit_price DOUBLE PRECISION NOT NULL,
+                    discount DOUBLE PRECISION NOT NULL, invoice_number TEXT, invoice_due_date TEXT,
+                    payment_amount DOUBLE PRECISION, payment_date TEXT, notes TEXT,
+                    product_id INTEGER, product_name TEXT, subtotal DOUBLE PRECISION
+                ) ON COMMIT DROP;
+                CREATE TEMP TABLE import_sales_rejected (line_no INTEGER, error TEXT) ON COMMIT DROP;
+                CREATE TEMP TABLE import_sales_invalid (sale_number TEXT) ON COMMIT DROP;
+                """
+            )
+            cur.copy_expert(
+                f"COPY import_sales_stage ({', '.join(_IMPORT_STAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                staged,
+            )
+            cur.copy_expert("COPY import_sales_invalid (sale_number) FROM STDIN WITH (FORMAT csv)", invalid_sales)
+            staged.close()
+            invalid_sales.close()
+            cur.execute("ANALYZE import_sales_stage; ANALYZE import_sales_invalid")
+
+            # Productos por SKU y clientes por RUT
+            cur.execute(
+                """
+                UPDATE import_sales_stage st
+                SET product_id = p.id, product_name = p.name,
+                    subtotal = ROUND((st.quantity * st.unit_price * (1 - st.discount / 100))::numeric, 2)
+                FROM products p
+                WHERE p.sku = st.sku AND (p.is_deleted = FALSE OR p.is_deleted IS NULL)
+                """
+            )
+            cur.execute(
+                """
+                UPDATE import_sales_stage st
+                SET customer_name = COALESCE(NULLIF(st.customer_name, ''), c.razon_social),
+                    customer_email = COALESCE(NULLIF(st.customer_email, ''), c.email)
+                FROM clients c
+                WHERE st.rut <> '' AND c.rut_normalized = st.rut
+                """
+            )
+            cur.execute(
+                """
+                INSERT INTO import_sales_rejected (line_no, error)
+                SELECT line_no, 'SKU inexistente: ' || sku FROM import_sales_stage WHERE product_id IS NULL
+                UNION ALL
+                SELECT line_no, CASE WHEN rut <> '' THEN 'RUT sin cliente registrado: ' || rut
+                                     ELSE 'Falta customer_name o rut' END
+                FROM (
+                    SELECT DISTINCT ON (sale_number) line_no, rut, customer_name
+                    FROM import_sales_stage ORDER BY sale_number, line_no
+                ) heads
+                WHERE COALESCE(customer_name, '') = ''
+                UNION ALL
+                SELECT st.line_no, 'La venta ya existe: ' || st.sale_number
+                FROM import_sales_stage st JOIN sales s ON s.sale_number = st.sale_number
+                """
+            )
+            # Una venta con cualquier línea rechazada se descarta completa
+            cur.execute(
+                """
+                WITH rejected_sales AS (
+                    SELECT st.sale_number FROM import_sales_stage st JOIN import_sales_rejected r USING (line_no)
+                    UNION
+                    SELECT sale_number FROM import_sales_invalid
+                )
+                INSERT INTO import_sales_rejected (line_no, error)
+                SELECT st.line_no, 'Otra línea de la venta ' || st.sale_number || ' fue rechazada'
+                FROM import_sales_stage st JOIN rejected_sales USING (sale_number)
+                WHERE NOT EXISTS (SELECT 1 FROM import_sales_rejected r WHERE r.line_no = st.line_no)
+                """
+            )
+            cur.execute("SELECT COUNT(DISTINCT line_no) AS n FROM import_sales_rejected")
+            rejected_count += cur.fetchone()["n"]
+            room = IMPORT_REJECTED_DETAIL_LIMIT - len(rejected)
+            if room > 0:
+                cur.execute(
+                    """
+                    SELECT r.line_no, st.sale_number, r.error
+                    FROM import_sales_rejected r JOIN import_sales_stage st USING (line_no)
+                    ORDER BY r.line_no
+                    LIMIT %s
+                    """,
+                    (room,),
+                )
+                rejected.extend(
+                    {"line": row["line_no"], "sale_number": row["sale_number"], "error": row["error"]}
+                    for row in cur.fetchall()
+                )
+            cur.execute("DELETE FROM import_sales_stage WHERE line_no IN (SELECT line_no FROM import_sales_rejected)")
+
+            cur.execute("SELECT COUNT(*) AS lines, COUNT(DISTINCT sale_number) AS sales FROM import_sales_stage")
+            counts = cur.fetchone()
+            summary = {
+                "total_rows": total_rows,
+                "imported_rows": counts["lines"],
+                "imported_sales": counts["sales"],
+                "rejected_rows": rejected_count,
+                "rejected": sorted(rejected, key=lambda item: item["line"]),
+                "dry_run": dry_run,
+            }
+            if dry_run or not counts["lines"]:
+                conn.rollback()
+                return summary
+
+            _insert_imported_sales(cur, now_str, with_entries)
+            publish_cache_invalidation(cur, "sales_filter_options")
+            publish_cache_invalidation(cur, "income_report")
+        conn.commit()
+    return summary
+
+
+def _insert_imported_sales(cur, now_str: str, with_entries: bool) -> None:
+    """Inserta ventas, líneas, pagos y (opcionalmente) sales_entries desde import_sales_stage."""
+    initials = "LEFT(UPPER(ARRAY_TO_STRING(ARRAY(SELECT LEFT(w, 1) FROM REGEXP_SPLIT_TO_TABLE(BTRIM({0}), '\\s+') w), '')), 3)"
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE import_sales_ids ON COMMIT DROP AS
+        WITH heads AS (
+            SELECT DISTINCT ON (sale_number) *
+            FROM import_sales_stage
+            ORDER BY sale_number, line_no
+        ), totals AS (
+            SELECT sale_number, SUM(subtotal) AS total_amount,
+                   JSONB_AGG(JSONB_BUILD_OBJECT(
+                       'product_id', product_id, 'product_name', product_name, 'quantity', quantity,
+                       'price', unit_price, 'discount', discount, 'subtotal', subtotal
+                   ) ORDER BY line_no)::text AS products_json
+            FROM import_sales_stage
+            GROUP BY sale_number
+        ), inserted AS (
+            INSERT INTO sales (
+                sale_number, customer_name, customer_email, customer_initials,
+                sale_date, sale_time, products_json, total_amount, status,
+                seller_name, seller_initials, payment_method, payment_status,
+                delivery_status, notes, created_at
+            )
+            SELECT h.sale_number, h.customer_name, COALESCE(h.customer_email, ''),
+                   {initials.format("h.customer_name")},
+                   h.sale_date, h.sale_time, t.products_json, t.total_amount, h.status,
+                   COALESCE(h.seller_name, ''), {initials.format("COALESCE(h.seller_name, '')")},
+                   COALESCE(h.payment_method, ''), h.payment_status, h.delivery_status,
+                   COALESCE(h.notes, ''), %(now)s
+            FROM heads h JOIN totals t USING (sale_number)
+            ORDER BY h.sale_date, h.sale_time, h.sale_number
+            RETURNING id, sale_number, total_amount, payment_status
+        )
+        SELECT i.id, i.sale_number, i.total_amount, i.payment_status,
+               h.sale_date, h.invoice_number, h.invoice_due_date, h.payment_amount, h.payment_date
+        FROM inserted i JOIN heads h USING (sale_number)
+        """,
+        {"now": now_str},
+    )
+    cur.execute(
+        """
+        INSERT INTO sale_items (sale_id, line_no, product_id, sku, product_name, quantity, unit_price, discount, subtotal)
+        SELECT ids.id, ROW_NUMBER() OVER (PARTITION BY st.sale_number ORDER BY st.line_no),
+               st.product_id, st.sku, st.product_name, st.quantity, st.unit_price, st.discount, st.subtotal
+        FROM import_sales_stage st JOIN import_sales_ids ids USING (sale_number)
+        """
+    )
+    # Las Completadas quedan como ya descontadas para que editarlas después no mueva el stock
+    cur.execute("SELECT id FROM import_sales_ids")
+    _mark_sales_already_deducted(
+        cur, [row["id"] for row in cur.fetchall()], "importada (histórica, sin efecto en el stock)", now_str
+    )
+    cur.execute(
+        """
+        INSERT INTO sale_payments (
+            sale_id, invoice_number, invoice_amount, invoice_due_date, payment_amount, payment_date,
+            accounting_approved, accounting_approved_by, accounting_approved_at, accounting_comment,
+            status, created_at, updated_at
+        )
+        SELECT id, NULLIF(invoice_number, ''), total_amount, NULLIF(invoice_due_date, ''),
+               payment_amount, NULLIF(payment_date, ''),
+               CASE WHEN payment_status = 'Pagado' THEN 1 ELSE 0 END,
+               CASE WHEN payment_status = 'Pagado' THEN 'Importación' END,
+               CASE WHEN payment_status = 'Pagado' THEN %(now)s END,
+               'Importación histórica',
+               CASE WHEN payment_status = 'Pagado' THEN 'Pagado' ELSE 'Factura pendiente' END,
+               %(now)s, %(now)s
+        FROM import_sales_ids
+        WHERE COALESCE(invoice_number, '') <> '' OR payment_amount > 0
+        """,
+        {"now": now_str},
+    )
+    cur.execute(
+        """
+        INSERT INTO sale_payment_items (
+            sale_id, payment_amount, payment_date, created_at,
+            accounting_approved, accounting_approved_by, accounting_approved_at, accounting_comment
+        )
+        SELECT id, payment_amount, COALESCE(NULLIF(payment_date, ''), sale_date), %(now)s,
+               CASE WHEN payment_status = 'Pagado' THEN 1 ELSE 0 END,
+               CASE WHEN payment_status = 'Pagado' THEN 'Importación' END,
+               CASE WHEN payment_status = 'Pagado' THEN %(now)s END,
+               'Importación histórica'
+        FROM import_sales_ids
+        WHERE payment_amount > 0
+        """,
+        {"now": now_str},
+    )
+    if with_entries:
+        cur.execute(
+            """
+            INSERT INTO sales_entries (
+                sku, product_name, quantity, unit_price, total_price,
+                sale_date, delivery_date, payment_status, delivery_status,
+                payment_method, customer_name, seller_name, notes, created_at
+            )
+            SELECT st.sku, st.product_name, st.quantity::integer, st.unit_price, st.subtotal,
+                   h.sale_date, '', h.payment_status, h.delivery_status,
+                   COALESCE(h.payment_method, ''), h.customer_name, COALESCE(h.seller_name, ''),
+                   COALESCE(st.notes, ''), %(now)s
+            FROM import_sales_stage st
+            JOIN (
+                SELECT DISTINCT ON (sale_number) * FROM import_sales_stage ORDER BY sale_number, line_no
+            ) h USING (sale_number)
+            ORDER BY st.line_no
+            """,
+            {"now": now_str},
+        )
+
+
+# === Bank Reconciliation Functions ===
+# Conciliación de cartolas: cada abono se compara con las ventas con saldo (sales.balance_due)
+# usando diccionarios en memoria por número de factura, RUT del cliente y monto, sin una
+# consulta por movimiento. Los candidatos se puntúan; los de alta confianza generan abonos
+# aprobados en sale_payment_items en una sola transacción y el resto queda en bank_movements
+# como 'Pendiente' para revisión (/ventas/conciliacion).
+
+BANK_STATEMENT_COLUMNS = ["date", "amount", "description", "reference", "rut", "invoice_number"]
+BANK_STATEMENT_REQUIRED_COLUMNS = ("date", "amount")
+BANK_MATCH_AUTO_SCORE = int(os.getenv("BANK_MATCH_AUTO_SCORE", "70"))
+BANK_MATCH_DATE_WINDOW = int(os.getenv("BANK_MATCH_DATE_WINDOW", "60"))  # días después del vencimiento
+BANK_MATCH_CANDIDATES = 5
+
+# Puntaje por coincidencia de factura, RUT, monto igual al saldo y fecha dentro de la ventana
+_BANK_SCORE_INVOICE = 50
+_BANK_SCORE_RUT = 30
+_BANK_SCORE_AMOUNT = 30
+_BANK_SCORE_DATE = 10
+# Puntaje mínimo para proponer un candidato y ventaja sobre el segundo para conciliar sin revisión
+_BANK_MIN_CANDIDATE_SCORE = 40
+_BANK_AUTO_MARGIN = 15
+
+_BANK_DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y")
+_BANK_RUT_RE = re.compile(r"\b(\d{1,2}\.?\d{3}\.?\d{3})-?[\dkK]\b")
+_BANK_NUMBER_RE = re.compile(r"\d{3,}")
+
+
+def _parse_bank_amount(value: str) -> float:
+    """Monto con formato chileno (1.234.567 o 1.234,50) o con punto decimal."""
+    text = re.sub(r"[^\d,.\-]", "", value or "")
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    elif re.fullmatch(r"-?\d{1,3}(\.\d{3})+", text):
+        text = text.replace(".", "")
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f"amount no es numérico: {value}")
+
+
+def _parse_bank_date(value: str):
+    for fmt in _BANK_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"date inválida: {value} (formato AAAA-MM-DD o DD-MM-AAAA)")
+
+
+def _invoice_key(value) -> str | None:
+    """Número de factura sólo con dígitos y sin ceros a la izquierda, para compararlo."""
+    key = re.sub(r"\D", "", str(value or "")).lstrip("0")
+    return key or None
+
+
+def _bank_movement_keys(movement: dict) -> None:
+    """Agrega al movimiento los RUT y números de factura con que se busca en los diccionarios."""
+    text = f"{movement['description']} {movement['reference']}"
+    ruts = set()
+    if movement["rut"]:
+        ruts.add(normalize_rut(movement["rut"].split("-")[0]))
+        if "-" not in movement["rut"]:
+            # Sin guion el DV puede venir pegado al número
+            ruts.add((normalize_rut(movement["rut"]) or "")[:-1])
+    ruts.update(match.group(1).replace(".", "") for match in _BANK_RUT_RE.finditer(text))
+    invoices = {_invoice_key(movement["invoice_number"])}
+    invoices.update(_invoice_key(number) for number in _BANK_NUMBER_RE.findall(_BANK_RUT_RE.sub(" ", text)))
+    movement["ruts"] = ruts - {None, ""}
+    movement["invoices"] = invoices - {None}
+
+
+def _open_sales_for_matching(cur) -> list[dict]:
+    """Ventas con saldo por cobrar, con su factura, vencimiento y RUT del cliente."""
+    cur.execute(
+        f"""
+        SELECT s.id, s.sale_number, s.customer_name, s.sale_ts::date AS sale_day,
+               COALESCE(sp.invoice_due_on, s.sale_ts::date) AS due_on, sp.invoice_number,
+               s.balance_due, c.rut_normalized
+        FROM sales s
+        LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+        LEFT JOIN (
+            SELECT DISTINCT ON (LOWER(TRIM(razon_social))) LOWER(TRIM(razon_social)) AS name_key, rut_normalized
+            FROM clients
+            ORDER BY LOWER(TRIM(razon_social)), id
+        ) c ON c.name_key = LOWER(TRIM(s.customer_name))
+        WHERE {_RECEIVABLES_OPEN_SQL}
+          AND s.balance_due > 0.005
+        """
+    )
+    sales = [dict(row) for row in cur.fetchall()]
+    for sale in sales:
+        sale["invoice_key"] = _invoice_key(sale["invoice_number"])
+    return sales
+
+
+def _match_bank_movements(movements: list[dict], open_sales: list[dict]) -> None:
+    """Puntúa los candidatos de cada movimiento y deja en movement['match'] la venta conciliable.
+
+    Los movimientos se recorren por fecha y cada conciliación descuenta el saldo de la venta,
+    así dos abonos de la misma cartola no pagan dos veces el mismo saldo.
+    """
+    by_invoice, by_rut, by_amount = {}, {}, {}
+    remaining = {}
+    for sale in open_sales:
+        remaining[sale["id"]] = sale["balance_due"]
+        if sale["invoice_key"]:
+            by_invoice.setdefault(sale["invoice_key"], []).append(sale)
+        if sale["rut_normalized"]:
+            by_rut.setdefault(sale["rut_normalized"], []).append(sale)
+        by_amount.setdefault(round(sale["balance_due"]), []).append(sale)
+
+    window = timedelta(days=BANK_MATCH_DATE_WINDOW)
+    for movement in sorted(movements, key=lambda m: (m["date"], m["line"])):
+        amount = movement["amount"]
+        found = {}
+        for key in movement["invoices"]:
+            found.update((sale["id"], sale) for sale in by_invoice.get(key, ()))
+        for key in movement["ruts"]:
+            found.update((sale["id"], sale) for sale in by_rut.get(key, ()))
+        for key in (round(amount) - 1, round(amount), round(amount) + 1):
+            found.update((sale["id"], sale) for sale in by_amount.get(key, ()))
+
+        scored = []
+        for sale in found.values():
+            balance = remaining[sale["id"]]
+            if balance <= 0.005:
+                continue
+            score = 0
+            if sale["invoice_key"] in movement["invoices"]:
+                score += _BANK_SCORE_INVOICE
+            if sale["rut_normalized"] in movement["ruts"]:
+                score += _BANK_SCORE_RUT
+            if abs(amount - balance) < 1:
+                score += _BANK_SCORE_AMOUNT
+            if sale["sale_day"] and sale["sale_day"] <= movement["date"] <= max(sale["due_on"], sale["sale_day"]) + window:
+                score += _BANK_SCORE_DATE
+            if score >= _BANK_MIN_CANDIDATE_SCORE:
+                scored.append((score, sale, balance))
+        scored.sort(key=lambda candidate: (-candidate[0], candidate[1]["id"]))
+
+        movement["score"] = scored[0][0] if scored else None
+        movement["candidates"] = [
+            {
+                "sale_id": sale["id"], "sale_number": sale["sale_number"], "customer_name": sale["customer_name"],
+                "invoice_number": sale["invoice_number"], "balance_due": round(balance, 2), "score": score,
+            }
+            for score, sale, balance in scored[:BANK_MATCH_CANDIDATES]
+        ]
+        movement["match"] = None
+        if scored:
+            score, sale, balance = scored[0]
+            unique = len(scored) == 1 or score - scored[1][0] >= _BANK_AUTO_MARGIN
+            if score >= BANK_MATCH_AUTO_SCORE and unique and amount <= balance + 1:
+                movement["match"] = sale
+                remaining[sale["id"]] = balance - amount
+
+
+def _bank_match_detail(amount: float, movement_date, label: str, line_no: int) -> str:
+    return f"Abono de ${amount:,.0f} del {movement_date.isoformat()} conciliado con {label} (línea {line_no}).".replace(",", ".")
+
+
+def _apply_bank_matches(cur, matches: list[dict], user_name: str, now_str: str) -> int:
+    """Crea los abonos aprobados de los movimientos conciliados, con una sentencia por tabla.
+
+    matches: dicts con movement_id, sale_id, amount, date y detail. Las ventas que quedan sin
+    saldo pasan a 'Pagado' y 'Completada' (con historial y descuento de stock). Devuelve
+    cuántas ventas quedaron pagadas.
+    """
+    if not matches:
+        return 0
+    # Un solo INSERT (page_size) para que el trigger de saldos corra una vez por lote
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO sale_payment_items (
+            sale_id, payment_amount, payment_date, created_at, accounting_approved,
+            accounting_approved_by, accounting_approved_at, accounting_comment, bank_movement_id
+        ) VALUES %s
+        """,
+        [
+            (m["sale_id"], m["amount"], m["date"].isoformat(), now_str, 1, user_name, now_str, m["detail"], m["movement_id"])
+            for m in matches
+        ],
+        page_size=len(matches),
+    )
+    # Como al registrar o aprobar un pago: la venta pagada pasa a Completada
+    cur.execute(
+        """
+        WITH target AS (
+            SELECT id, status AS old_status FROM sales
+            WHERE id IN (SELECT unnest(%s::int[]))
+              AND balance_due <= 0.005
+              AND payment_status IS DISTINCT FROM 'Pagado'
+            ORDER BY id
+            FOR UPDATE
+        )
+        UPDATE sales s SET payment_status = 'Pagado', status = 'Completada'
+        FROM target t
+        WHERE s.id = t.id
+        RETURNING s.id, t.old_status
+        """,
+        (sorted({m["sale_id"] for m in matches}),),
+    )
+    paid = sorted(cur.fetchall(), key=lambda row: row["id"])
+    completed = [row["id"] for row in paid if row["old_status"] != "Completada"]
+    changed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if paid:
+        cur.execute(
+            "UPDATE sale_payments SET status = 'Pagado', updated_at = %s WHERE sale_id IN (SELECT unnest(%s::int[]))",
+            (now_str, [row["id"] for row in paid]),
+        )
+    if completed:
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO sales_status_history (sale_id, status, user_name, changed_at, comment) VALUES %s",
+            [
+                (sale_id, "Completada", f"Sistema (Conciliación por {user_name})", changed_at,
+                 "Estado cambiado automáticamente a Completada tras conciliación bancaria")
+                for sale_id in completed
+            ],
+            page_size=len(completed),
+        )
+        # Las ventas que pasan a Completada descuentan stock
+        for sale_id in completed:
+            _sync_sale_stock(cur, sale_id)
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO sales_payment_history (sale_id, action, user_name, changed_at, details) VALUES %s",
+        [(m["sale_id"], "Pago Conciliado", user_name, changed_at, m["detail"]) for m in matches],
+        page_size=len(matches),
+    )
+    publish_cache_invalidation(cur, "income_report")
+    return len(paid)
+
+
+def import_bank_statement(stream, file_name: str | None = None, user_name: str = "Sistema",
+                          dry_run: bool = False) -> dict:
+    """Importa una cartola bancaria en CSV y concilia sus abonos contra las ventas con saldo.
+
+    Columnas: date y amount obligatorias; description, reference, rut e invoice_number
+    opcionales (el RUT y los números de factura también se buscan en la glosa y la referencia).
+    Los montos negativos (cargos) se ignoran y los movimientos ya importados se omiten.
+    Con dry_run informa qué se conciliaría sin guardar nada.
+    """
+    reader = csv.DictReader(stream)
+    missing = [col for col in BANK_STATEMENT_REQUIRED_COLUMNS if col not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"El archivo no tiene las columnas obligatorias: {', '.join(missing)}")
+
+    movements = []
+    rejected = []
+    rejected_count = 0
+    ignored = 0
+    total_rows = 0
+    occurrences: dict[str, int] = {}
+    for line_no, row in enumerate(reader, start=2):
+        total_rows += 1
+        values = {col: (row.get(col) or "").strip() for col in BANK_STATEMENT_COLUMNS}
+        try:
+            movement_date = _parse_bank_date(values["date"])
+            amount = _parse_bank_amount(values["amount"])
+        except ValueError as e:
+            rejected_count += 1
+            if len(rejected) < IMPORT_REJECTED_DETAIL_LIMIT:
+                rejected.append({"line": line_no, "error": str(e)})
+            continue
+        if amount <= 0:
+            ignored += 1
+            continue
+        # Dos movimientos idénticos en la misma cartola se distinguen por su número de aparición
+        base = "|".join([movement_date.isoformat(), f"{amount:.2f}", values["description"], values["reference"]])
+        occurrences[base] = occurrences.get(base, 0) + 1
+        movement = {
+            **values,
+            "line": line_no,
+            "date": movement_date,
+            "amount": amount,
+            "fingerprint": hashlib.sha1(f"{base}|{occurrences[base]}".encode("utf-8")).hexdigest(),
         }
-        return insert_client(new_client)
+        _bank_movement_keys(movement)
+        movements.append(movement)
+
+    now_str = datetime.utcnow().isoformat(timespec="seconds")
+    label = f"la cartola {file_name}" if file_name else "la cartola"
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Una importación o revisión a la vez, para no conciliar dos veces el mismo movimiento
+            cur.execute("LOCK TABLE bank_movements IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute(
+                "SELECT fingerprint FROM bank_movements WHERE fingerprint = ANY(%s)",
+                ([m["fingerprint"] for m in movements],),
+            )
+            existing = {row["fingerprint"] for row in cur.fetchall()}
+            new = [m for m in movements if m["fingerprint"] not in existing]
+            _match_bank_movements(new, _open_sales_for_matching(cur) if new else [])
+            matched = [m for m in new if m["match"]]
+
+            cur.execute(
+                """
+                INSERT INTO bank_statement_imports (file_name, imported_by, imported_at, movements, matched)
+                VALUES (%s, %s, %s, %s, %s) RETURNING id
+                """,
+                (file_name, user_name, now_str, len(new), len(matched)),
+            )
+            import_id = cur.fetchone()["id"]
+            ids = {}
+            if new:
+                rows = psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO bank_movements (
+                        import_id, line_no, movement_date, amount, description, reference, rut,
+                        invoice_number, fingerprint, status, sale_id, score, candidates, resolved_by, resolved_at
+                    ) VALUES %s
+                    RETURNING id, fingerprint
+                    """,
+                    [
+                        (
+                            import_id, m["line"], m["date"], m["amount"], m["description"] or None,
+                            m["reference"] or None, m["rut"] or None, m["invoice_number"] or None, m["fingerprint"],
+                            "Conciliado" if m["match"] else "Pendiente", m["match"]["id"] if m["match"] else None,
+                            m["score"], json.dumps(m["candidates"], ensure_ascii=False),
+                            user_name if m["match"] else None, now_str if m["match"] else None,
+                        )
+                        for m in new
+                    ],
+                    page_size=1000,
+                    fetch=True,
+                )
+                ids = {row["fingerprint"]: row["id"] for row in rows}
+            paid_sales = _apply_bank_matches(
+                cur,
+                [
+                    {
+                        "movement_id": ids[m["fingerprint"]], "sale_id": m["match"]["id"], "amount": m["amount"],
+                        "date": m["date"], "detail": _bank_match_detail(m["amount"], m["date"], label, m["line"]),
+                    }
+                    for m in matched
+                ],
+                user_name,
+                now_str,
+            )
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+
+    return {
+        "dry_run": dry_run,
+        "import_id": None if dry_run else import_id,
+        "total_rows": total_rows,
+        "movements": len(new),
+        "duplicates": len(movements) - len(new),
+        "ignored": ignored,
+        "matched": len(matched),
+        "matched_amount": round(sum(m["amount"] for m in matched), 2),
+        "paid_sales": paid_sales,
+        "pending": len(new) - len(matched),
+        "rejected_rows": rejected_count,
+        "rejected": rejected,
+    }
+
+
+def list_pending_bank_movements(limit: int = 200) -> dict:
+    """Movimientos por revisar, del más antiguo al más reciente, con sus candidatos."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS total FROM bank_movements WHERE status = 'Pendiente'")
+            total = cur.fetchone()["total"]
+            cur.execute(
+                """
+                SELECT m.id, m.line_no, m.movement_date, m.amount, m.description, m.reference, m.rut,
+                       m.invoice_number, m.score, m.candidates, i.file_name
+                FROM bank_movements m
+                JOIN bank_statement_imports i ON i.id = m.import_id
+                WHERE m.status = 'Pendiente'
+                ORDER BY m.movement_date, m.id
+                LIMIT %s
+                """,
+                (min(max(1, int(limit)), 1000),),
+            )
+            items = [dict(row) for row in cur.fetchall()]
+    return {"items": items, "total": total}
+
 
+def confirm_bank_movement(movement_id: int, sale_number: str, user_name: str) -> dict:
+    """Concilia a mano un movimiento pendiente con la venta indicada (abono aprobado)."""
+    now_str = datetime.utcnow().isoformat(timespec="seconds")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT m.id, m.line_no, m.movement_date, m.amount, m.status, m.import_id, i.file_name
+                FROM bank_movements m
+                JOIN bank_statement_imports i ON i.id = m.import_id
+                WHERE m.id = %s
+                FOR UPDATE OF m
+                """,
+                (movement_id,),
+            )
+            movement = cur.fetchone()
+            if not movement:
+                raise ValueError("Movimiento bancario no encontrado.")
+            if movement["status"] != "Pendiente":
+                raise ValueError("El movimiento ya fue revisado.")
+            cur.execute(
+                f"""
+                SELECT s.id, s.sale_number, s.balance_due, ({_RECEIVABLES_OPEN_SQL}) AS is_open
+                FROM sales s
+                WHERE s.sale_number = %s
+                FOR UPDATE
+                """,
+                ((sale_number or "").strip(),),
+            )
+            sale = cur.fetchone()
+            if not sale:
+                raise ValueError(f"No existe la venta {sale_number}.")
+            if not sale["is_open"] or sale["balance_due"] <= 0.005:
+                raise ValueError(f"La venta {sale['sale_number']} no tiene saldo por cobrar.")
+            if movement["amount"] > sale["balance_due"] + 1:
+                raise ValueError(
+                    f"El monto del movimiento supera el saldo de la venta {sale['sale_number']} "
+                    f"(${sale['balance_due']:,.0f}).".replace(",", ".")
+                )
 
+            label = f"la cartola {movement['file_name']}" if movement["file_name"] else "la cartola"
+            paid_sales = _apply_bank_matches(
+                cur,
+                [{
+                    "movement_id": movement["id"], "sale_id": sale["id"], "amount": movement["amount"],
+                    "date": movement["movement_date"],
+                    "detail": _bank_match_detail(movement["amount"], movement["movement_date"], label, movement["line_no"]),
+                }],
+                user_name,
+                now_str,
+            )
+            cur.execute(
+                """
+                UPDATE bank_movements SET status = 'Conciliado', sale_id = %s, resolved_by = %s, resolved_at = %s
+                WHERE id = %s
+                """,
+                (sale["id"], user_name, now_str, movement["id"]),
+            )
+            cur.execute(
+                "UPDATE bank_statement_imports SET matched = matched + 1 WHERE id = %s",
+                (movement["import_id"],),
+            )
+        conn.commit()
+    return {"sale_number": sale["sale_number"], "paid": bool(paid_sales)}
 
 
+def discard_bank_movement(movement_id: int, user_name: str) -> None:
+    """Saca un movimiento de la cola de revisión sin registrar pago (p. ej. un abono que no es de ventas)."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE bank_movements SET status = 'Descartado', resolved_by = %s, resolved_at = %s
+                WHERE id = %s AND status = 'Pendiente'
+                """,
+                (user_name, datetime.utcnow().isoformat(timespec="seconds"), movement_id),
+            )
+            if not cur.rowcount:
+                raise ValueError("El movimiento no existe o ya fue revisado.")
+        conn.commit()
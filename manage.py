@@ -0,0 +1,159 @@
+"""Comandos de mantenimiento de la base de datos.
+
+Uso:
+    python manage.py migrate   # aplica migraciones pendientes y datos por defecto
+    python manage.py status    # muestra la versión del esquema
+    python manage.py rebuild-rollups  # recalcula los resúmenes de ventas
+    python manage.py rebuild-prices   # recalcula la matriz de precios
+    python manage.py rebuild-costs [--check]  # recalcula (o sólo verifica) el costo promedio móvil
+    python manage.py rebuild-balances [--check]  # recalcula (o sólo verifica) los saldos de ventas y clientes
+    python manage.py import-sales archivo.csv [--dry-run] [--registro]  # importa ventas históricas
+    python manage.py import-bank cartola.csv [--dry-run]  # concilia una cartola bancaria con las ventas
+"""
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()  # Cargar variables del archivo .env local
+
+import db
+
+
+def cmd_migrate(args) -> int:
+    applied = db.apply_migrations()
+    for migration in applied:
+        print(f"Aplicada {migration['version']:04d}_{migration['name']}")
+    if not applied:
+        print("El esquema ya está actualizado.")
+    db.seed_data_if_empty()
+    print(f"Versión actual del esquema: {db.get_schema_version()}")
+    return 0
+
+
+def cmd_status(args) -> int:
+    current = db.get_schema_version()
+    print(f"Versión registrada: {current}")
+    for migration in db.list_migrations():
+        state = "aplicada" if migration["version"] <= current else "pendiente"
+        print(f"  {migration['version']:04d}_{migration['name']} ({state})")
+    return 0 if current >= db.latest_schema_version() else 1
+
+
+def cmd_rebuild_rollups(args) -> int:
+    db.rebuild_sales_rollups()
+    print("Resúmenes de ventas recalculados.")
+    return 0
+
+
+def cmd_rebuild_prices(args) -> int:
+    db.refresh_price_matrix()
+    print("Matriz de precios recalculada.")
+    return 0
+
+
+def cmd_rebuild_costs(args) -> int:
+    differences = db.rebuild_product_cost(check_only=args.check)
+    for diff in differences:
+        print(
+            f"  {diff['sku']}: costo {diff['stored_avg_cost']} -> {diff['expected_avg_cost']}, "
+            f"cantidad {diff['stored_quantity']} -> {diff['expected_quantity']}"
+        )
+    if args.check:
+        print("product_cost coincide con el libro de movimientos." if not differences
+              else f"{len(differences)} SKU con diferencias.")
+        return 1 if differences else 0
+    print(f"Costo promedio recalculado ({len(differences)} SKU corregidos).")
+    return 0
+
+
+def cmd_rebuild_balances(args) -> int:
+    differences = db.rebuild_sale_balances(check_only=args.check)
+    for diff in differences["sales"]:
+        print(f"  Venta {diff['sale_number']}: pagado {diff['stored_paid_total']} -> {diff['expected_paid_total']}")
+    for diff in differences["clients"]:
+        print(
+            f"  Cliente {diff['customer_name']}: saldo {diff['stored_balance_due']} -> {diff['expected_balance_due']}, "
+            f"ventas abiertas {diff['stored_open_sales']} -> {diff['expected_open_sales']}"
+        )
+    count = len(differences["sales"]) + len(differences["clients"])
+    if args.check:
+        print("Los saldos coinciden con los pagos registrados." if not count
+              else f"{len(differences['sales'])} ventas y {len(differences['clients'])} clientes con diferencias.")
+        return 1 if count else 0
+    print(f"Saldos recalculados ({len(differences['sales'])} ventas y {len(differences['clients'])} clientes corregidos).")
+    return 0
+
+
+def cmd_import_sales(args) -> int:
+    try:
+        with open(args.archivo, encoding="utf-8-sig", newline="") as stream:
+            summary = db.import_sales_csv(stream, dry_run=args.dry_run, with_entries=args.registro)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    for item in summary["rejected"]:
+        print(f"  línea {item['line']} ({item['sale_number']}): {item['error']}")
+    if summary["rejected_rows"] > len(summary["rejected"]):
+        print(f"  ... y {summary['rejected_rows'] - len(summary['rejected'])} filas rechazadas más")
+    action = "Se importarían" if args.dry_run else "Importadas"
+    print(
+        f"{action} {summary['imported_sales']} ventas ({summary['imported_rows']} líneas) "
+        f"de {summary['total_rows']} filas; {summary['rejected_rows']} rechazadas."
+    )
+    return 1 if summary["rejected_rows"] else 0
+
+
+def cmd_import_bank(args) -> int:
+    try:
+        with open(args.archivo, encoding="utf-8-sig", newline="") as stream:
+            summary = db.import_bank_statement(stream, file_name=os.path.basename(args.archivo), dry_run=args.dry_run)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    for item in summary["rejected"]:
+        print(f"  Línea {item['line']}: {item['error']}")
+    prefix = "Se conciliarían" if args.dry_run else "Conciliados"
+    amount = f"{summary['matched_amount']:,.0f}".replace(",", ".")
+    print(
+        f"{prefix} {summary['matched']} de {summary['movements']} abonos nuevos "
+        f"(${amount}, {summary['paid_sales']} ventas pagadas); "
+        f"{summary['pending']} por revisar, {summary['duplicates']} ya importados, "
+        f"{summary['ignored']} cargos ignorados, {summary['rejected_rows']} filas rechazadas."
+    )
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Comandos de mantenimiento de la base de datos")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("migrate", help="Aplicar migraciones pendientes").set_defaults(func=cmd_migrate)
+    subparsers.add_parser("status", help="Mostrar la versión del esquema").set_defaults(func=cmd_status)
+    subparsers.add_parser("rebuild-rollups", help="Recalcular los resúmenes de ventas").set_defaults(func=cmd_rebuild_rollups)
+    subparsers.add_parser("rebuild-prices", help="Recalcular la matriz de precios").set_defaults(func=cmd_rebuild_prices)
+    costs = subparsers.add_parser("rebuild-costs", help="Recalcular el costo promedio móvil desde el libro de movimientos")
+    costs.add_argument("--check", action="store_true", help="Sólo informar diferencias, sin modificar")
+    costs.set_defaults(func=cmd_rebuild_costs)
+
+    balances = subparsers.add_parser("rebuild-balances", help="Recalcular lo pagado y el saldo de ventas y clientes")
+    balances.add_argument("--check", action="store_true", help="Sólo informar diferencias, sin modificar")
+    balances.set_defaults(func=cmd_rebuild_balances)
+
+    imports = subparsers.add_parser("import-sales", help="Importar ventas históricas desde un CSV")
+    imports.add_argument("archivo", help="CSV con una fila por línea de producto")
+    imports.add_argument("--dry-run", action="store_true", help="Sólo validar e informar las filas rechazadas")
+    imports.add_argument("--registro", action="store_true", help="Agregar también las líneas a sales_entries (/ingreso-ventas)")
+    imports.set_defaults(func=cmd_import_sales)
+
+    bank = subparsers.add_parser("import-bank", help="Importar una cartola bancaria y conciliar sus abonos")
+    bank.add_argument("archivo", help="CSV con una fila por movimiento")
+    bank.add_argument("--dry-run", action="store_true", help="Sólo informar qué se conciliaría")
+    bank.set_defaults(func=cmd_import_bank)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
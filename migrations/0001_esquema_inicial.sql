@@ -0,0 +1,328 @@
+-- Esquema base del sistema (equivalente al antiguo init_db).
+-- Idempotente: puede aplicarse sobre bases de datos que ya tenían las tablas.
+
+CREATE TABLE IF NOT EXISTS page_data (
+    key TEXT PRIMARY KEY,
+    json TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sales_entries (
+    id SERIAL PRIMARY KEY,
+    sku TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    unit_price DOUBLE PRECISION NOT NULL,
+    total_price DOUBLE PRECISION NOT NULL,
+    sale_date TEXT NOT NULL,
+    delivery_date TEXT,
+    payment_status TEXT NOT NULL,
+    delivery_status TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    customer_name TEXT NOT NULL,
+    seller_name TEXT NOT NULL,
+    notes TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS products (
+    id SERIAL PRIMARY KEY,
+    sku TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    description TEXT,
+    photo_url TEXT,
+    barcode TEXT,
+    internal_code TEXT,
+    category TEXT,
+    expiry_date TEXT,
+    width_cm DOUBLE PRECISION,
+    height_cm DOUBLE PRECISION,
+    depth_cm DOUBLE PRECISION,
+    weight_kg DOUBLE PRECISION,
+    created_at TEXT NOT NULL
+);
+ALTER TABLE products ADD COLUMN IF NOT EXISTS barcode TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS internal_code TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS category TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS expiry_date TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS product_type TEXT DEFAULT 'Final';
+ALTER TABLE products ADD COLUMN IF NOT EXISTS cost DOUBLE PRECISION DEFAULT 0.0;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS is_deleted BOOLEAN DEFAULT FALSE;
+
+CREATE TABLE IF NOT EXISTS roles (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    description TEXT,
+    permissions TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    role_id INTEGER NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (role_id) REFERENCES roles(id)
+);
+
+CREATE TABLE IF NOT EXISTS sales (
+    id SERIAL PRIMARY KEY,
+    sale_number TEXT NOT NULL UNIQUE,
+    customer_name TEXT NOT NULL,
+    customer_email TEXT,
+    customer_initials TEXT,
+    sale_date TEXT NOT NULL,
+    sale_time TEXT NOT NULL,
+    products_json TEXT NOT NULL,
+    total_amount DOUBLE PRECISION NOT NULL,
+    status TEXT NOT NULL,
+    seller_name TEXT NOT NULL,
+    seller_initials TEXT,
+    payment_method TEXT,
+    payment_status TEXT,
+    delivery_status TEXT,
+    notes TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sale_payments (
+    id SERIAL PRIMARY KEY,
+    sale_id INTEGER NOT NULL UNIQUE,
+    invoice_number TEXT,
+    invoice_amount DOUBLE PRECISION,
+    invoice_due_date TEXT,
+    invoice_file TEXT,
+    payment_proof_file TEXT,
+    payment_amount DOUBLE PRECISION,
+    payment_date TEXT,
+    seller_uploaded_at TEXT,
+    payment_uploaded_at TEXT,
+    accounting_approved INTEGER DEFAULT 0,
+    accounting_approved_by TEXT,
+    accounting_approved_at TEXT,
+    accounting_comment TEXT,
+    status TEXT NOT NULL DEFAULT 'Factura pendiente',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    FOREIGN KEY (sale_id) REFERENCES sales(id)
+);
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS invoice_number TEXT;
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS accounting_comment TEXT;
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS invoice_due_date TEXT;
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS payment_date TEXT;
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS invoice_amount DOUBLE PRECISION;
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS payment_amount DOUBLE PRECISION;
+
+CREATE TABLE IF NOT EXISTS sale_payment_items (
+    id SERIAL PRIMARY KEY,
+    sale_id INTEGER NOT NULL,
+    payment_amount DOUBLE PRECISION NOT NULL,
+    payment_date TEXT,
+    payment_proof_file TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (sale_id) REFERENCES sales(id)
+);
+-- Migrar pagos únicos antiguos a ítems de pago (sólo si la tabla está vacía)
+INSERT INTO sale_payment_items (sale_id, payment_amount, payment_date, payment_proof_file, created_at)
+SELECT sale_id, payment_amount, payment_date, payment_proof_file, created_at
+FROM sale_payments
+WHERE payment_amount IS NOT NULL AND payment_amount > 0
+  AND NOT EXISTS (SELECT 1 FROM sale_payment_items);
+ALTER TABLE sale_payment_items ADD COLUMN IF NOT EXISTS accounting_approved INTEGER DEFAULT 0;
+ALTER TABLE sale_payment_items ADD COLUMN IF NOT EXISTS accounting_approved_by TEXT;
+ALTER TABLE sale_payment_items ADD COLUMN IF NOT EXISTS accounting_approved_at TEXT;
+ALTER TABLE sale_payment_items ADD COLUMN IF NOT EXISTS accounting_comment TEXT;
+
+CREATE TABLE IF NOT EXISTS sales_status_history (
+    id SERIAL PRIMARY KEY,
+    sale_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    changed_at TEXT NOT NULL,
+    comment TEXT,
+    FOREIGN KEY (sale_id) REFERENCES sales(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS sales_payment_history (
+    id SERIAL PRIMARY KEY,
+    sale_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    changed_at TEXT NOT NULL,
+    details TEXT,
+    FOREIGN KEY (sale_id) REFERENCES sales(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS suppliers (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT,
+    website TEXT,
+    created_at TEXT NOT NULL
+);
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS rut TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS dv TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS razon_social TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS giro TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS direccion TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS comuna TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS ciudad TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS email TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS phone TEXT;
+ALTER TABLE suppliers ADD COLUMN IF NOT EXISTS tipo_compra TEXT;
+
+CREATE TABLE IF NOT EXISTS supplier_contacts (
+    id SERIAL PRIMARY KEY,
+    supplier_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    phone TEXT,
+    email TEXT,
+    position TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS product_suppliers (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    supplier_id INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
+    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE CASCADE,
+    UNIQUE(product_id, supplier_id)
+);
+
+CREATE TABLE IF NOT EXISTS purchase_orders (
+    id SERIAL PRIMARY KEY,
+    oc_number TEXT NOT NULL UNIQUE,
+    supplier_id INTEGER NOT NULL,
+    order_date TEXT NOT NULL,
+    status TEXT NOT NULL, -- 'Borrador', 'Emitida', 'Parcialmente Recibida', 'Recibida', 'Facturada'
+    total_amount DOUBLE PRECISION NOT NULL,
+    notes TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS purchase_order_items (
+    id SERIAL PRIMARY KEY,
+    purchase_order_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity_ordered INTEGER NOT NULL,
+    quantity_received INTEGER DEFAULT 0,
+    unit_price DOUBLE PRECISION NOT NULL,
+    total_price DOUBLE PRECISION NOT NULL,
+    FOREIGN KEY (purchase_order_id) REFERENCES purchase_orders(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS inventory_entries (
+    id SERIAL PRIMARY KEY,
+    entry_date TEXT NOT NULL,
+    order_number TEXT NOT NULL,
+    purchase_order_id INTEGER,
+    supplier_id INTEGER NOT NULL,
+    warehouse TEXT NOT NULL,
+    notes TEXT,
+    total_amount DOUBLE PRECISION NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (purchase_order_id) REFERENCES purchase_orders(id) ON DELETE SET NULL,
+    FOREIGN KEY (supplier_id) REFERENCES suppliers(id) ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS inventory_entry_items (
+    id SERIAL PRIMARY KEY,
+    inventory_entry_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    unit_price DOUBLE PRECISION NOT NULL,
+    total DOUBLE PRECISION NOT NULL,
+    FOREIGN KEY (inventory_entry_id) REFERENCES inventory_entries(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+ALTER TABLE inventory_entries ALTER COLUMN supplier_id DROP NOT NULL;
+
+ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS created_by INTEGER REFERENCES users(id) ON DELETE SET NULL;
+ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS approved_by INTEGER REFERENCES users(id) ON DELETE SET NULL;
+ALTER TABLE purchase_orders ADD COLUMN IF NOT EXISTS payment_method TEXT DEFAULT 'Efectivo';
+
+CREATE TABLE IF NOT EXISTS product_margins (
+    product_sku TEXT PRIMARY KEY,
+    base_margin DOUBLE PRECISION DEFAULT 20.0,
+    category_margins JSONB DEFAULT '{}'::jsonb
+);
+
+CREATE TABLE IF NOT EXISTS production_orders (
+    id SERIAL PRIMARY KEY,
+    ot_number TEXT NOT NULL UNIQUE,
+    final_product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    notes TEXT,
+    created_at TEXT NOT NULL,
+    approved_at TEXT,
+    completed_at TEXT,
+    FOREIGN KEY (final_product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+ALTER TABLE production_orders ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
+
+CREATE TABLE IF NOT EXISTS production_order_items (
+    id SERIAL PRIMARY KEY,
+    production_order_id INTEGER NOT NULL,
+    input_product_id INTEGER NOT NULL,
+    quantity_required DOUBLE PRECISION NOT NULL,
+    FOREIGN KEY (production_order_id) REFERENCES production_orders(id) ON DELETE CASCADE,
+    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS product_recipes (
+    id SERIAL PRIMARY KEY,
+    final_product_id INTEGER NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (final_product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS product_recipe_items (
+    id SERIAL PRIMARY KEY,
+    recipe_id INTEGER NOT NULL,
+    input_product_id INTEGER NOT NULL,
+    quantity_required DOUBLE PRECISION NOT NULL,
+    FOREIGN KEY (recipe_id) REFERENCES product_recipes(id) ON DELETE CASCADE,
+    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS production_order_additional_items (
+    id SERIAL PRIMARY KEY,
+    production_order_id INTEGER NOT NULL,
+    input_product_id INTEGER NOT NULL,
+    quantity DOUBLE PRECISION NOT NULL,
+    reason TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (production_order_id) REFERENCES production_orders(id) ON DELETE CASCADE,
+    FOREIGN KEY (input_product_id) REFERENCES products(id) ON DELETE RESTRICT
+);
+ALTER TABLE production_order_items ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
+ALTER TABLE production_order_additional_items ADD COLUMN IF NOT EXISTS unit_cost DOUBLE PRECISION;
+
+CREATE TABLE IF NOT EXISTS clients (
+    id SERIAL PRIMARY KEY,
+    rut VARCHAR(20),
+    dv VARCHAR(5),
+    razon_social VARCHAR(255) NOT NULL,
+    tipo_compra VARCHAR(100) DEFAULT 'Del Giro',
+    direccion TEXT,
+    comuna VARCHAR(100),
+    ciudad VARCHAR(100),
+    giro VARCHAR(255),
+    contacto VARCHAR(255),
+    rut_solicita VARCHAR(20),
+    dv_solicita VARCHAR(5),
+    email VARCHAR(255),
+    phone VARCHAR(50),
+    category_id VARCHAR(50),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+ALTER TABLE clients ALTER COLUMN category_id TYPE VARCHAR(50);
@@ -0,0 +1,31 @@
+-- Columnas de fecha tipadas (generadas) e índices para ordenar y filtrar por fecha
+-- sin castear el texto en cada consulta. Las columnas TEXT originales se mantienen
+-- porque la aplicación las sigue usando como texto ISO.
+
+-- Convierte texto ISO a timestamp; devuelve NULL si el valor no es una fecha válida.
+-- Se declara IMMUTABLE para poder usarse en columnas generadas: los valores se
+-- guardan siempre en formato ISO, que no depende de DateStyle.
+CREATE OR REPLACE FUNCTION text_to_timestamp(value TEXT) RETURNS TIMESTAMP
+LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+    IF value IS NULL OR btrim(value) IN ('', '-') THEN
+        RETURN NULL;
+    END IF;
+    RETURN btrim(value)::timestamp;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END
+$$;
+
+ALTER TABLE sales ADD COLUMN IF NOT EXISTS sale_ts TIMESTAMP
+    GENERATED ALWAYS AS (text_to_timestamp(sale_date || ' ' || sale_time)) STORED;
+CREATE INDEX IF NOT EXISTS idx_sales_sale_ts ON sales (sale_ts DESC NULLS LAST, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sales_status_sale_ts ON sales (status, sale_ts DESC NULLS LAST, id DESC);
+
+ALTER TABLE sale_payments ADD COLUMN IF NOT EXISTS invoice_due_on DATE
+    GENERATED ALWAYS AS (text_to_timestamp(invoice_due_date)::date) STORED;
+CREATE INDEX IF NOT EXISTS idx_sale_payments_invoice_due_on ON sale_payments (invoice_due_on);
+
+ALTER TABLE sales_entries ADD COLUMN IF NOT EXISTS created_ts TIMESTAMP
+    GENERATED ALWAYS AS (text_to_timestamp(created_at)) STORED;
+CREATE INDEX IF NOT EXISTS idx_sales_entries_created_ts ON sales_entries (created_ts DESC NULLS LAST, id DESC);
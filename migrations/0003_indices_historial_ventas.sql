@@ -0,0 +1,3 @@
+-- Índices para cargar el historial de varias ventas en una sola consulta (sale_id = ANY(...) ORDER BY id DESC)
+CREATE INDEX IF NOT EXISTS idx_sales_status_history_sale ON sales_status_history (sale_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sales_payment_history_sale ON sales_payment_history (sale_id, id DESC);
@@ -0,0 +1,48 @@
+-- Libro de movimientos de inventario y saldos por SKU, en reemplazo de page_data['inventory_items'].
+-- Cada cambio de stock inserta movimientos y suma al saldo con un UPDATE atómico por fila.
+
+CREATE TABLE IF NOT EXISTS inventory_movements (
+    id BIGSERIAL PRIMARY KEY,
+    sku TEXT NOT NULL,
+    quantity DOUBLE PRECISION NOT NULL,
+    movement_type TEXT NOT NULL,
+    reference_type TEXT,
+    reference_id INTEGER,
+    unit_cost DOUBLE PRECISION,
+    notes TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_inventory_movements_sku ON inventory_movements (sku, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_movements_reference ON inventory_movements (reference_type, reference_id);
+
+CREATE TABLE IF NOT EXISTS stock_balances (
+    sku TEXT PRIMARY KEY,
+    quantity DOUBLE PRECISION NOT NULL DEFAULT 0,
+    min_stock INTEGER NOT NULL DEFAULT 10,
+    price DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL
+);
+
+-- Saldos iniciales desde el JSON de inventario existente
+INSERT INTO stock_balances (sku, quantity, min_stock, price, updated_at)
+SELECT DISTINCT ON (item->>'code')
+       item->>'code',
+       COALESCE((item->>'stock')::double precision, 0),
+       COALESCE(round((item->>'min_stock')::numeric)::integer, 10),
+       COALESCE((item->>'price')::double precision, 0),
+       to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS')
+FROM page_data, jsonb_array_elements(page_data.json::jsonb) AS item
+WHERE page_data.key = 'inventory_items'
+  AND jsonb_typeof(page_data.json::jsonb) = 'array'
+  AND COALESCE(item->>'code', '') <> ''
+ORDER BY item->>'code'
+ON CONFLICT (sku) DO NOTHING;
+
+-- Un movimiento de saldo inicial por SKU para que el libro cuadre con los saldos
+INSERT INTO inventory_movements (sku, quantity, movement_type, notes, created_at)
+SELECT sb.sku, sb.quantity, 'saldo_inicial', 'Saldo migrado desde page_data', sb.updated_at
+FROM stock_balances sb
+WHERE sb.quantity <> 0
+  AND NOT EXISTS (SELECT 1 FROM inventory_movements im WHERE im.sku = sb.sku);
+
+DELETE FROM page_data WHERE key = 'inventory_items';
@@ -0,0 +1,104 @@
+"""Stock reservado por SKU mantenido de forma incremental (ventas pendientes y OTs aprobadas)."""
+import json
+import re
+
+# Copia congelada de la resolución de líneas de db.py al publicar esta migración: la
+# migración no debe cambiar de resultado cuando cambie el código de la aplicación.
+_SALE_PRODUCT_STR_RE = re.compile(r'^(.*?)\s*\((\d+)\)$')
+
+
+def _resolve_sale_product_lines(products: list, id_to_sku: dict, name_to_sku: dict) -> list[tuple[str, float]]:
+    """(sku, cantidad) de los productos de una venta, en formato dict o texto legado "Nombre (cantidad)"."""
+    def by_name(name):
+        if name in name_to_sku:
+            return name_to_sku[name]
+        for name_db, sku_db in name_to_sku.items():
+            if name_db in name or name in name_db:
+                return sku_db
+        return None
+
+    lines = []
+    for p in products or []:
+        sku, qty = None, 0
+        if isinstance(p, dict):
+            qty = p.get('quantity', 0) or 0
+            p_id = p.get('product_id')
+            p_name = (p.get('product_name') or '').strip().lower()
+            if p_id and p_id in id_to_sku:
+                sku = id_to_sku[p_id]
+            elif p_name:
+                sku = by_name(p_name)
+        elif isinstance(p, str):
+            match = _SALE_PRODUCT_STR_RE.match(p.strip())
+            if match:
+                qty = int(match.group(2))
+                sku = by_name(match.group(1).strip().lower())
+        if sku and qty > 0:
+            lines.append((sku, qty))
+    return lines
+
+
+def upgrade(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            reference_type TEXT NOT NULL,
+            reference_id INTEGER NOT NULL,
+            sku TEXT NOT NULL,
+            quantity DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (reference_type, reference_id, sku)
+        );
+        CREATE INDEX IF NOT EXISTS idx_stock_reservations_sku ON stock_reservations (sku);
+        ALTER TABLE stock_balances ADD COLUMN IF NOT EXISTS reserved DOUBLE PRECISION NOT NULL DEFAULT 0;
+        """
+    )
+
+    # Reservas de OTs aprobadas: insumos planificados más adicionales
+    cur.execute(
+        """
+        INSERT INTO stock_reservations (reference_type, reference_id, sku, quantity)
+        SELECT 'production_order', items.production_order_id, p.sku, SUM(items.quantity)
+        FROM (
+            SELECT production_order_id, input_product_id, quantity_required AS quantity FROM production_order_items
+            UNION ALL
+            SELECT production_order_id, input_product_id, quantity FROM production_order_additional_items
+        ) items
+        JOIN production_orders po ON po.id = items.production_order_id
+        JOIN products p ON p.id = items.input_product_id
+        WHERE po.status = 'Aprobada'
+        GROUP BY items.production_order_id, p.sku
+        ON CONFLICT DO NOTHING
+        """
+    )
+
+    # Reservas de ventas pendientes: las líneas se resuelven a SKU igual que en la aplicación
+    cur.execute("SELECT id, sku, name FROM products")
+    products = cur.fetchall()
+    id_to_sku = {row["id"]: row["sku"] for row in products}
+    name_to_sku = {row["name"].strip().lower(): row["sku"] for row in products}
+    cur.execute("SELECT id, products_json FROM sales WHERE status = 'Pendiente'")
+    rows = []
+    for sale in cur.fetchall():
+        totals = {}
+        for sku, qty in _resolve_sale_product_lines(json.loads(sale["products_json"] or "[]"), id_to_sku, name_to_sku):
+            totals[sku] = totals.get(sku, 0) + qty
+        rows.extend(("sale", sale["id"], sku, qty) for sku, qty in totals.items())
+    for row in rows:
+        cur.execute(
+            """
+            INSERT INTO stock_reservations (reference_type, reference_id, sku, quantity)
+            VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING
+            """,
+            row,
+        )
+
+    # Totales por SKU en stock_balances
+    cur.execute(
+        """
+        INSERT INTO stock_balances (sku, quantity, reserved, updated_at)
+        SELECT sku, 0, SUM(quantity), to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS')
+        FROM stock_reservations
+        GROUP BY sku
+        ON CONFLICT (sku) DO UPDATE SET reserved = EXCLUDED.reserved
+        """
+    )
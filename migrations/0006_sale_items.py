@@ -0,0 +1,115 @@
+"""Líneas de venta normalizadas en sale_items, con backfill desde sales.products_json."""
+import json
+import re
+
+import psycopg2.extras
+
+# Parser de products_json tal como estaba en db.py al publicar la migración (congelado aquí)
+_SALE_PRODUCT_STR_RE = re.compile(r'^(.*?)\s*\((\d+)\)$')
+
+
+def _match_product_sku(name: str, name_to_sku: dict) -> str | None:
+    """SKU por nombre exacto (en minúsculas) o, si no hay, por coincidencia parcial."""
+    if name in name_to_sku:
+        return name_to_sku[name]
+    for name_db, sku_db in name_to_sku.items():
+        if name_db in name or name in name_db:
+            return sku_db
+    return None
+
+
+def _parse_sale_product_lines(products: list, id_to_sku: dict, name_to_sku: dict) -> list[dict]:
+    """Líneas de sale_items a partir de products_json, en formato dict o texto legado "Nombre (cantidad)"."""
+    lines = []
+    for p in products or []:
+        sku, unit_price, discount, subtotal = None, None, 0.0, None
+        if isinstance(p, dict):
+            name = (p.get('product_name') or p.get('name') or '').strip()
+            qty = float(p.get('quantity', 0) or 0)
+            p_id = p.get('product_id')
+            if p_id and p_id in id_to_sku:
+                sku = id_to_sku[p_id]
+            elif name:
+                sku = _match_product_sku(name.lower(), name_to_sku)
+            price = p.get('price', p.get('unit_price'))
+            unit_price = float(price) if price not in (None, '') else None
+            discount = float(p.get('discount') or 0.0)
+            if p.get('subtotal') not in (None, ''):
+                subtotal = float(p['subtotal'])
+            elif unit_price is not None:
+                subtotal = round(qty * unit_price * (1.0 - discount / 100.0), 2)
+        elif isinstance(p, str):
+            match = _SALE_PRODUCT_STR_RE.match(p.strip())
+            if match:
+                name, qty = match.group(1).strip(), float(match.group(2))
+            else:
+                name, qty = p.split('(')[0].strip(), 1.0
+            sku = _match_product_sku(name.lower(), name_to_sku) if name else None
+        else:
+            continue
+        if (name or sku) and qty > 0:
+            lines.append({
+                "sku": sku,
+                "product_name": name or sku,
+                "quantity": qty,
+                "unit_price": unit_price,
+                "discount": discount,
+                "subtotal": subtotal,
+            })
+    return lines
+
+
+def upgrade(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sale_items (
+            id SERIAL PRIMARY KEY,
+            sale_id INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
+            line_no INTEGER NOT NULL,
+            product_id INTEGER REFERENCES products(id) ON DELETE SET NULL,
+            sku TEXT,
+            product_name TEXT NOT NULL,
+            quantity DOUBLE PRECISION NOT NULL,
+            unit_price DOUBLE PRECISION,
+            discount DOUBLE PRECISION NOT NULL DEFAULT 0,
+            subtotal DOUBLE PRECISION,
+            UNIQUE (sale_id, line_no)
+        );
+        CREATE INDEX IF NOT EXISTS idx_sale_items_product ON sale_items (product_id);
+        CREATE INDEX IF NOT EXISTS idx_sale_items_sku ON sale_items (sku);
+        """
+    )
+
+    cur.execute("SELECT id, sku, name FROM products")
+    products = cur.fetchall()
+    id_to_sku = {row["id"]: row["sku"] for row in products}
+    name_to_sku = {row["name"].strip().lower(): row["sku"] for row in products}
+    sku_to_id = {row["sku"]: row["id"] for row in products}
+
+    cur.execute(
+        """
+        SELECT s.id, s.products_json FROM sales s
+        WHERE NOT EXISTS (SELECT 1 FROM sale_items si WHERE si.sale_id = s.id)
+        ORDER BY s.id
+        """
+    )
+    rows = []
+    for sale in cur.fetchall():
+        try:
+            products_list = json.loads(sale["products_json"] or "[]")
+        except ValueError:
+            continue
+        for line_no, line in enumerate(_parse_sale_product_lines(products_list, id_to_sku, name_to_sku), start=1):
+            rows.append((
+                sale["id"], line_no, sku_to_id.get(line["sku"]), line["sku"], line["product_name"],
+                line["quantity"], line["unit_price"], line["discount"], line["subtotal"],
+            ))
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO sale_items (sale_id, line_no, product_id, sku, product_name, quantity, unit_price, discount, subtotal)
+        VALUES %s
+        """,
+        rows,
+        page_size=1000,
+    )
@@ -0,0 +1,84 @@
+-- Resúmenes de ventas precalculados para el dashboard y las tarjetas de /ventas.
+-- Un trigger sobre sales los mantiene al día en cada INSERT/UPDATE/DELETE, incluidas
+-- las actualizaciones directas de estado que hacen las rutas; rebuild_sales_rollups()
+-- los recalcula completos (python manage.py rebuild-rollups).
+
+-- Ventas por día, estado, vendedor y estado de pago. Las ventas sin fecha válida van al día -infinity.
+CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+    day DATE NOT NULL,
+    status TEXT NOT NULL,
+    seller_name TEXT NOT NULL,
+    payment_status TEXT NOT NULL,
+    sale_count INTEGER NOT NULL DEFAULT 0,
+    total_amount DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, status, seller_name, payment_status)
+);
+
+-- Cantidad de ventas por cliente, para contar clientes distintos sin recorrer sales
+CREATE TABLE IF NOT EXISTS sales_customer_rollup (
+    customer_name TEXT PRIMARY KEY,
+    sale_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION sales_rollup_add(r sales, sign INTEGER) RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO sales_daily_rollup AS d (day, status, seller_name, payment_status, sale_count, total_amount)
+    VALUES (
+        COALESCE(r.sale_ts::date, '-infinity'::date), COALESCE(r.status, ''), COALESCE(r.seller_name, ''),
+        COALESCE(r.payment_status, ''), sign, sign * COALESCE(r.total_amount, 0)
+    )
+    ON CONFLICT (day, status, seller_name, payment_status) DO UPDATE
+    SET sale_count = d.sale_count + EXCLUDED.sale_count,
+        total_amount = d.total_amount + EXCLUDED.total_amount;
+
+    IF r.customer_name IS NOT NULL THEN
+        INSERT INTO sales_customer_rollup AS c (customer_name, sale_count)
+        VALUES (r.customer_name, sign)
+        ON CONFLICT (customer_name) DO UPDATE SET sale_count = c.sale_count + EXCLUDED.sale_count;
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION sales_rollup_trigger() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM sales_rollup_add(OLD, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM sales_rollup_add(NEW, 1);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS trg_sales_rollup ON sales;
+CREATE TRIGGER trg_sales_rollup
+AFTER INSERT OR DELETE OR UPDATE OF sale_date, sale_time, status, seller_name, payment_status, total_amount, customer_name
+ON sales
+FOR EACH ROW EXECUTE FUNCTION sales_rollup_trigger();
+
+CREATE OR REPLACE FUNCTION rebuild_sales_rollups() RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Bloquea escrituras en sales mientras se recalcula para no perder cambios concurrentes
+    LOCK TABLE sales IN SHARE MODE;
+    DELETE FROM sales_daily_rollup;
+    DELETE FROM sales_customer_rollup;
+
+    INSERT INTO sales_daily_rollup (day, status, seller_name, payment_status, sale_count, total_amount)
+    SELECT COALESCE(sale_ts::date, '-infinity'::date), COALESCE(status, ''), COALESCE(seller_name, ''),
+           COALESCE(payment_status, ''), COUNT(*), COALESCE(SUM(total_amount), 0)
+    FROM sales
+    GROUP BY 1, 2, 3, 4;
+
+    INSERT INTO sales_customer_rollup (customer_name, sale_count)
+    SELECT customer_name, COUNT(*)
+    FROM sales
+    WHERE customer_name IS NOT NULL
+    GROUP BY customer_name;
+END
+$$;
+
+SELECT rebuild_sales_rollups();
@@ -0,0 +1,104 @@
+"""Matriz de precios por producto y categoría de cliente, calculada desde el VPP y los márgenes."""
+import json
+from datetime import datetime
+
+import psycopg2.extras
+
+# Cálculo de la matriz tal como se publicó esta migración (VPP de los ingresos); el de la
+# aplicación cambia después (0009 usa el costo promedio), así que no se importa de db.py.
+_DEFAULT_PRICE_LIST_CONFIG = {
+    "base_margin": 20.0,
+    "categories": [
+        {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
+        {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
+        {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
+        {"id": "cat_3", "name": "Categoría D", "margin": 20.0},
+    ],
+}
+
+
+def _load_price_list_config(cur) -> dict:
+    cur.execute("SELECT json FROM page_data WHERE key = 'price_list_config'")
+    row = cur.fetchone()
+    config = json.loads(row["json"]) if row else None
+    if not config or "categories" not in config:
+        return _DEFAULT_PRICE_LIST_CONFIG
+    return config
+
+
+def _load_product_vpp(cur) -> dict[int, float]:
+    """Valor promedio ponderado de compra por producto."""
+    cur.execute(
+        """
+        SELECT product_id, SUM(quantity) as total_qty, SUM(total) as total_spent
+        FROM inventory_entry_items
+        GROUP BY product_id
+        """
+    )
+    vpp_map = {}
+    for row in cur.fetchall():
+        qty = row["total_qty"] or 0
+        if qty > 0:
+            vpp_map[row["product_id"]] = (row["total_spent"] or 0.0) / qty
+    return vpp_map
+
+
+def _compute_price_rows(products: list[dict], vpp_map: dict, catalog_prices: dict, margins_map: dict, config: dict) -> list[tuple]:
+    """Filas (sku, category_id, vpp, margin, price) de la matriz para los productos dados."""
+    rows = []
+    for p in products:
+        sku = p["sku"]
+        vpp = vpp_map.get(p["id"])
+        if vpp is None:
+            vpp = catalog_prices.get(sku) or 0.0
+
+        m = margins_map.get(sku)
+        product_cat_margins = {}
+        if m:
+            base_margin = m["base_margin"]
+            product_cat_margins = m["category_margins"] or {}
+        else:
+            base_margin = config["base_margin"]
+
+        price_base = vpp * (1 + base_margin / 100)
+        rows.append((sku, "", vpp, base_margin, round(price_base, 2)))
+        for cat in config["categories"]:
+            margin = product_cat_margins.get(cat["id"])
+            if margin is None:
+                margin = cat["margin"]
+            rows.append((sku, cat["id"], vpp, margin, round(price_base * (1 + margin / 100), 2)))
+    return rows
+
+
+def upgrade(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS price_matrix (
+            sku TEXT NOT NULL,
+            category_id TEXT NOT NULL,
+            vpp DOUBLE PRECISION NOT NULL,
+            margin DOUBLE PRECISION NOT NULL,
+            price DOUBLE PRECISION NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (sku, category_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_inventory_entry_items_product ON inventory_entry_items (product_id);
+        """
+    )
+
+    cur.execute("SELECT id, sku FROM products WHERE (is_deleted = FALSE OR is_deleted IS NULL)")
+    products = cur.fetchall()
+    cur.execute("SELECT sku, price FROM stock_balances")
+    catalog_prices = {row["sku"]: row["price"] for row in cur.fetchall()}
+    cur.execute("SELECT product_sku, base_margin, category_margins FROM product_margins")
+    margins_map = {row["product_sku"]: row for row in cur.fetchall()}
+
+    rows = _compute_price_rows(products, _load_product_vpp(cur), catalog_prices, margins_map, _load_price_list_config(cur))
+    cur.execute("DELETE FROM price_matrix")
+    if rows:
+        now = datetime.utcnow().isoformat(timespec='seconds')
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO price_matrix (sku, category_id, vpp, margin, price, updated_at) VALUES %s",
+            [row + (now,) for row in rows],
+        )
@@ -0,0 +1,146 @@
+"""Costo promedio móvil por SKU en product_cost, recalculado desde el libro de movimientos."""
+import json
+from datetime import datetime
+
+import psycopg2.extras
+
+# El recálculo de costos y de la matriz de precios queda copiado aquí como estaba al
+# publicar la migración; las versiones de db.py pueden cambiar sin alterar este resultado.
+_DEFAULT_PRICE_LIST_CONFIG = {
+    "base_margin": 20.0,
+    "categories": [
+        {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
+        {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
+        {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
+        {"id": "cat_3", "name": "Categoría D", "margin": 20.0},
+    ],
+}
+
+
+def _apply_cost_movement(state: dict, quantity: float, unit_cost: float | None) -> None:
+    """Aplica un movimiento al costo promedio móvil de un SKU.
+
+    Las entradas con costo se promedian con el saldo (o fijan el costo si no hay saldo
+    o aún no hay costo); las salidas y entradas sin costo mueven el saldo al costo vigente.
+    """
+    new_quantity = state["quantity"] + quantity
+    if quantity > 0 and unit_cost is not None:
+        if state["quantity"] <= 0 or state["avg_cost"] is None or new_quantity <= 0:
+            state["avg_cost"] = float(unit_cost)
+            state["total_value"] = new_quantity * float(unit_cost)
+        else:
+            state["total_value"] += quantity * float(unit_cost)
+            state["avg_cost"] = state["total_value"] / new_quantity
+    else:
+        state["total_value"] = new_quantity * (state["avg_cost"] or 0.0)
+    state["quantity"] = new_quantity
+
+
+def _replay_product_costs(cur) -> dict[str, dict]:
+    """Recalcula el costo promedio móvil de cada SKU recorriendo todo el libro de movimientos."""
+    states: dict[str, dict] = {}
+    cur.execute("SELECT sku, quantity, unit_cost FROM inventory_movements ORDER BY id")
+    for row in cur.fetchall():
+        state = states.setdefault(row["sku"], {"sku": row["sku"], "quantity": 0.0, "total_value": 0.0, "avg_cost": None})
+        _apply_cost_movement(state, float(row["quantity"]), row["unit_cost"])
+    return states
+
+
+def _refresh_price_matrix(cur) -> None:
+    """Recalcula toda la price_matrix valorizando cada producto a su costo promedio."""
+    cur.execute("SELECT json FROM page_data WHERE key = 'price_list_config'")
+    row = cur.fetchone()
+    config = json.loads(row["json"]) if row else None
+    if not config or "categories" not in config:
+        config = _DEFAULT_PRICE_LIST_CONFIG
+
+    cur.execute("SELECT id, sku FROM products WHERE (is_deleted = FALSE OR is_deleted IS NULL)")
+    products = cur.fetchall()
+    cur.execute(
+        """
+        SELECT p.id, pc.avg_cost
+        FROM product_cost pc
+        JOIN products p ON p.sku = pc.sku
+        WHERE pc.avg_cost IS NOT NULL
+        """
+    )
+    vpp_map = {row["id"]: row["avg_cost"] for row in cur.fetchall()}
+    cur.execute("SELECT sku, price FROM stock_balances")
+    catalog_prices = {row["sku"]: row["price"] for row in cur.fetchall()}
+    cur.execute("SELECT product_sku, base_margin, category_margins FROM product_margins")
+    margins_map = {row["product_sku"]: row for row in cur.fetchall()}
+
+    rows = []
+    for p in products:
+        sku = p["sku"]
+        vpp = vpp_map.get(p["id"])
+        if vpp is None:
+            vpp = catalog_prices.get(sku) or 0.0
+
+        m = margins_map.get(sku)
+        product_cat_margins = {}
+        if m:
+            base_margin = m["base_margin"]
+            product_cat_margins = m["category_margins"] or {}
+        else:
+            base_margin = config["base_margin"]
+
+        price_base = vpp * (1 + base_margin / 100)
+        rows.append((sku, "", vpp, base_margin, round(price_base, 2)))
+        for cat in config["categories"]:
+            margin = product_cat_margins.get(cat["id"])
+            if margin is None:
+                margin = cat["margin"]
+            rows.append((sku, cat["id"], vpp, margin, round(price_base * (1 + margin / 100), 2)))
+
+    cur.execute("DELETE FROM price_matrix")
+    if rows:
+        now = datetime.utcnow().isoformat(timespec='seconds')
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO price_matrix (sku, category_id, vpp, margin, price, updated_at) VALUES %s",
+            [row + (now,) for row in rows],
+        )
+
+
+def upgrade(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS product_cost (
+            sku TEXT PRIMARY KEY,
+            quantity DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+            avg_cost DOUBLE PRECISION,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+
+    # Los saldos iniciales se valorizan al promedio histórico de los ingresos del producto
+    cur.execute(
+        """
+        UPDATE inventory_movements m
+        SET unit_cost = h.vpp
+        FROM (
+            SELECT p.sku, SUM(iei.total) / NULLIF(SUM(iei.quantity), 0) AS vpp
+            FROM inventory_entry_items iei
+            JOIN products p ON p.id = iei.product_id
+            GROUP BY p.sku
+        ) h
+        WHERE m.sku = h.sku AND m.movement_type = 'saldo_inicial'
+          AND m.unit_cost IS NULL AND h.vpp IS NOT NULL
+        """
+    )
+
+    states = _replay_product_costs(cur)
+    now_str = datetime.utcnow().isoformat(timespec='seconds')
+    if states:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO product_cost (sku, quantity, total_value, avg_cost, updated_at) VALUES %s
+            ON CONFLICT (sku) DO NOTHING
+            """,
+            [(sku, st["quantity"], st["total_value"], st["avg_cost"], now_str) for sku, st in states.items()],
+        )
+    _refresh_price_matrix(cur)
@@ -0,0 +1,51 @@
+-- RUT normalizado (sin puntos, guiones ni espacios, en mayúsculas) para buscar clientes por índice.
+ALTER TABLE clients ADD COLUMN IF NOT EXISTS rut_normalized TEXT
+    GENERATED ALWAYS AS (NULLIF(upper(regexp_replace(COALESCE(rut, ''), '[^0-9A-Za-z]', '', 'g')), '')) STORED;
+
+-- Fusionar clientes con el mismo RUT: se conserva el más antiguo y cada campo toma el
+-- valor no vacío más reciente, igual que una actualización por RUT.
+WITH merged AS (
+    SELECT rut_normalized,
+           MIN(id) AS keep_id,
+           (array_agg(rut ORDER BY id DESC))[1] AS rut,
+           (array_agg(dv ORDER BY id DESC) FILTER (WHERE COALESCE(dv, '') <> ''))[1] AS dv,
+           (array_agg(razon_social ORDER BY id DESC) FILTER (WHERE COALESCE(razon_social, '') <> ''))[1] AS razon_social,
+           (array_agg(tipo_compra ORDER BY id DESC) FILTER (WHERE COALESCE(tipo_compra, '') <> ''))[1] AS tipo_compra,
+           (array_agg(direccion ORDER BY id DESC) FILTER (WHERE COALESCE(direccion, '') <> ''))[1] AS direccion,
+           (array_agg(comuna ORDER BY id DESC) FILTER (WHERE COALESCE(comuna, '') <> ''))[1] AS comuna,
+           (array_agg(ciudad ORDER BY id DESC) FILTER (WHERE COALESCE(ciudad, '') <> ''))[1] AS ciudad,
+           (array_agg(giro ORDER BY id DESC) FILTER (WHERE COALESCE(giro, '') <> ''))[1] AS giro,
+           (array_agg(contacto ORDER BY id DESC) FILTER (WHERE COALESCE(contacto, '') <> ''))[1] AS contacto,
+           (array_agg(rut_solicita ORDER BY id DESC) FILTER (WHERE COALESCE(rut_solicita, '') <> ''))[1] AS rut_solicita,
+           (array_agg(dv_solicita ORDER BY id DESC) FILTER (WHERE COALESCE(dv_solicita, '') <> ''))[1] AS dv_solicita,
+           (array_agg(email ORDER BY id DESC) FILTER (WHERE COALESCE(email, '') <> ''))[1] AS email,
+           (array_agg(phone ORDER BY id DESC) FILTER (WHERE COALESCE(phone, '') <> ''))[1] AS phone,
+           (array_agg(category_id ORDER BY id DESC) FILTER (WHERE COALESCE(category_id, '') <> ''))[1] AS category_id
+    FROM clients
+    WHERE rut_normalized IS NOT NULL
+    GROUP BY rut_normalized
+    HAVING COUNT(*) > 1
+)
+UPDATE clients c
+SET rut = m.rut,
+    dv = COALESCE(m.dv, c.dv),
+    razon_social = COALESCE(m.razon_social, c.razon_social),
+    tipo_compra = COALESCE(m.tipo_compra, c.tipo_compra),
+    direccion = COALESCE(m.direccion, c.direccion),
+    comuna = COALESCE(m.comuna, c.comuna),
+    ciudad = COALESCE(m.ciudad, c.ciudad),
+    giro = COALESCE(m.giro, c.giro),
+    contacto = COALESCE(m.contacto, c.contacto),
+    rut_solicita = COALESCE(m.rut_solicita, c.rut_solicita),
+    dv_solicita = COALESCE(m.dv_solicita, c.dv_solicita),
+    email = COALESCE(m.email, c.email),
+    phone = COALESCE(m.phone, c.phone),
+    category_id = COALESCE(m.category_id, c.category_id)
+FROM merged m
+WHERE c.id = m.keep_id;
+
+DELETE FROM clients c
+USING clients k
+WHERE c.rut_normalized = k.rut_normalized AND c.id > k.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_rut_normalized ON clients (rut_normalized);
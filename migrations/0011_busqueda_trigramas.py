@@ -0,0 +1,31 @@
+"""Índices GIN de trigramas (pg_trgm) para la búsqueda de ventas, clientes, productos y proveedores.
+
+Si la extensión no está disponible en el servidor, la migración sólo la omite y la
+búsqueda usa el ordenamiento en Python de db.search.
+"""
+import psycopg2
+
+TRIGRAM_INDEXES = [
+    ("idx_sales_sale_number_trgm", "sales", "sale_number"),
+    ("idx_sales_customer_name_trgm", "sales", "customer_name"),
+    ("idx_clients_razon_social_trgm", "clients", "razon_social"),
+    ("idx_clients_rut_normalized_trgm", "clients", "rut_normalized"),
+    ("idx_products_name_trgm", "products", "name"),
+    ("idx_products_sku_trgm", "products", "sku"),
+    ("idx_products_barcode_trgm", "products", "barcode"),
+    ("idx_suppliers_name_trgm", "suppliers", "name"),
+    ("idx_suppliers_razon_social_trgm", "suppliers", "razon_social"),
+]
+
+
+def upgrade(cur):
+    cur.execute("SAVEPOINT pg_trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT pg_trgm")
+        return
+    cur.execute("RELEASE SAVEPOINT pg_trgm")
+
+    for index_name, table, column in TRIGRAM_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} USING gin ({column} gin_trgm_ops)")
@@ -0,0 +1,9 @@
+-- Ventas con saldo por cobrar: el informe de antigüedad recorre sólo este índice parcial
+-- (el mismo predicado que _RECEIVABLES_OPEN_SQL en db.py) y no todas las ventas.
+CREATE INDEX IF NOT EXISTS idx_sales_open_receivables ON sales (id)
+    WHERE status NOT IN ('Cancelada', 'Cancelado', 'Cotización', 'Borrador')
+      AND COALESCE(payment_status, 'Pendiente') <> 'Pagado';
+
+-- Abonos por venta, para sumar lo pagado sin leer la tabla
+CREATE INDEX IF NOT EXISTS idx_sale_payment_items_sale ON sale_payment_items (sale_id)
+    INCLUDE (payment_amount, accounting_approved);
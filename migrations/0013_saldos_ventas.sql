@@ -0,0 +1,178 @@
+-- Saldos precalculados: lo pagado y el saldo de cada venta (sales.paid_total / balance_due)
+-- y el saldo abierto de cada cliente (client_balances). Triggers por sentencia sobre
+-- sale_payment_items, sale_payments y sales los mantienen en la misma transacción que el
+-- pago o la aprobación, incluidas las actualizaciones directas que hacen las rutas;
+-- python manage.py rebuild-balances --check recalcula y reporta diferencias.
+
+ALTER TABLE sales ADD COLUMN IF NOT EXISTS paid_total DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE sales ADD COLUMN IF NOT EXISTS balance_due DOUBLE PRECISION
+    GENERATED ALWAYS AS (ROUND((COALESCE(total_amount, 0) - paid_total)::numeric, 2)::double precision) STORED;
+
+-- Saldo de las ventas vigentes no pagadas de cada cliente (el mismo criterio que
+-- _RECEIVABLES_OPEN_SQL en db.py más balance_due > 0)
+CREATE TABLE IF NOT EXISTS client_balances (
+    customer_name TEXT PRIMARY KEY,
+    open_sales INTEGER NOT NULL DEFAULT 0,
+    balance_due DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- Pagado de cada venta: la suma de abonos aprobados o, si es mayor, el pago único aprobado
+-- de sale_payments (el flujo de aprobación de /ventas sólo marca ese registro).
+-- Con p_ids NULL calcula todas las ventas.
+CREATE OR REPLACE FUNCTION sales_paid_totals(p_ids INTEGER[] DEFAULT NULL)
+RETURNS TABLE (sale_id INTEGER, paid_total DOUBLE PRECISION)
+LANGUAGE sql STABLE AS $$
+    SELECT s.id,
+           GREATEST(
+               COALESCE(items.approved, 0),
+               CASE WHEN sp.accounting_approved = 1 THEN COALESCE(sp.payment_amount, 0) ELSE 0 END
+           )
+    -- Join con los ids desanidados: "s.id = ANY(p_ids)" es cuadrático en sentencias grandes
+    FROM (SELECT DISTINCT unnest(COALESCE(p_ids, ARRAY(SELECT id FROM sales))) AS id) ids
+    JOIN sales s ON s.id = ids.id
+    LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+    LEFT JOIN LATERAL (
+        SELECT SUM(spi.payment_amount) AS approved FROM sale_payment_items spi
+        WHERE spi.sale_id = s.id AND spi.accounting_approved = 1
+    ) items ON TRUE
+$$;
+
+CREATE OR REPLACE FUNCTION refresh_sales_paid_total(p_ids INTEGER[]) RETURNS VOID
+LANGUAGE sql AS $$
+    UPDATE sales s SET paid_total = t.paid_total
+    FROM sales_paid_totals(p_ids) t
+    WHERE s.id = t.sale_id AND s.paid_total IS DISTINCT FROM t.paid_total;
+$$;
+
+-- Recalcula una sola vez por sentencia las ventas tocadas (sirve para sale_payment_items y sale_payments)
+CREATE OR REPLACE FUNCTION sales_paid_total_trigger() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    ids INTEGER[] := '{}';
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        ids := ids || ARRAY(SELECT DISTINCT sale_id FROM old_rows);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        ids := ids || ARRAY(SELECT DISTINCT sale_id FROM new_rows);
+    END IF;
+    PERFORM refresh_sales_paid_total(ids);
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS trg_sale_payment_items_paid_ins ON sale_payment_items;
+DROP TRIGGER IF EXISTS trg_sale_payment_items_paid_upd ON sale_payment_items;
+DROP TRIGGER IF EXISTS trg_sale_payment_items_paid_del ON sale_payment_items;
+CREATE TRIGGER trg_sale_payment_items_paid_ins AFTER INSERT ON sale_payment_items
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+CREATE TRIGGER trg_sale_payment_items_paid_upd AFTER UPDATE ON sale_payment_items
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+CREATE TRIGGER trg_sale_payment_items_paid_del AFTER DELETE ON sale_payment_items
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+
+DROP TRIGGER IF EXISTS trg_sale_payments_paid_ins ON sale_payments;
+DROP TRIGGER IF EXISTS trg_sale_payments_paid_upd ON sale_payments;
+DROP TRIGGER IF EXISTS trg_sale_payments_paid_del ON sale_payments;
+CREATE TRIGGER trg_sale_payments_paid_ins AFTER INSERT ON sale_payments
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+CREATE TRIGGER trg_sale_payments_paid_upd AFTER UPDATE ON sale_payments
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+CREATE TRIGGER trg_sale_payments_paid_del AFTER DELETE ON sale_payments
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION sales_paid_total_trigger();
+
+-- Aporte de una venta a client_balances: sólo las vigentes, no pagadas y con saldo
+CREATE OR REPLACE FUNCTION sale_counts_in_client_balance(status TEXT, payment_status TEXT, balance_due DOUBLE PRECISION)
+RETURNS BOOLEAN LANGUAGE sql IMMUTABLE AS $$
+    SELECT status NOT IN ('Cancelada', 'Cancelado', 'Cotización', 'Borrador')
+       AND COALESCE(payment_status, 'Pendiente') <> 'Pagado'
+       AND balance_due > 0.005
+$$;
+
+-- Suma a client_balances las diferencias (cliente, ventas abiertas, saldo), en orden de
+-- cliente para que dos transacciones concurrentes no se bloqueen mutuamente
+CREATE OR REPLACE FUNCTION client_balances_apply(p_names TEXT[], p_counts INTEGER[], p_amounts DOUBLE PRECISION[])
+RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO client_balances AS c (customer_name, open_sales, balance_due, updated_at)
+    SELECT d.customer_name, SUM(d.open_sales), SUM(d.balance_due), now()
+    FROM unnest(p_names, p_counts, p_amounts) AS d (customer_name, open_sales, balance_due)
+    WHERE d.customer_name IS NOT NULL
+    GROUP BY d.customer_name
+    ORDER BY d.customer_name
+    ON CONFLICT (customer_name) DO UPDATE
+    SET open_sales = c.open_sales + EXCLUDED.open_sales,
+        balance_due = ROUND((c.balance_due + EXCLUDED.balance_due)::numeric, 2)::double precision,
+        updated_at = EXCLUDED.updated_at;
+$$;
+
+-- Aplica a client_balances la diferencia entre las filas de sales antes y después de la sentencia
+CREATE OR REPLACE FUNCTION client_balances_trigger() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    names TEXT[];
+    counts INTEGER[];
+    amounts DOUBLE PRECISION[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(customer_name), array_agg(1), array_agg(balance_due)
+        INTO names, counts, amounts
+        FROM new_rows
+        WHERE sale_counts_in_client_balance(status, payment_status, balance_due);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(customer_name), array_agg(-1), array_agg(-balance_due)
+        INTO names, counts, amounts
+        FROM old_rows
+        WHERE sale_counts_in_client_balance(status, payment_status, balance_due);
+    ELSE
+        -- Sólo las ventas cuyo aporte cambió (cliente, estado, estado de pago o saldo)
+        SELECT array_agg(d.customer_name), array_agg(d.open_sales), array_agg(d.balance_due)
+        INTO names, counts, amounts
+        FROM old_rows o
+        JOIN new_rows n ON n.id = o.id
+        CROSS JOIN LATERAL (VALUES
+            (o.customer_name, -1, -o.balance_due, sale_counts_in_client_balance(o.status, o.payment_status, o.balance_due)),
+            (n.customer_name, 1, n.balance_due, sale_counts_in_client_balance(n.status, n.payment_status, n.balance_due))
+        ) AS d (customer_name, open_sales, balance_due, counts)
+        WHERE d.counts
+          AND (o.customer_name, o.status, o.payment_status, o.balance_due)
+              IS DISTINCT FROM (n.customer_name, n.status, n.payment_status, n.balance_due);
+    END IF;
+    IF names IS NOT NULL THEN
+        PERFORM client_balances_apply(names, counts, amounts);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION rebuild_client_balances() RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Bloquea escrituras en sales mientras se recalcula para no perder cambios concurrentes
+    LOCK TABLE sales IN SHARE MODE;
+    DELETE FROM client_balances;
+    INSERT INTO client_balances (customer_name, open_sales, balance_due)
+    SELECT customer_name, COUNT(*), ROUND(SUM(balance_due)::numeric, 2)::double precision
+    FROM sales
+    WHERE customer_name IS NOT NULL
+      AND sale_counts_in_client_balance(status, payment_status, balance_due)
+    GROUP BY customer_name;
+END
+$$;
+
+-- Carga inicial antes de crear los triggers de sales, para no aplicar la diferencia fila a fila
+UPDATE sales s SET paid_total = t.paid_total
+FROM sales_paid_totals() t
+WHERE s.id = t.sale_id AND s.paid_total IS DISTINCT FROM t.paid_total;
+
+SELECT rebuild_client_balances();
+
+DROP TRIGGER IF EXISTS trg_sales_client_balances_ins ON sales;
+DROP TRIGGER IF EXISTS trg_sales_client_balances_upd ON sales;
+DROP TRIGGER IF EXISTS trg_sales_client_balances_del ON sales;
+CREATE TRIGGER trg_sales_client_balances_ins AFTER INSERT ON sales
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION client_balances_trigger();
+CREATE TRIGGER trg_sales_client_balances_upd AFTER UPDATE ON sales
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION client_balances_trigger();
+CREATE TRIGGER trg_sales_client_balances_del AFTER DELETE ON sales
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION client_balances_trigger();
@@ -0,0 +1,38 @@
+-- Cartolas bancarias importadas y sus movimientos (abonos). Los que se concilian con una
+-- venta generan un abono aprobado en sale_payment_items (bank_movement_id); el resto queda
+-- 'Pendiente' para revisión en /ventas/conciliacion.
+CREATE TABLE IF NOT EXISTS bank_statement_imports (
+    id SERIAL PRIMARY KEY,
+    file_name TEXT,
+    imported_by TEXT,
+    imported_at TEXT NOT NULL,
+    movements INTEGER NOT NULL DEFAULT 0,
+    matched INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS bank_movements (
+    id SERIAL PRIMARY KEY,
+    import_id INTEGER NOT NULL REFERENCES bank_statement_imports(id) ON DELETE CASCADE,
+    line_no INTEGER NOT NULL,
+    movement_date DATE NOT NULL,
+    amount DOUBLE PRECISION NOT NULL,
+    description TEXT,
+    reference TEXT,
+    rut TEXT,
+    invoice_number TEXT,
+    -- Huella de fecha, monto, glosa y referencia: reimportar la misma cartola no duplica movimientos
+    fingerprint TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'Pendiente',  -- Pendiente, Conciliado, Descartado
+    sale_id INTEGER REFERENCES sales(id) ON DELETE SET NULL,
+    score INTEGER,
+    candidates JSONB NOT NULL DEFAULT '[]',
+    resolved_by TEXT,
+    resolved_at TEXT
+);
+
+-- Cola de revisión: sólo los movimientos pendientes
+CREATE INDEX IF NOT EXISTS idx_bank_movements_pending ON bank_movements (movement_date, id)
+    WHERE status = 'Pendiente';
+
+ALTER TABLE sale_payment_items ADD COLUMN IF NOT EXISTS bank_movement_id INTEGER
+    REFERENCES bank_movements(id) ON DELETE SET NULL;
@@ -0,0 +1,4 @@
+-- Cola de aprobación de pagos: las ventas 'Pendiente Aprobación Pago' se leen de este índice
+-- parcial, en el orden de la cola, sin recorrer todas las ventas.
+CREATE INDEX IF NOT EXISTS idx_sales_pending_payment_approval ON sales (sale_ts, id)
+    WHERE payment_status = 'Pendiente Aprobación Pago';
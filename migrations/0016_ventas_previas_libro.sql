@@ -0,0 +1,27 @@
+-- Ventas Completadas anteriores al libro de inventario (0004): su salida ya estaba descontada
+-- del saldo migrado, pero no tienen movimientos 'sale', así que _sync_sale_stock las volvía a
+-- descontar en el siguiente cambio de estado, edición o pago. Se registra por venta y SKU la
+-- salida ('venta', referencia sale) junto a una entrada 'saldo_inicial' que la compensa:
+-- el saldo por SKU no cambia y el libro queda cuadrado con lo ya descontado.
+INSERT INTO inventory_movements (sku, quantity, movement_type, reference_type, reference_id, notes, created_at)
+SELECT m.sku, m.quantity, m.movement_type, m.reference_type, m.reference_id,
+       'Venta ' || t.sale_number || ' anterior al libro de inventario (ya descontada del saldo)',
+       to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS')
+FROM (
+    SELECT s.id AS sale_id, s.sale_number, si.sku, SUM(si.quantity) AS quantity
+    FROM sales s
+    JOIN sale_items si ON si.sale_id = s.id
+    WHERE s.status = 'Completada'
+      AND si.sku IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM inventory_movements im
+          WHERE im.reference_type = 'sale' AND im.reference_id = s.id
+      )
+    GROUP BY s.id, s.sale_number, si.sku
+    HAVING SUM(si.quantity) <> 0
+) t
+CROSS JOIN LATERAL (VALUES
+    (1, t.sku, t.quantity, 'saldo_inicial', NULL, NULL::integer),
+    (2, t.sku, -t.quantity, 'venta', 'sale', t.sale_id)
+) AS m (ord, sku, quantity, movement_type, reference_type, reference_id)
+ORDER BY t.sale_id, t.sku, m.ord;
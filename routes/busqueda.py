@@ -0,0 +1,17 @@
+from flask import Blueprint, request, jsonify
+from db import search, SEARCH_TYPES
+
+busqueda_bp = Blueprint('busqueda', __name__)
+
+@busqueda_bp.route('/api/buscar')
+def api_buscar():
+    """Búsqueda tolerante a errores sobre ventas, clientes, productos y proveedores (?q=&tipo=)"""
+    query = request.args.get('q', '').strip()
+    tipo = request.args.get('tipo', '').strip()
+    if tipo and tipo not in SEARCH_TYPES:
+        return jsonify({"error": f"Tipo inválido. Opciones: {', '.join(SEARCH_TYPES)}"}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify({
+        "query": query,
+        "results": search(query, [tipo] if tipo else None, limit)
+    })
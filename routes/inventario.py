@@ -18,7 +18,8 @@ from db import (
     rename_category,
     delete_category,
     set_page_data,
-    list_sales
+    list_stock_balances,
+    update_stock_min
 )
 
 inventario_bp = Blueprint('inventario', __name__)
@@ -43,107 +44,19 @@ def uploaded_file(filename):
 @inventario_bp.route('/inventario')
 def inventario():
     """Módulo de Inventario"""
-    import re
     inventory_stats = get_page_data("inventory_stats") or {"total": 0, "low_stock": 0, "total_value": 0.0}
-    inventory_items = get_page_data("inventory_items") or []
+    inventory_items = list_stock_balances()
     inventory_categories = get_page_data("inventory_categories")
     inventory_stock_filters = get_page_data("inventory_stock_filters")
-    
-    # 1. Obtener todas las ventas pendientes
-    pending_sales = list_sales({"status": "Pendiente"})
-    
-    # 2. Cargar todos los productos para mapeo ID -> SKU y Nombre -> SKU
-    products_db = list_products()
-    id_to_sku = {p['id']: p['sku'] for p in products_db}
-    name_to_sku = {p['name'].strip().lower(): p['sku'] for p in products_db}
-    
-    # 3. Calcular stock reservado por SKU
-    reserved_by_sku = {}
-    for sale in pending_sales:
-        for p in sale.get('products', []):
-            qty = 0
-            sku = None
-            if isinstance(p, dict):
-                qty = p.get('quantity', 0)
-                p_id = p.get('product_id')
-                p_name = p.get('product_name', '')
-                if p_id and p_id in id_to_sku:
-                    sku = id_to_sku[p_id]
-                elif p_name:
-                    p_name_clean = p_name.strip().lower()
-                    if p_name_clean in name_to_sku:
-                        sku = name_to_sku[p_name_clean]
-                    else:
-                        for name_db, sku_db in name_to_sku.items():
-                            if name_db in p_name_clean or p_name_clean in name_db:
-                                sku = sku_db
-                                break
-            elif isinstance(p, str):
-                match = re.match(r'^(.*?)\s*\((\d+)\)$', p.strip())
-                if match:
-                    p_name = match.group(1).strip().lower()
-                    qty = int(match.group(2))
-                    if p_name in name_to_sku:
-                        sku = name_to_sku[p_name]
-                    else:
-                        for name_db, sku_db in name_to_sku.items():
-                            if name_db in p_name or p_name in name_db:
-                                sku = sku_db
-                                break
-            
-            if sku and qty > 0:
-                reserved_by_sku[sku] = reserved_by_sku.get(sku, 0) + qty
-
-    # 3.5. Obtener insumos reservados de OTs activas (Aprobadas)
-    from db import get_connection
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            # 3.5.1 Insumos iniciales planificados en OTs Aprobadas
-            cur.execute(
-                """
-                SELECT poi.quantity_required, p.sku
-                FROM production_order_items poi
-                JOIN production_orders po ON poi.production_order_id = po.id
-                JOIN products p ON poi.input_product_id = p.id
-                WHERE po.status = 'Aprobada'
-                """
-            )
-            for row in cur.fetchall():
-                sku = row["sku"]
-                qty = row["quantity_required"]
-                reserved_by_sku[sku] = reserved_by_sku.get(sku, 0) + qty
-
-            # 3.5.2 Insumos adicionales sumados en OTs Aprobadas
-            cur.execute(
-                """
-                SELECT poai.quantity, p.sku
-                FROM production_order_additional_items poai
-                JOIN production_orders po ON poai.production_order_id = po.id
-                JOIN products p ON poai.input_product_id = p.id
-                WHERE po.status = 'Aprobada'
-                """
-            )
-            for row in cur.fetchall():
-                sku = row["sku"]
-                qty = row["quantity"]
-                reserved_by_sku[sku] = reserved_by_sku.get(sku, 0) + qty
 
-    # 4. Aumentar cada ítem del inventario con su stock reservado y total
+    # Reservado, total y estado vienen calculados desde stock_balances
     low_stock_count = 0
     for item in inventory_items:
-        sku = item.get("code")
-        reserved = reserved_by_sku.get(sku, 0)
-        item["reserved"] = reserved
-        item["total_stock"] = item["stock"] + reserved
-        
-        min_stock = item.get("min_stock", 10)
-        if item["total_stock"] <= min_stock:
-            item["status"] = "Stock Bajo"
+        for field in ("stock", "reserved", "total_stock"):
+            if float(item[field]).is_integer():
+                item[field] = int(item[field])
+        if item["status"] == "Stock Bajo":
             low_stock_count += 1
-        else:
-            item["status"] = "Normal"
-            
-        item["stock_percent"] = min(100, int((item["total_stock"] / max(1, item["stock"] + 100)) * 100))
 
     inventory_stats["low_stock"] = low_stock_count
     
@@ -416,22 +329,13 @@ def productos_por_proveedor(supplier_id):
 
 @inventario_bp.route('/inventario/producto/<string:code>/min-stock', methods=['POST'])
 def update_product_min_stock(code):
-    """Actualiza el stock mínimo de un producto en el JSON de inventario"""
+    """Actualiza el stock mínimo de un producto en su saldo de inventario"""
     new_min = request.form.get('min_stock', type=int)
     if new_min is None or new_min < 0:
         flash("Valor de stock mínimo no válido.", "danger")
         return redirect(url_for('inventario.inventario'))
         
-    items = get_page_data("inventory_items") or []
-    updated = False
-    for item in items:
-        if item.get("code") == code:
-            item["min_stock"] = new_min
-            updated = True
-            break
-            
-    if updated:
-        set_page_data("inventory_items", items)
+    if update_stock_min(code, new_min):
         flash(f"Stock mínimo del producto {code} actualizado a {new_min} correctamente.", "success")
     else:
         flash("Producto no encontrado en el inventario.", "danger")
@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from datetime import datetime
 import json
-from db import get_connection, get_page_data, set_page_data, list_products
+from db import get_connection, get_page_data, list_products, _post_inventory_movements, ensure_stock_balance, get_stock_map, _sync_production_order_stock
 
 produccion_bp = Blueprint('produccion', __name__)
 
@@ -198,21 +198,8 @@ def crear_producto_rapido():
 
         product_id = insert_product(product)
         
-        # También ingresarlo a inventory_items con stock 0
-        inventory_items = get_page_data("inventory_items") or []
-        if not any(item["code"] == sku for item in inventory_items):
-            inventory_items.append({
-                "code": sku,
-                "name": name,
-                "desc": product["description"],
-                "category": category,
-                "stock": 0.0,
-                "min_stock": 10,
-                "price": 0.0,
-                "status": "Normal",
-                "stock_percent": 100
-            })
-            set_page_data("inventory_items", inventory_items)
+        # También crear su saldo de inventario con stock 0
+        ensure_stock_balance(sku)
             
         return jsonify({
             "status": "ok",
@@ -242,6 +229,7 @@ def aprobar_ot(ot_id):
                 """,
                 (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), ot_id)
             )
+            _sync_production_order_stock(cur, ot_id)
         conn.commit()
     flash("Orden de Trabajo aprobada y stock de insumos reservado.", "success")
     return redirect(url_for('produccion.list_ots'))
@@ -268,88 +256,85 @@ def finalizar_ot(ot_id):
                 flash("La Orden de Trabajo no se encuentra aprobada o no existe.", "danger")
                 return redirect(url_for('produccion.list_ots'))
                 
-            # 2. Cargar insumos requeridos
+            # 2. Cargar insumos requeridos (costo promedio móvil, o el de ficha si aún no tiene)
             cur.execute(
                 """
-                SELECT poi.id, poi.quantity_required, p.sku as input_sku, p.cost as input_cost
+                SELECT poi.id, poi.quantity_required, p.sku as input_sku,
+                       COALESCE(pc.avg_cost, p.cost) as input_cost
                 FROM production_order_items poi
                 JOIN products p ON poi.input_product_id = p.id
+                LEFT JOIN product_cost pc ON pc.sku = p.sku
                 WHERE poi.production_order_id = %s
                 """,
                 (ot_id,)
             )
             items = cur.fetchall()
             
-            # 3. Descontar stock e incrementar stock en inventory_items
-            inventory_items = get_page_data("inventory_items") or []
-            
-            # Mapear inventario por código para facilitar acceso
-            inv_map = {item["code"]: item for item in inventory_items}
-            
+            # 3. Descontar insumos e ingresar el producto terminado como movimientos de inventario
             total_manufacturing_cost = 0.0
+            movements = []
             
             # Descontar insumos planificados
             for item in items:
-                sku = item["input_sku"]
                 qty = item["quantity_required"]
-                if sku in inv_map:
-                    # Rebaja física definitiva
-                    inv_map[sku]["stock"] = max(0.0, inv_map[sku]["stock"] - qty)
-                    cost_unit = float(item["input_cost"] or 0.0)
-                    total_manufacturing_cost += cost_unit * qty
-                    # Registrar costo histórico
-                    cur.execute(
-                        "UPDATE production_order_items SET unit_cost = %s WHERE id = %s",
-                        (cost_unit, item["id"])
-                    )
+                cost_unit = float(item["input_cost"] or 0.0)
+                total_manufacturing_cost += cost_unit * qty
+                movements.append({
+                    "sku": item["input_sku"],
+                    "quantity": -qty,
+                    "movement_type": "consumo_ot",
+                    "reference_type": "production_order",
+                    "reference_id": ot_id,
+                    "unit_cost": cost_unit,
+                })
+                # Registrar costo histórico
+                cur.execute(
+                    "UPDATE production_order_items SET unit_cost = %s WHERE id = %s",
+                    (cost_unit, item["id"])
+                )
                     
             # Descontar insumos adicionales
             cur.execute(
                 """
-                SELECT poai.id, poai.quantity, p.sku as input_sku, p.cost as input_cost
+                SELECT poai.id, poai.quantity, p.sku as input_sku,
+                       COALESCE(pc.avg_cost, p.cost) as input_cost
                 FROM production_order_additional_items poai
                 JOIN products p ON poai.input_product_id = p.id
+                LEFT JOIN product_cost pc ON pc.sku = p.sku
                 WHERE poai.production_order_id = %s
                 """,
                 (ot_id,)
             )
             add_items = cur.fetchall()
             for item in add_items:
-                sku = item["input_sku"]
                 qty = item["quantity"]
-                if sku in inv_map:
-                    inv_map[sku]["stock"] = max(0.0, inv_map[sku]["stock"] - qty)
-                    cost_unit = float(item["input_cost"] or 0.0)
-                    total_manufacturing_cost += cost_unit * qty
-                    # Registrar costo histórico
-                    cur.execute(
-                        "UPDATE production_order_additional_items SET unit_cost = %s WHERE id = %s",
-                        (cost_unit, item["id"])
-                    )
+                cost_unit = float(item["input_cost"] or 0.0)
+                total_manufacturing_cost += cost_unit * qty
+                movements.append({
+                    "sku": item["input_sku"],
+                    "quantity": -qty,
+                    "movement_type": "consumo_ot",
+                    "reference_type": "production_order",
+                    "reference_id": ot_id,
+                    "unit_cost": cost_unit,
+                })
+                # Registrar costo histórico
+                cur.execute(
+                    "UPDATE production_order_additional_items SET unit_cost = %s WHERE id = %s",
+                    (cost_unit, item["id"])
+                )
                     
             # Incrementar producto terminado
-            final_sku = ot["final_sku"]
-            if final_sku in inv_map:
-                inv_map[final_sku]["stock"] = inv_map[final_sku]["stock"] + ot["quantity"]
-            else:
-                # Si no existía en el listado de inventario, lo agregamos
-                cur.execute("SELECT name, category, description FROM products WHERE sku = %s", (final_sku,))
-                prod_info = cur.fetchone()
-                if prod_info:
-                    inventory_items.append({
-                        "code": final_sku,
-                        "name": prod_info["name"],
-                        "desc": prod_info["description"] or "",
-                        "category": prod_info["category"] or "Varios",
-                        "stock": float(ot["quantity"]),
-                        "min_stock": 10,
-                        "price": 0.0,
-                        "status": "Normal",
-                        "stock_percent": 100
-                    })
-            
-            # Guardar inventario
-            set_page_data("inventory_items", inventory_items)
+            movements.append({
+                "sku": ot["final_sku"],
+                "quantity": float(ot["quantity"]),
+                "movement_type": "produccion_ot",
+                "reference_type": "production_order",
+                "reference_id": ot_id,
+                "unit_cost": total_manufacturing_cost / ot["quantity"] if ot["quantity"] > 0 else 0.0,
+            })
+            # Con el cursor de la OT: los movimientos se confirman junto con ella
+            _post_inventory_movements(cur, movements)
             
             # 3.8. Registrar el ingreso en el historial de entradas con el costo real recalculado
             actual_unit_price = total_manufacturing_cost / ot["quantity"] if ot["quantity"] > 0 else 0.0
@@ -393,6 +378,8 @@ def finalizar_ot(ot_id):
                 """,
                 (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), actual_unit_price, ot_id)
             )
+            # Liberar la reserva de insumos ya consumidos
+            _sync_production_order_stock(cur, ot_id)
         conn.commit()
         
     flash("Orden de Trabajo finalizada. Insumos rebajados y producto terminado ingresado al stock.", "success")
@@ -434,6 +421,7 @@ def adicionar_insumo(ot_id):
                     datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 )
             )
+            _sync_production_order_stock(cur, ot_id)
         conn.commit()
         
     flash("Insumo adicional agregado y reservado en stock correctamente.", "success")
@@ -569,8 +557,7 @@ def get_product_recipe(product_id):
         return jsonify({"error": "Receta no encontrada"}), 404
         
     # Obtener stock físico actual
-    inventory_items = get_page_data("inventory_items") or []
-    stock_map = {item["code"]: float(item.get("stock", 0.0)) for item in inventory_items}
+    stock_map = get_stock_map([item["input_sku"] for item in items])
     
     for item in items:
         sku = item["input_sku"]
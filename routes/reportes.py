@@ -1,5 +1,15 @@
-from flask import Blueprint, render_template, make_response
-from db import get_income_report_data
+from datetime import datetime
+
+from flask import Blueprint, render_template, make_response, request, jsonify, Response, flash
+from db import (
+    get_income_report_data,
+    get_income_report_detail,
+    get_receivables_aging,
+    list_receivables,
+    iter_export_rows,
+    EXPORT_TYPES,
+)
+from exports import csv_stream, xlsx_stream
 
 reportes_bp = Blueprint('reportes', __name__)
 
@@ -29,3 +39,92 @@ def reportes_ingresos():
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     return response
+
+@reportes_bp.route('/api/reporteria/ingresos/<tipo>')
+def reportes_ingresos_detalle(tipo):
+    """Detalle paginado del reporte de ingresos: historicos (pagados) o futuros (por cobrar)"""
+    try:
+        detail = get_income_report_detail(
+            tipo,
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 25, type=int),
+            sort=request.args.get('sort', 'sale_date'),
+            direction=request.args.get('dir', 'asc'),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(detail)
+
+@reportes_bp.route('/reporteria/cuentas-por-cobrar')
+def reportes_cuentas_por_cobrar():
+    """Antigüedad de saldos por cobrar por cliente"""
+    try:
+        aging = get_receivables_aging(request.args.get('fecha'))
+    except ValueError as e:
+        flash(str(e), "danger")
+        aging = get_receivables_aging()
+    return render_template('reporte_cuentas_por_cobrar.html', aging=aging)
+
+@reportes_bp.route('/api/cuentas-por-cobrar')
+def api_cuentas_por_cobrar():
+    """Antigüedad de saldos por cliente en JSON (fecha de corte opcional)"""
+    try:
+        return jsonify(get_receivables_aging(request.args.get('fecha')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@reportes_bp.route('/api/cuentas-por-cobrar/ventas')
+def api_cuentas_por_cobrar_ventas():
+    """Ventas con saldo pendiente, filtrables por cliente y tramo"""
+    try:
+        items = list_receivables(
+            request.args.get('fecha'),
+            customer_name=request.args.get('cliente'),
+            bucket=request.args.get('tramo'),
+            limit=request.args.get('limit', 500, type=int),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": items})
+
+@reportes_bp.route('/reporteria/exportar/<tipo>')
+def exportar(tipo):
+    """Exportación en streaming de ventas, pagos, órdenes de compra o ingresos (CSV o XLSX)"""
+    formato = request.args.get('formato', 'csv')
+    comprimir = request.args.get('gzip') == '1'
+    if tipo not in EXPORT_TYPES:
+        return jsonify({"error": f"Tipo de exportación desconocido: {tipo}"}), 404
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({"error": "formato debe ser csv o xlsx"}), 400
+
+    filters = {
+        'date_from': request.args.get('desde'),
+        'date_to': request.args.get('hasta'),
+        'status': request.args.get('estado'),
+    }
+    try:
+        rows = iter_export_rows(tipo, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    columns = EXPORT_TYPES[tipo]['columns']
+    filename = f"{tipo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    if formato == 'xlsx':
+        body = xlsx_stream(columns, rows, sheet_name=tipo)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename += '.xlsx'
+    elif comprimir:
+        body = csv_stream(columns, rows, compress=True)
+        mimetype = 'application/gzip'
+        filename += '.csv.gz'
+    else:
+        body = csv_stream(columns, rows)
+        mimetype = 'text/csv'
+        filename += '.csv'
+
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    # Evitar que un proxy (nginx) acumule la respuesta completa antes de enviarla
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
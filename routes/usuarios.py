@@ -1,5 +1,6 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
 from datetime import datetime
+import io
 import json
 from db import (
     get_page_data,
@@ -13,8 +14,14 @@ from db import (
     insert_user,
     update_user,
     delete_user,
-    set_page_data,
-    list_products
+    list_products,
+    get_price_list_config,
+    get_price_matrix,
+    save_price_list_config,
+    save_product_margins,
+    simulate_price_list,
+    import_sales_csv,
+    IMPORT_SALES_COLUMNS
 )
 
 usuarios_bp = Blueprint('usuarios', __name__)
@@ -29,19 +36,7 @@ def administracion():
 
 @usuarios_bp.route('/administracion/listas-precios', methods=['GET', 'POST'])
 def listas_precios():
-    from db import get_connection
-    
-    config = get_page_data("price_list_config")
-    if not config or "categories" not in config:
-        config = {
-            "base_margin": 20.0,
-            "categories": [
-                {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
-                {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
-                {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
-                {"id": "cat_3", "name": "Categoría D", "margin": 20.0}
-            ]
-        }
+    config = get_price_list_config()
     
     if request.method == 'POST':
         action = request.form.get('action')
@@ -61,7 +56,7 @@ def listas_precios():
                     "margin": float(margin or 0.0)
                 })
             config["categories"] = categories
-            set_page_data("price_list_config", config)
+            save_price_list_config(config)
             flash("Configuración de categorías y márgenes actualizada.", "success")
             return redirect(url_for('usuarios.listas_precios'))
             
@@ -75,96 +70,34 @@ def listas_precios():
                     cat_id = key.split('[')[1].split(']')[0]
                     category_margins[cat_id] = float(value or 0.0)
             
-            with get_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO product_margins (product_sku, base_margin, category_margins)
-                        VALUES (%s, %s, %s::jsonb)
-                        ON CONFLICT (product_sku) DO UPDATE
-                        SET base_margin = EXCLUDED.base_margin,
-                            category_margins = EXCLUDED.category_margins
-                        """,
-                        (sku, base_margin, json.dumps(category_margins))
-                    )
-                conn.commit()
+            save_product_margins(sku, base_margin, category_margins)
             return jsonify({"status": "ok", "message": f"Márgenes de {sku} actualizados."})
 
-    # Carga de VPP por producto
-    vpp_map = {}
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT product_id, SUM(quantity) as total_qty, SUM(total) as total_spent
-                FROM inventory_entry_items
-                GROUP BY product_id
-                """
-            )
-            for row in cur.fetchall():
-                qty = row["total_qty"] or 0
-                spent = row["total_spent"] or 0.0
-                if qty > 0:
-                    vpp_map[row["product_id"]] = spent / qty
-
-    # Mapeo de precios por catálogo fallback
-    catalog_prices = {}
-    inventory_items = get_page_data("inventory_items") or []
-    for item in inventory_items:
-        catalog_prices[item["code"]] = item.get("price", 0.0)
-
-    # Carga de márgenes específicos de producto
-    prod_margins_map = {}
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM product_margins")
-            for row in cur.fetchall():
-                prod_margins_map[row["product_sku"]] = dict(row)
-
-    products_db = list_products()
+    # Precios precalculados por producto y categoría
+    price_matrix = get_price_matrix()
     products_display = []
     
-    for p in products_db:
+    for p in list_products():
         if p.get("product_type", "Final") == "Insumo":
             continue
-        sku = p["sku"]
-        p_id = p["id"]
-        
-        vpp = vpp_map.get(p_id)
-        if vpp is None:
-            vpp = catalog_prices.get(sku, 0.0)
-            
-        m = prod_margins_map.get(sku)
-        product_cat_margins = {}
-        if m:
-            base_margin = m["base_margin"]
-            product_cat_margins = m["category_margins"] or {}
-        else:
-            base_margin = config["base_margin"]
+        prices = price_matrix.get(p["sku"]) or {"vpp": 0.0, "base_margin": config["base_margin"], "price_base": 0.0, "categories": {}}
             
-        price_base = vpp * (1 + base_margin / 100)
-        
         categories_display = []
         for cat in config["categories"]:
-            cat_id = cat["id"]
-            margin = product_cat_margins.get(cat_id)
-            if margin is None:
-                margin = cat["margin"]
-                
-            price_final = price_base * (1 + margin / 100)
+            cat_prices = prices["categories"].get(cat["id"], {})
             categories_display.append({
-                "id": cat_id,
+                "id": cat["id"],
                 "name": cat["name"],
-                "margin": margin,
-                "price_final": round(price_final, 2)
+                "margin": cat_prices.get("margin", cat["margin"]),
+                "price_final": cat_prices.get("price", 0.0)
             })
             
         products_display.append({
-            "sku": sku,
+            "sku": p["sku"],
             "name": p["name"],
-            "vpp": vpp,
-            "base_margin": base_margin,
-            "price_base": round(price_base, 2),
+            "vpp": prices["vpp"],
+            "base_margin": prices["base_margin"],
+            "price_base": prices["price_base"],
             "categories": categories_display
         })
 
@@ -174,6 +107,46 @@ def listas_precios():
         products=products_display
     )
 
+@usuarios_bp.route('/api/listas-precios/simular', methods=['POST'])
+def simular_listas_precios():
+    """Recalcula la lista de precios con márgenes propuestos, sin guardar cambios"""
+    payload = request.get_json(silent=True) or {}
+    try:
+        base_margin = payload.get("base_margin")
+        base_margin = float(base_margin) if base_margin is not None else None
+        category_margins = {
+            str(cat_id): float(margin)
+            for cat_id, margin in (payload.get("category_margins") or {}).items()
+        }
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "Márgenes inválidos"}), 400
+    return jsonify(simulate_price_list(base_margin, category_margins))
+
+@usuarios_bp.route('/administracion/importar-ventas', methods=['GET', 'POST'])
+def importar_ventas():
+    """Importación masiva de ventas históricas desde CSV"""
+    if session.get('role_name') not in ['Gerente', 'Administrativo']:
+        flash("No tienes permisos para importar ventas.", "danger")
+        return redirect(url_for('usuarios.administracion'))
+
+    summary = None
+    if request.method == 'POST':
+        file = request.files.get('archivo')
+        if not file or not file.filename:
+            flash("Selecciona un archivo CSV.", "warning")
+            return redirect(url_for('usuarios.importar_ventas'))
+        dry_run = request.form.get('dry_run') == '1'
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        try:
+            summary = import_sales_csv(stream, dry_run=dry_run, with_entries=request.form.get('registro') == '1')
+        except (ValueError, UnicodeDecodeError) as e:
+            flash(f"No se pudo importar el archivo: {e}", "danger")
+            return redirect(url_for('usuarios.importar_ventas'))
+        if not dry_run and summary['imported_sales']:
+            flash(f"Se importaron {summary['imported_sales']} ventas ({summary['imported_rows']} líneas).", "success")
+
+    return render_template('importar_ventas.html', summary=summary, columns=IMPORT_SALES_COLUMNS)
+
 @usuarios_bp.route('/usuarios', methods=['GET', 'POST'])
 def usuarios():
     """Gestión de usuarios"""
@@ -11,7 +11,16 @@ from db import (
     list_products,
     insert_sale,
     get_sale,
-    update_sale
+    update_sale,
+    get_status_history_for_sales,
+    get_payment_history_for_sales,
+    _sync_sale_stock,
+    get_price_list_config,
+    get_price_matrix,
+    publish_cache_invalidation,
+    list_pending_payment_approvals,
+    approve_sale_payments,
+    reject_sale_payments
 )
 
 ventas_bp = Blueprint('ventas', __name__)
@@ -32,16 +41,24 @@ def proyeccion_ventas():
     )
 
 def _get_formatted_sales_data():
-    sales_list = list_sales(None)
     today_str = datetime.today().strftime('%Y-%m-%d')
+    return _format_sales_records(list_sales(None), today_str), today_str
+
+
+def _format_sales_records(sales_list, today_str):
     ventas_records_all = []
     from db import get_connection
 
-    # Cargar mapa de clientes para enriquecer datos
+    # Cargar sólo los clientes de estas ventas para enriquecer datos
+    emails = sorted({(s.get("customer_email") or "").lower().strip() for s in sales_list} - {""})
+    names = sorted({(s.get("customer_name") or "").lower().strip() for s in sales_list} - {""})
     clients_map = {}
     with get_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM clients")
+            cur.execute(
+                "SELECT * FROM clients WHERE LOWER(TRIM(email)) = ANY(%s) OR LOWER(TRIM(razon_social)) = ANY(%s)",
+                (emails, names)
+            )
             for c in cur.fetchall():
                 c_dict = dict(c)
                 if c_dict.get("email"):
@@ -51,6 +68,11 @@ def _get_formatted_sales_data():
                 if c_dict.get("rut"):
                     clients_map[c_dict["rut"].strip()] = c_dict
 
+            # Historiales de todas las ventas en dos consultas en vez de dos por venta
+            sale_ids = [sale["id"] for sale in sales_list]
+            status_histories = get_status_history_for_sales(sale_ids)
+            payment_histories = get_payment_history_for_sales(sale_ids)
+
             for sale in sales_list:
                 raw_p_status = sale.get("payment_status") or "Pendiente"
                 due_date = sale.get("invoice_due_date") or ""
@@ -60,18 +82,6 @@ def _get_formatted_sales_data():
                     if due_date < today_str:
                         calculated_payment_status = "Retrasada"
 
-                cur.execute(
-                    "SELECT status, user_name, changed_at, comment FROM sales_status_history WHERE sale_id = %s ORDER BY id DESC",
-                    (sale["id"],)
-                )
-                history = [dict(row) for row in cur.fetchall()]
-
-                cur.execute(
-                    "SELECT action, user_name, changed_at, details FROM sales_payment_history WHERE sale_id = %s ORDER BY id DESC",
-                    (sale["id"],)
-                )
-                payment_history = [dict(row) for row in cur.fetchall()]
-
                 c_email = (sale.get("customer_email") or "").lower().strip()
                 c_name = (sale.get("customer_name") or "").lower().strip()
                 c_data = clients_map.get(c_email) or clients_map.get(c_name) or {}
@@ -127,51 +137,65 @@ def _get_formatted_sales_data():
                         "name": sale["seller_name"],
                         "initials": sale.get("seller_initials", "")
                     },
-                    "history": history,
-                    "payment_history": payment_history
+                    "history": status_histories[sale["id"]],
+                    "payment_history": payment_histories[sale["id"]]
                 })
-    return ventas_records_all, today_str
+    return ventas_records_all
+
+
+VENTAS_PAGE_SIZE = 50
+
+# Tarjetas de /ventas -> filtros SQL de list_sales_page
+VENTAS_CARD_FILTERS = {
+    'Ventas Pendientes': {'status': 'Pendiente'},
+    'Ventas Completadas': {'status': 'Completada'},
+    'Pago Retrasado': {'payment_overdue': True},
+    'Pagos Retrasados': {'payment_overdue': True},
+    'Retrasada': {'payment_overdue': True},
+}
 
 
 @ventas_bp.route('/ventas')
 def ventas():
     """Módulo exclusivo de Ventas"""
+    from db import list_sales_page, count_sales, get_sale_payments_for_sales, get_sales_filter_options
     card_filter = request.args.get('filter', '')
     active_filter = card_filter
+    selected_client = request.args.get('cliente', '').strip()
+    selected_product = request.args.get('producto', '').strip()
+    today_str = datetime.today().strftime('%Y-%m-%d')
 
-    ventas_records_all, today_str = _get_formatted_sales_data()
-
-    # Excluir cotizaciones para esta vista
-    only_ventas = [r for r in ventas_records_all if r['status']['label'] != 'Cotización' and not str(r['sale_number']).startswith('COT-')]
-
-    count_retrasadas = sum(1 for v in only_ventas if v['payment_status'] == 'Retrasada')
-
-    ventas_records = []
-    for record in only_ventas:
-        if card_filter == 'Ventas Pendientes':
-            if record['status']['label'] == 'Pendiente':
-                ventas_records.append(record)
-        elif card_filter == 'Ventas Completadas':
-            if record['status']['label'] == 'Completada':
-                ventas_records.append(record)
-        elif card_filter in ['Pago Retrasado', 'Pagos Retrasados', 'Retrasada']:
-            if record['payment_status'] == 'Retrasada':
-                ventas_records.append(record)
-        elif card_filter == 'Ventas Hoy':
-            if record['date'] == today_str:
-                ventas_records.append(record)
-        else:
-            ventas_records.append(record)
-
-    # Extraer clientes y productos únicos para filtros
-    all_clients = sorted(list(set(v['customer']['name'] for v in only_ventas if v['customer']['name'])))
-    all_products_set = set()
-    for v in only_ventas:
-        for p in v['products']:
-            p_name = p.get('product_name') or p.get('name') if isinstance(p, dict) else str(p)
-            if p_name:
-                all_products_set.add(p_name)
-    all_products = sorted(list(all_products_set))
+    # Los filtros de tarjeta, cliente y producto se resuelven en SQL y sólo se renderiza una página
+    filters = {'exclude_quotes': True, 'customer_exact': selected_client, 'product': selected_product}
+    filters.update(VENTAS_CARD_FILTERS.get(card_filter, {}))
+    if card_filter == 'Ventas Hoy':
+        filters.update({'date_from': today_str, 'date_to': today_str})
+
+    try:
+        page = list_sales_page(
+            VENTAS_PAGE_SIZE,
+            request.args.get('cursor') or None,
+            filters,
+            backward=request.args.get('dir') == 'prev',
+        )
+    except ValueError:
+        page = list_sales_page(VENTAS_PAGE_SIZE, None, filters)
+
+    sales_list = page["items"]
+    payments = get_sale_payments_for_sales([sale["id"] for sale in sales_list])
+    for sale in sales_list:
+        payment = payments.get(sale["id"], {})
+        for field in ("invoice_due_date", "payment_date", "payment_proof_file", "invoice_number", "invoice_file"):
+            sale[field] = payment.get(field)
+    ventas_records = _format_sales_records(sales_list, today_str)
+
+    total_records = count_sales(filters, estimate=True)
+    count_retrasadas = count_sales({'exclude_quotes': True, 'payment_overdue': True}, estimate=True)
+
+    # Opciones de filtros desde una consulta cacheada
+    filter_options = get_sales_filter_options()
+    all_clients = filter_options["clients"]
+    all_products = filter_options["products"]
 
     metrics = get_sales_metrics()
     ventas_metrics = [
@@ -213,8 +237,7 @@ def ventas():
     ]
 
     roles = list_roles()
-    config = get_page_data("price_list_config")
-    categories = config.get("categories", [])
+    categories = get_price_list_config()["categories"]
     from flask import make_response
     response = make_response(render_template(
         'ventas.html',
@@ -225,6 +248,11 @@ def ventas():
         roles=roles,
         categories=categories,
         active_filter=active_filter,
+        selected_client=selected_client,
+        selected_product=selected_product,
+        total_records=total_records,
+        next_cursor=page["next_cursor"],
+        prev_cursor=page["prev_cursor"],
     ))
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
@@ -250,15 +278,11 @@ def cotizaciones():
         else:
             cotizaciones_records.append(record)
 
-    # Extraer clientes y productos únicos para filtros
-    all_clients = sorted(list(set(c['customer']['name'] for c in only_cotizaciones if c['customer']['name'])))
-    all_products_set = set()
-    for c in only_cotizaciones:
-        for p in c['products']:
-            p_name = p.get('product_name') or p.get('name') if isinstance(p, dict) else str(p)
-            if p_name:
-                all_products_set.add(p_name)
-    all_products = sorted(list(all_products_set))
+    # Opciones de filtros desde una consulta cacheada
+    from db import get_sales_filter_options
+    filter_options = get_sales_filter_options(quotes=True)
+    all_clients = filter_options["clients"]
+    all_products = filter_options["products"]
 
     total_amount_cotizaciones = sum(c['total_raw'] for c in only_cotizaciones)
     unique_clients_count = len(set(c['customer']['name'] for c in only_cotizaciones if c['customer']['name']))
@@ -295,8 +319,7 @@ def cotizaciones():
     ]
 
     roles = list_roles()
-    config = get_page_data("price_list_config")
-    categories = config.get("categories", [])
+    categories = get_price_list_config()["categories"]
     from flask import make_response
     response = make_response(render_template(
         'cotizaciones.html',
@@ -432,7 +455,16 @@ def registrar_pago_venta():
     with get_connection() as conn:
         with conn.cursor() as cur:
             # 1. Obtener la venta, su estado anterior y el pago anterior para auditar diferencias
-            cur.execute("SELECT total_amount, sale_date, status, payment_status FROM sales WHERE id = %s", (sale_id,))
+            cur.execute(
+                """
+                SELECT s.total_amount, s.sale_date, s.status, s.payment_status,
+                       sp.invoice_due_date, sp.payment_date, sp.payment_proof_file
+                FROM sales s
+                LEFT JOIN sale_payments sp ON sp.sale_id = s.id
+                WHERE s.id = %s
+                """,
+                (sale_id,)
+            )
             sale_row = cur.fetchone()
             if not sale_row:
                 flash('Venta no encontrada.', 'danger')
@@ -442,13 +474,9 @@ def registrar_pago_venta():
             sale_date = sale_row["sale_date"]
             old_sale_status = sale_row["status"]
             old_payment_status = sale_row["payment_status"]
-
-            # Obtener datos de pago anteriores
-            cur.execute("SELECT invoice_due_date, payment_date, payment_proof_file FROM sale_payments WHERE sale_id = %s", (sale_id,))
-            old_payment_row = cur.fetchone()
-            old_due_date = old_payment_row["invoice_due_date"] if old_payment_row else None
-            old_payment_date = old_payment_row["payment_date"] if old_payment_row else None
-            old_proof_file = old_payment_row["payment_proof_file"] if old_payment_row else None
+            old_due_date = sale_row["invoice_due_date"]
+            old_payment_date = sale_row["payment_date"]
+            old_proof_file = sale_row["payment_proof_file"]
 
             # Si el estado de pago cambia a Pendiente
             if payment_status == 'Pendiente' and old_payment_status in ['Pagado', 'Pendiente Aprobación Pago']:
@@ -516,20 +544,15 @@ def registrar_pago_venta():
                 )
 
             # 2. Actualizar el estado de pago principal en la tabla sales
+            # Automatización: Si el pago se registró como "Pagado" y la venta no estaba Completada
+            auto_completed = payment_status == 'Pagado' and old_sale_status != 'Completada'
             cur.execute(
-                "UPDATE sales SET payment_status = %s WHERE id = %s",
-                (payment_status, sale_id)
+                "UPDATE sales SET payment_status = %s, status = CASE WHEN %s THEN 'Completada' ELSE status END WHERE id = %s",
+                (payment_status, auto_completed, sale_id)
             )
-
-            # Automatización: Si el pago se registró como "Pagado" y la venta no estaba Completada
-            auto_completed = False
-            if payment_status == 'Pagado' and old_sale_status != 'Completada':
-                cur.execute(
-                    "UPDATE sales SET status = 'Completada' WHERE id = %s",
-                    (sale_id,)
-                )
-                auto_completed = True
-                
+            publish_cache_invalidation(cur, "income_report")
+            if auto_completed:
+                _sync_sale_stock(cur, sale_id)
                 # Registrar historial de estado por cambio automático del sistema
                 cur.execute(
                     """
@@ -589,72 +612,109 @@ def aprobar_pago_venta(sale_id):
     if user_role not in ['Aprobador', 'Gerente', 'Administrativo']:
         flash("No tienes permisos para aprobar pagos.", "danger")
         return redirect(url_for('ventas.ventas'))
-        
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            # 1. Obtener la venta
-            cur.execute("SELECT payment_status, total_amount FROM sales WHERE id = %s", (sale_id,))
-            sale_row = cur.fetchone()
-            if not sale_row:
-                flash("Venta no encontrada.", "danger")
-                return redirect(url_for('ventas.ventas'))
-                
-            if sale_row['payment_status'] != 'Pendiente Aprobación Pago':
-                flash("El pago de esta venta no está pendiente de aprobación.", "warning")
-                return redirect(url_for('ventas.ventas'))
-                
-            # 2. Actualizar el estado de pago principal a 'Pagado' y el estado de la venta a 'Completada'
-            cur.execute("UPDATE sales SET payment_status = 'Pagado', status = 'Completada' WHERE id = %s", (sale_id,))
-            
-            # 3. Actualizar la tabla sale_payments
-            cur.execute(
-                """
-                UPDATE sale_payments
-                SET status = 'Pagado',
-                    accounting_approved = 1,
-                    accounting_approved_by = %s,
-                    accounting_approved_at = %s,
-                    payment_amount = %s,
-                    updated_at = %s
-                WHERE sale_id = %s
-                """,
-                (user_responsible, datetime.utcnow().isoformat(), sale_row['total_amount'], datetime.utcnow().isoformat(), sale_id)
-            )
-            
-            # 4. Registrar en historial de estado
-            cur.execute(
-                """
-                INSERT INTO sales_status_history (sale_id, status, user_name, changed_at, comment)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (
-                    sale_id,
-                    'Completada',
-                    f'Sistema (Aprobación por {user_responsible})',
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'Estado cambiado a Completada tras aprobación de pago'
-                )
-            )
-            
-            # 5. Registrar en historial de pagos
-            cur.execute(
-                """
-                INSERT INTO sales_payment_history (sale_id, action, user_name, changed_at, details)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (
-                    sale_id,
-                    'Pago Aprobado',
-                    user_responsible,
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'El pago fue validado y aprobado formalmente.'
-                )
-            )
-        conn.commit()
-        
+
+    if not get_sale(sale_id):
+        flash("Venta no encontrada.", "danger")
+        return redirect(url_for('ventas.ventas'))
+    if not approve_sale_payments([sale_id], user_responsible):
+        flash("El pago de esta venta no está pendiente de aprobación.", "warning")
+        return redirect(url_for('ventas.ventas'))
+
     flash("Pago aprobado y verificado correctamente.", "success")
     return redirect(url_for('ventas.ventas'))
 
+@ventas_bp.route('/ventas/aprobaciones', methods=['GET', 'POST'])
+def aprobaciones_pagos():
+    """Cola de pagos por aprobar, con aprobación o rechazo en lote"""
+    if session.get('role_name') not in ['Aprobador', 'Gerente', 'Administrativo']:
+        flash("No tienes permisos para aprobar pagos.", "danger")
+        return redirect(url_for('ventas.ventas'))
+
+    if request.method == 'POST':
+        sale_ids = request.form.getlist('sale_ids', type=int)
+        accion = request.form.get('accion')
+        user_responsible = session.get('full_name', 'Administrador')
+        if not sale_ids:
+            flash("Selecciona al menos una venta.", "warning")
+        elif accion == 'aprobar':
+            approved = approve_sale_payments(sale_ids, user_responsible)
+            flash(f"Se aprobaron {len(approved)} pagos.", "success")
+        elif accion == 'rechazar':
+            rejected = reject_sale_payments(sale_ids, user_responsible, request.form.get('comentario', ''))
+            flash(f"Se rechazaron {len(rejected)} pagos; las ventas volvieron a pago Pendiente.", "warning")
+        else:
+            flash("Acción no válida.", "danger")
+        return redirect(url_for('ventas.aprobaciones_pagos'))
+
+    queue = list_pending_payment_approvals()
+    return render_template('aprobaciones_pagos.html', queue=queue)
+
+@ventas_bp.route('/ventas/conciliacion', methods=['GET', 'POST'])
+def conciliacion_bancaria():
+    """Importar cartolas bancarias y revisar los movimientos que no se conciliaron solos"""
+    import io
+    from db import import_bank_statement, list_pending_bank_movements, BANK_STATEMENT_COLUMNS
+
+    if session.get('role_name') not in ['Aprobador', 'Gerente', 'Administrativo']:
+        flash("No tienes permisos para conciliar pagos.", "danger")
+        return redirect(url_for('ventas.ventas'))
+
+    summary = None
+    if request.method == 'POST':
+        file = request.files.get('archivo')
+        if not file or not file.filename:
+            flash("Selecciona un archivo CSV.", "warning")
+            return redirect(url_for('ventas.conciliacion_bancaria'))
+        dry_run = request.form.get('dry_run') == '1'
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        try:
+            summary = import_bank_statement(
+                stream, file_name=file.filename, user_name=session.get('full_name', 'Administrador'), dry_run=dry_run
+            )
+        except (ValueError, UnicodeDecodeError) as e:
+            flash(f"No se pudo importar la cartola: {e}", "danger")
+            return redirect(url_for('ventas.conciliacion_bancaria'))
+        if not dry_run and summary['matched']:
+            flash(f"Se conciliaron {summary['matched']} movimientos.", "success")
+
+    pending = list_pending_bank_movements()
+    return render_template('conciliacion_bancaria.html', summary=summary, pending=pending, columns=BANK_STATEMENT_COLUMNS)
+
+@ventas_bp.route('/ventas/conciliacion/<int:movement_id>/conciliar', methods=['POST'])
+def conciliar_movimiento(movement_id):
+    """Conciliar a mano un movimiento pendiente con una venta"""
+    from db import confirm_bank_movement
+
+    if session.get('role_name') not in ['Aprobador', 'Gerente', 'Administrativo']:
+        flash("No tienes permisos para conciliar pagos.", "danger")
+        return redirect(url_for('ventas.ventas'))
+    try:
+        result = confirm_bank_movement(
+            movement_id, request.form.get('sale_number', ''), session.get('full_name', 'Administrador')
+        )
+    except ValueError as e:
+        flash(str(e), "danger")
+    else:
+        estado = " y quedó pagada" if result['paid'] else ""
+        flash(f"Movimiento conciliado con la venta {result['sale_number']}{estado}.", "success")
+    return redirect(url_for('ventas.conciliacion_bancaria'))
+
+@ventas_bp.route('/ventas/conciliacion/<int:movement_id>/descartar', methods=['POST'])
+def descartar_movimiento(movement_id):
+    """Descartar un movimiento que no corresponde a un pago de ventas"""
+    from db import discard_bank_movement
+
+    if session.get('role_name') not in ['Aprobador', 'Gerente', 'Administrativo']:
+        flash("No tienes permisos para conciliar pagos.", "danger")
+        return redirect(url_for('ventas.ventas'))
+    try:
+        discard_bank_movement(movement_id, session.get('full_name', 'Administrador'))
+    except ValueError as e:
+        flash(str(e), "danger")
+    else:
+        flash("Movimiento descartado.", "info")
+    return redirect(url_for('ventas.conciliacion_bancaria'))
+
 @ventas_bp.route('/ventas/actualizar-estado', methods=['POST'])
 def actualizar_estado_venta():
     """Actualizar el estado general de la venta (Completada, Pendiente, Cancelada)"""
@@ -721,6 +781,8 @@ def actualizar_estado_venta():
                 "UPDATE sales SET status = %s WHERE id = %s",
                 (new_status, sale_id)
             )
+            _sync_sale_stock(cur, sale_id)
+            publish_cache_invalidation(cur, "income_report")
 
             # 3. Guardar el número de factura y el archivo adjunto de la factura en sale_payments
             # Primero verificar si existe un registro de pago para esa venta
@@ -999,79 +1061,22 @@ def nueva_cotizacion():
                 "products": cloned_sale.get("products", [])
             }
     
-    # Lógica de construcción de precios por categorías de clientes para la cotización
-    config = get_page_data("price_list_config")
-    if not config or "categories" not in config:
-        config = {
-            "base_margin": 20.0,
-            "categories": [
-                {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
-                {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
-                {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
-                {"id": "cat_3", "name": "Categoría D", "margin": 20.0}
-            ]
-        }
-        
-    vpp_map = {}
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT product_id, SUM(quantity) as total_qty, SUM(total) as total_spent
-                FROM inventory_entry_items
-                GROUP BY product_id
-                """
-            )
-            for row in cur.fetchall():
-                qty = row["total_qty"] or 0
-                spent = row["total_spent"] or 0.0
-                if qty > 0:
-                    vpp_map[row["product_id"]] = spent / qty
-
-    catalog_prices = {}
-    inventory_items = get_page_data("inventory_items") or []
-    for item in inventory_items:
-        catalog_prices[item["code"]] = item.get("price", 0.0)
-
-    prod_margins_map = {}
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM product_margins")
-            for row in cur.fetchall():
-                prod_margins_map[row["product_sku"]] = dict(row)
+    # Precios por categoría de cliente desde la matriz precalculada
+    config = get_price_list_config()
+    price_matrix = get_price_matrix()
 
     products_prices_map = {}
     for p in products:
-        sku = p["sku"]
-        p_id = p["id"]
-        
-        vpp = vpp_map.get(p_id)
-        if vpp is None:
-            vpp = catalog_prices.get(sku, 0.0)
-            
-        m = prod_margins_map.get(sku)
-        product_cat_margins = {}
-        if m:
-            base_margin = m["base_margin"]
-            product_cat_margins = m["category_margins"] or {}
-        else:
-            base_margin = config["base_margin"]
-            
-        price_base = vpp * (1 + base_margin / 100)
-        
-        prices = {
-            "default": round(price_base, 2)  # fallback si no se selecciona categoría
+        prices = price_matrix.get(p["sku"], {"price_base": 0.0, "categories": {}})
+        product_prices = {
+            "default": prices["price_base"]  # fallback si no se selecciona categoría
         }
         for cat in config["categories"]:
-            cat_id = cat["id"]
-            margin = product_cat_margins.get(cat_id)
-            if margin is None:
-                margin = cat["margin"]
-                
-            price_final = price_base * (1 + margin / 100)
-            prices[cat_id] = round(price_final, 2)
+            cat_prices = prices["categories"].get(cat["id"])
+            if cat_prices:
+                product_prices[cat["id"]] = cat_prices["price"]
             
-        products_prices_map[str(p_id)] = prices
+        products_prices_map[str(p["id"])] = product_prices
 
     return render_template(
         'nueva_cotizacion.html',
@@ -1192,6 +1197,7 @@ def convertir_cotizacion(sale_id):
                 """,
                 (new_sale_id, invoice_due_date, 'Factura pendiente', now_str, now_str)
             )
+            publish_cache_invalidation(cur, "income_report")
             cur.execute(
                 """
                 INSERT INTO sales_status_history (sale_id, status, user_name, changed_at, comment)
@@ -1213,7 +1219,7 @@ def convertir_cotizacion(sale_id):
 
 @ventas_bp.route('/ventas/clientes', methods=['GET', 'POST'])
 def clientes():
-    from db import list_clients, insert_client, get_page_data
+    from db import list_clients, insert_client
     if request.method == 'POST':
         client_data = {
             "rut": request.form.get('rut', '').strip(),
@@ -1232,20 +1238,17 @@ def clientes():
             "category_id": request.form.get('category_id', '').strip()
         }
         if client_data['razon_social']:
-            insert_client(client_data)
-            flash("Cliente registrado exitosamente.", "success")
+            try:
+                insert_client(client_data)
+                flash("Cliente registrado exitosamente.", "success")
+            except ValueError as e:
+                flash(str(e), "danger")
         else:
             flash("La Razón Social es requerida.", "warning")
         return redirect(url_for('ventas.clientes'))
 
     clients_list = list_clients()
-    config = get_page_data("price_list_config") or {}
-    categories = config.get("categories", [
-        {"id": "cat_0", "name": "Categoría A", "margin": 5.0},
-        {"id": "cat_1", "name": "Categoría B", "margin": 10.0},
-        {"id": "cat_2", "name": "Categoría C", "margin": 15.0},
-        {"id": "cat_3", "name": "Categoría D", "margin": 20.0}
-    ])
+    categories = get_price_list_config()["categories"]
     return render_template('clientes.html', clients=clients_list, categories=categories)
 
 
@@ -1268,8 +1271,11 @@ def editar_cliente(client_id):
         "phone": request.form.get('phone', '').strip(),
         "category_id": request.form.get('category_id', '').strip()
     }
-    update_client(client_id, client_data)
-    flash("Cliente actualizado exitosamente.", "success")
+    try:
+        update_client(client_id, client_data)
+        flash("Cliente actualizado exitosamente.", "success")
+    except ValueError as e:
+        flash(str(e), "danger")
     return redirect(url_for('ventas.clientes'))
 
 
@@ -1283,9 +1289,10 @@ def eliminar_cliente(client_id):
 
 @ventas_bp.route('/api/clientes/buscar_por_rut/<path:rut>')
 def api_buscar_cliente_por_rut(rut):
-    from db import get_client_by_rut
+    from db import get_client_by_rut, get_client_balance
     client = get_client_by_rut(rut)
     if client:
+        balance = get_client_balance(client.get("razon_social") or "")
         return jsonify({
             "status": "ok",
             "client": {
@@ -1295,9 +1302,56 @@ def api_buscar_cliente_por_rut(rut):
                 "razon_social": client.get("razon_social", ""),
                 "email": client.get("email", ""),
                 "phone": client.get("phone", ""),
-                "category_id": client.get("category_id", "")
+                "category_id": client.get("category_id", ""),
+                "open_sales": balance["open_sales"],
+                "balance_due": balance["balance_due"]
             }
         })
     return jsonify({"status": "not_found", "message": "Cliente no encontrado"}), 404
 
 
+
+
+@ventas_bp.route('/api/ventas')
+def api_listar_ventas():
+    """Listado paginado de ventas con cursor (?cursor=&direccion=siguiente|anterior)"""
+    from db import list_sales_page_light, count_sales
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    filters = {
+        'status': request.args.get('estado', '').strip(),
+        'customer_name': request.args.get('cliente', '').strip(),
+        'date_from': request.args.get('desde', '').strip(),
+        'date_to': request.args.get('hasta', '').strip(),
+    }
+    backward = request.args.get('direccion') == 'anterior'
+    try:
+        page = list_sales_page_light(limit, request.args.get('cursor') or None, filters, backward)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    for sale in page["items"]:
+        sale.pop("sale_ts", None)
+    response = {"status": "ok", **page}
+    if request.args.get('con_total') == '1':
+        response["total_estimado"] = count_sales(filters, estimate=True)
+    return jsonify(response)
+
+
+@ventas_bp.route('/api/ventas/aprobaciones')
+def api_aprobaciones_pagos():
+    """Ventas con pago pendiente de aprobación (?limit=)"""
+    if session.get('role_name') not in ['Aprobador', 'Gerente', 'Administrativo']:
+        return jsonify({"status": "error", "message": "No tienes permisos para aprobar pagos."}), 403
+    return jsonify({"status": "ok", **list_pending_payment_approvals(request.args.get('limit', 500, type=int))})
+
+@ventas_bp.route('/api/ventas/<int:sale_id>/historial')
+def api_historial_venta(sale_id):
+    """Historial de estados y pagos de una venta, para cargarlo al abrir su detalle"""
+    if not get_sale(sale_id):
+        return jsonify({"status": "error", "message": "Venta no encontrada"}), 404
+    return jsonify({
+        "status": "ok",
+        "sale_id": sale_id,
+        "history": get_status_history_for_sales([sale_id])[sale_id],
+        "payment_history": get_payment_history_for_sales([sale_id])[sale_id],
+    })